@@ -0,0 +1,254 @@
+"""
+blizzard_standin
+~~~~~~~~~~~~
+
+This module implements a local stand-in for oauth.battle.net and eu.api.blizzard.com.
+It serves the token, profile and media endpoints from the recorded responses in benchmarks/fixtures (or made up
+characters based on them) and can inject latency, errors and quota limits.
+
+Usage: python benchmarks/blizzard_standin.py [--port 8080] [--latency exp:80] [--rate-404 0.01] [--rate-429 0.02]
+                                             [--rate-5xx 0.01] [--quota 36000] [--qps 100] [--synthetic]
+
+Point blizzapi at it with
+    BLIZZAPI_OAUTH_URL=http://127.0.0.1:8080 BLIZZAPI_API_URL=http://127.0.0.1:8080
+
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from corpus import Corpus
+
+
+def parse_latency(spec: str):
+    """
+    Converts a latency specification into a function returning a delay in seconds
+    :param spec: One of "none", "fixed:MS", "uniform:MIN_MS:MAX_MS", "exp:MEAN_MS" or "lognormal:MEDIAN_MS:SIGMA"
+    :return: A function without arguments that draws a delay
+    """
+    kind, *values = spec.split(":")
+    values = [float(value) for value in values]
+    match kind:
+        case "none":
+            return lambda: 0.0
+        case "fixed":
+            return lambda: values[0] / 1000
+        case "uniform":
+            return lambda: random.uniform(values[0], values[1]) / 1000
+        case "exp":
+            return lambda: random.expovariate(1000 / values[0])
+        case "lognormal":
+            return lambda: values[0] / 1000 * random.lognormvariate(0, values[1])
+        case _:
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class StandinState:
+    def __init__(self, corpus: Corpus, latency, rate_404: float, rate_429: float, rate_5xx: float,
+                 quota: int, qps: int, token_lifetime: int):
+        self.corpus = corpus
+        self.latency = latency
+        self.rate_404 = rate_404
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.quota = quota
+        self.qps = qps
+        self.token_lifetime = token_lifetime
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.quota_used = 0
+        self.quota_reset = time.time() + 3600
+        self.second = int(time.time())
+        self.second_count = 0
+        self.stats = {"requests": 0, "tokens": 0, "status": {}}
+
+    def count(self, status: int):
+        """
+        Counts a response by its status code
+        :param status: The status code of the response
+        """
+        with self.lock:
+            self.stats["status"][str(status)] = self.stats["status"].get(str(status), 0) + 1
+
+    def take_quota(self) -> tuple:
+        """
+        Uses up one request of the hourly quota and the per-second limit
+        :return: A tuple of whether the request is allowed and the quota headers to send
+        """
+        with self.lock:
+            now = time.time()
+            self.stats["requests"] += 1
+            if now >= self.quota_reset:
+                self.quota_used = 0
+                self.quota_reset = now + 3600
+            if int(now) != self.second:
+                self.second = int(now)
+                self.second_count = 0
+            self.quota_used += 1
+            self.second_count += 1
+            allowed = self.quota_used <= self.quota and self.second_count <= self.qps
+            headers = {
+                "X-Plan-Quota-Allotted": str(self.quota),
+                "X-Plan-Quota-Current": str(min(self.quota_used, self.quota)),
+                "X-Plan-Quota-Reset": str(int((self.quota_reset - now) * 1000)),
+                "X-Plan-QPS-Allotted": str(self.qps),
+                "X-Plan-QPS-Current": str(min(self.second_count, self.qps))
+            }
+            return allowed, headers
+
+    def issue_token(self) -> str:
+        """
+        :return: A new access token that is valid for the configured lifetime
+        """
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.tokens[token] = time.time() + self.token_lifetime
+            self.stats["tokens"] += 1
+        return token
+
+    def token_valid(self, token: str) -> bool:
+        """
+        :param token: An access token as sent in the Authorization header
+        :return: Whether the token was issued by this server and has not expired yet
+        """
+        with self.lock:
+            return self.tokens.get(token, 0) > time.time()
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    server_version = "blizzard-standin/1.0"
+    state: StandinState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body, headers: dict = None):
+        """
+        Sends a JSON response
+        :param status: The status code of the response
+        :param body: The object to send as JSON, or None for an empty body
+        :param headers: Additional headers to send
+        """
+        payload = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=UTF-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        self.state.count(status)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.split("?")[0] != "/token":
+            self.send_json(404, {"code": 404, "type": "BLZWEBAPI00000404", "detail": "Not Found"})
+            return
+        time.sleep(self.state.latency())
+        self.send_json(200, {
+            "access_token": self.state.issue_token(),
+            "token_type": "bearer",
+            "expires_in": self.state.token_lifetime,
+            "sub": "standin"
+        })
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/_standin/stats":
+            self.send_json(200, self.state.stats)
+            return
+
+        authorization = self.headers.get("Authorization", "")
+        if not self.state.token_valid(authorization.removeprefix("Bearer ")):
+            self.send_json(401, {"code": 401, "type": "BLZWEBAPI00000401", "detail": "Unauthorized"})
+            return
+
+        allowed, headers = self.state.take_quota()
+        time.sleep(self.state.latency())
+        if not allowed:
+            headers["Retry-After"] = "1"
+            self.send_json(429, {"code": 429, "type": "BLZWEBAPI00000429", "detail": "Too Many Requests"}, headers)
+            return
+
+        roll = random.random()
+        if roll < self.state.rate_429:
+            headers["Retry-After"] = "1"
+            self.send_json(429, {"code": 429, "type": "BLZWEBAPI00000429", "detail": "Too Many Requests"}, headers)
+            return
+        roll -= self.state.rate_429
+        if roll < self.state.rate_5xx:
+            self.send_json(random.choice([500, 502, 503, 504]), None, headers)
+            return
+        roll -= self.state.rate_5xx
+        if roll < self.state.rate_404:
+            self.send_json(404, {"code": 404, "type": "BLZWEBAPI00000404", "detail": "Not Found"}, headers)
+            return
+
+        body = self.state.corpus.lookup(path)
+        if body == 404:
+            self.send_json(404, {"code": 404, "type": "BLZWEBAPI00000404", "detail": "Not Found"}, headers)
+            return
+
+        etag = '"' + hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest() + '"'
+        headers["ETag"] = etag
+        headers["Last-Modified"] = self.date_time_string(int(self.server.started))
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_json(304, None, headers)
+            return
+        self.send_json(200, body, headers)
+
+
+def make_server(host: str = "127.0.0.1", port: int = 8080, latency: str = "none", rate_404: float = 0.0,
+                rate_429: float = 0.0, rate_5xx: float = 0.0, quota: int = 36000, qps: int = 100,
+                token_lifetime: int = 86399, synthetic: bool = False) -> ThreadingHTTPServer:
+    """
+    Creates a stand-in server, call serve_forever() on it to start answering requests
+    :return: The server, its base url is http://host:server.server_port
+    """
+    state = StandinState(Corpus(synthetic=synthetic), parse_latency(latency), rate_404, rate_429, rate_5xx,
+                         quota, qps, token_lifetime)
+    handler = type("BoundStandinHandler", (StandinHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.started = time.time()
+    server.state = state
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Blizzard-API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", default="none",
+                        help="none, fixed:MS, uniform:MIN_MS:MAX_MS, exp:MEAN_MS or lognormal:MEDIAN_MS:SIGMA")
+    parser.add_argument("--rate-404", type=float, default=0.0, help="share of requests answered with 404")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="share of requests answered with 5xx")
+    parser.add_argument("--quota", type=int, default=36000, help="requests allowed per hour")
+    parser.add_argument("--qps", type=int, default=100, help="requests allowed per second")
+    parser.add_argument("--token-lifetime", type=int, default=86399, help="seconds until a token expires")
+    parser.add_argument("--synthetic", action="store_true",
+                        help="answer for any character or item by making it up from the recorded responses")
+    parser.add_argument("--seed", type=int, help="seed for latency and error injection")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    server = make_server(args.host, args.port, args.latency, args.rate_404, args.rate_429, args.rate_5xx,
+                         args.quota, args.qps, args.token_lifetime, args.synthetic)
+    print(f"Blizzard stand-in listening on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
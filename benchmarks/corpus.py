@@ -0,0 +1,116 @@
+"""
+corpus
+~~~~~~~~~~~~
+
+This module loads the recorded Blizzard-API responses in benchmarks/fixtures and serves them in place of the
+live api, so that data_processing and discordbot can be driven without network access.
+
+"""
+
+import copy
+import json
+import os
+import zlib
+from urllib.parse import urlparse
+
+fixture_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+profile_infotypes = ["equipment", "specializations", "character-media"]
+
+
+class Corpus:
+    def __init__(self, path: str = fixture_dir, synthetic: bool = False):
+        """
+        :param path: Directory containing the recorded responses
+        :param synthetic: Whether characters and items that were not recorded should be made up from the
+        recorded ones instead of answering with 404
+        """
+        self.profiles = {}
+        profile_dir = os.path.join(path, "profile")
+        for realm in sorted(os.listdir(profile_dir)):
+            for name in sorted(os.listdir(os.path.join(profile_dir, realm))):
+                responses = {}
+                for infotype in profile_infotypes:
+                    file = open(os.path.join(profile_dir, realm, name, infotype + ".json"), "r", encoding="utf-8")
+                    responses[infotype] = json.load(file)
+                    file.close()
+                self.profiles[(realm, name)] = responses
+
+        file = open(os.path.join(path, "item-media.json"), "r", encoding="utf-8")
+        self.item_media = json.load(file)
+        file.close()
+
+        self.templates = list(self.profiles)
+        self.aliases = {}
+        self.synthetic = synthetic
+
+    def roster(self, size: int) -> list:
+        """
+        Builds a synthetic raidlist of the given size, every character is backed by one of the recorded profiles
+        :param size: Number of characters in the raidlist
+        :return: A list in the format of raidplayerlist.json
+        """
+        playerlist = []
+        for index in range(size):
+            realm, name = self.templates[index % len(self.templates)]
+            if index >= len(self.templates):
+                name = f"{name}{index}"
+            self.aliases[(realm, name)] = self.templates[index % len(self.templates)]
+            playerlist.append({"name": name.title(), "realm": realm.replace("-", " ").title(), "discordID": -1})
+        return playerlist
+
+    def icon_ids(self) -> dict:
+        """
+        :return: The icon IDs of every recorded item, in the format of itemiconid.json
+        """
+        return {itemid: media["assets"][0]["file_data_id"] for itemid, media in self.item_media.items()}
+
+    def realm_index(self) -> dict:
+        """
+        :return: A response in the format of the realm index endpoint, containing every realm of the corpus
+        """
+        realms = {}
+        for responses in self.profiles.values():
+            realm = responses["equipment"]["character"]["realm"]
+            realms[realm["slug"]] = {"name": realm["name"], "id": realm["id"], "slug": realm["slug"]}
+        return {"realms": list(realms.values())}
+
+    def lookup(self, url: str):
+        """
+        Looks up the recorded response for an api-url
+        :param url: A url as constructed by blizzapi
+        :return: A copy of the recorded response, or 404 if there is none
+        """
+        parts = urlparse(url).path.strip("/").split("/")
+        if parts[:3] == ["profile", "wow", "character"] and len(parts) == 6:
+            realm, name, infotype = parts[3], parts[4], parts[5]
+            key = self.aliases.get((realm, name), (realm, name))
+            if key not in self.profiles and self.synthetic:
+                key = self.templates[zlib.crc32(f"{realm}/{name}".encode()) % len(self.templates)]
+            if key in self.profiles and infotype == "status":
+                return {"id": self.profiles[key]["equipment"]["character"]["id"], "is_valid": True}
+            if key in self.profiles and infotype in self.profiles[key]:
+                return copy.deepcopy(self.profiles[key][infotype])
+        elif parts == ["data", "wow", "realm", "index"]:
+            return self.realm_index()
+        elif parts[:4] == ["data", "wow", "media", "item"] and len(parts) == 5:
+            if parts[4] in self.item_media:
+                return copy.deepcopy(self.item_media[parts[4]])
+            if self.synthetic and parts[4].isdigit():
+                return synthetic_item_media(int(parts[4]))
+        return 404
+
+
+def synthetic_item_media(itemid: int) -> dict:
+    """
+    Makes up an item media response for an item that is not part of the corpus
+    :param itemid: ID of the Item
+    :return: A response in the format of the item media endpoint
+    """
+    return {
+        "assets": [{
+            "key": "icon",
+            "value": f"https://render.worldofwarcraft.com/eu/icons/56/inv_misc_questionmark_{itemid}.jpg",
+            "file_data_id": 5000000 + itemid % 313
+        }],
+        "id": itemid
+    }
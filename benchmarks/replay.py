@@ -0,0 +1,319 @@
+"""
+replay
+~~~~~~~~~~~~
+
+This module implements the replay of cassettes recorded by the bot (see cassette.py).
+The recorded messages, dropdown and button clicks are fed into the handlers of discordbot at their original pace, or N
+times faster, with fake channels in place of discord, and every request to the Blizzard-API is answered with the
+recorded response after the recorded delay. The latency of every command and the number of api requests are
+reported, so different versions of the bot can be compared on the same traffic.
+
+Usage: python benchmarks/replay.py cassette.jsonl.gz [--speed 1] [--no-cooldowns] [--output results.json]
+
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord  # noqa: E402
+
+import blizzapi  # noqa: E402
+import cassette  # noqa: E402
+import discordbot  # noqa: E402
+import guilds  # noqa: E402
+import raidcheckstore  # noqa: E402
+import realmindex  # noqa: E402
+import regions  # noqa: E402
+from run_benchmarks import FakeChannel, FakeMessage  # noqa: E402
+
+# The components of a raidcheck that can be clicked, and the command their latency is reported as
+component_commands = {
+    discordbot.CharSelect: "charselect",
+    discordbot.DetailButton: "raiddetail",
+    discordbot.DetailJump: "raiddetail"
+}
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+    def get_member(self, member_id: int):
+        return None
+
+    def get_role(self, role_id: int):
+        return None
+
+    async def query_members(self, **kwargs) -> list:
+        return []
+
+    async def fetch_roles(self) -> list:
+        return []
+
+
+class FakeResponse:
+    async def defer(self, **kwargs):
+        pass
+
+
+class FakeInteraction:
+    def __init__(self, user_id: int, channel: FakeChannel, guild_id: int = None):
+        self.user = FakeUser(user_id)
+        self.channel_id = channel.id
+        self.guild_id = guild_id
+        self.response = FakeResponse()
+        self.followup = channel
+
+    async def edit_original_response(self, **kwargs):
+        await self.followup.send(**kwargs)
+
+
+class Tape:
+    def __init__(self, events: list, speed: float):
+        """
+        :param events: The events of the cassette
+        :param speed: How many times faster than recorded the responses of the api are delivered
+        """
+        self.speed = speed
+        self.responses = {}
+        for event in events:
+            if event["type"] == "response":
+                self.responses.setdefault((event["url"], event["namespace"]), deque()).append(event)
+        self.requests = {}
+        self.unrecorded = 0
+
+    def request(self, url: str, namespace: str):
+        """
+        Stands in for blizzapi.request_blizz_api(), answering with the recorded responses in the order they were
+        recorded, the last one is repeated once they run out
+        :param url: The api-url of the request
+        :param namespace: The namespace of the request
+        :return: The recorded answer of the api
+        """
+        endpoint = blizzapi.endpoint_name(url)
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        recorded = self.responses.get((url, namespace))
+        if not recorded:
+            self.unrecorded += 1
+            return 404
+        response = recorded.popleft() if len(recorded) > 1 else recorded[0]
+        time.sleep(response["duration"] / self.speed)
+        return response["result"]
+
+
+class RunMap:
+    def __init__(self, events: list):
+        """
+        Maps the raidcheck runs of the recording to the runs made during the replay, the n-th run of a channel in the
+        recording is the n-th run of the same channel in the replay
+        :param events: The events of the cassette
+        """
+        self.recorded = {}
+        counts = {}
+        for event in events:
+            if event["type"] == "run":
+                self.recorded[event["run_id"]] = (event["channel"], counts.get(event["channel"], 0))
+                counts[event["channel"]] = counts.get(event["channel"], 0) + 1
+        self.replayed = {}
+        self.created = asyncio.Event()
+
+    def run_created(self, channel_id: int, run_id: str):
+        self.replayed.setdefault(channel_id, []).append(run_id)
+        self.created.set()
+        self.created = asyncio.Event()
+
+    async def resolve(self, run_id: str, timeout: float) -> str:
+        """
+        :param run_id: ID of a run in the recording
+        :param timeout: How long to wait for the run to be made in the replay
+        :return: The ID of the same run in the replay, or None if it was not made in time
+        """
+        if run_id not in self.recorded:
+            return None
+        channel_id, number = self.recorded[run_id]
+        deadline = time.monotonic() + timeout
+        while len(self.replayed.get(channel_id, [])) <= number:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(self.created.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+        return self.replayed[channel_id][number]
+
+
+def prepare_environment(header: dict, workdir: str, cooldowns: bool):
+    """
+    Writes the files discordbot expects into the working directory and restores the recorded state
+    :param header: The header of the cassette
+    :param workdir: A temporary directory that becomes the working directory of the replay
+    :param cooldowns: Whether the command cooldowns stay active
+    """
+    os.chdir(workdir)
+    for filename, content in [("raidplayerlist.json", header["raidlist"]), ("playermains.json", header["mains"]),
+                              ("itemiconid.json", header["itemiconids"])]:
+        file = open(filename, "w")
+        json.dump(content, file)
+        file.close()
+    discordbot.settings = dict(header["settings"])
+    guilds.configure(discordbot.settings.get("guilds", {}))
+    for guild_id, state in header.get("guilds", {}).items():
+        with guilds.use(int(guild_id)):
+            discordbot.save_raidlist(state["raidlist"])
+            discordbot.save_mains(state["mains"])
+    if not cooldowns:
+        discordbot.settings["cooldowns"] = {}
+    discordbot.item_icon_ids = None
+    realms = header["realms"]
+    if type(realms) is list:
+        # Cassettes of older versions only have the realms of the default region
+        realms = {regions.default_region: realms} if len(realms) != 0 else {}
+    for region, realmlist in realms.items():
+        realmindex.build_index(realmlist, region)
+        realmindex.get_index(region).fetched = time.time()
+
+
+async def replay(events: list, speed: float) -> dict:
+    """
+    Replays the events of a cassette
+    :param events: The events of the cassette
+    :param speed: How many times faster than recorded the cassette is replayed
+    :return: A dictionary with the latencies of every command and the requests made to the api
+    """
+    tape = Tape(events, speed)
+    runs = RunMap(events)
+    blizzapi.request_blizz_api = tape.request
+    create_run = raidcheckstore.create_run
+
+    def tracked_create_run(channel_id, playerlist, results, created=None):
+        run_id = create_run(channel_id, playerlist, results, created)
+        runs.run_created(channel_id, run_id)
+        return run_id
+
+    raidcheckstore.create_run = tracked_create_run
+    channels = {}
+    latencies = {}
+    errors = []
+    skipped = 0
+
+    async def handle(event: dict):
+        nonlocal skipped
+        channel = channels.setdefault(event["channel"], FakeChannel(event["channel"]))
+        start = time.perf_counter()
+        if event["type"] == "message":
+            message = FakeMessage(event["content"], channel)
+            message.author = FakeUser(event["author"])
+            message.guild = FakeGuild(event["guild"]) if event["guild"] is not None else None
+            handler = discordbot.get_command_handler(message)
+            command = handler.__name__.removesuffix("_cmd") if handler is not None else "none"
+            await discordbot.on_message(message)
+        else:
+            for item_class, command in component_commands.items():
+                match = item_class.__discord_ui_compiled_template__.fullmatch(event["custom_id"])
+                if match is not None:
+                    break
+            run_id = await runs.resolve(match["run_id"], 60 / speed) if match is not None else None
+            if run_id is None:
+                skipped += 1
+                return
+            start = time.perf_counter()
+            custom_id = event["custom_id"].replace(match["run_id"], run_id, 1)
+            interaction = FakeInteraction(event["user"], channel, event.get("guild"))
+            item = await item_class.from_custom_id(interaction, None,
+                                                   item_class.__discord_ui_compiled_template__.fullmatch(custom_id))
+            if isinstance(item.item, discord.ui.Select):
+                item.item._values = event["values"]
+            await item.callback(interaction)
+        latencies.setdefault(command, []).append(time.perf_counter() - start)
+
+    async def guarded(event: dict):
+        try:
+            await handle(event)
+        except Exception as exception:
+            errors.append(f"{event.get('content', event.get('custom_id'))}: {exception!r}")
+
+    tasks = []
+    started = time.monotonic()
+    for event in events:
+        if event["type"] not in ["message", "interaction"]:
+            continue
+        delay = event["t"] / speed - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(guarded(event)))
+    await asyncio.gather(*tasks)
+
+    return {
+        "speed": speed,
+        "duration": time.monotonic() - started,
+        "commands": {
+            command: {
+                "count": len(timings),
+                "median": statistics.median(timings),
+                "p95": sorted(timings)[math.ceil(0.95 * len(timings)) - 1],
+                "max": max(timings)
+            } for command, timings in sorted(latencies.items())
+        },
+        "requests": dict(sorted(tape.requests.items())),
+        "requests_total": sum(tape.requests.values()),
+        "recorded_requests_total": sum(1 for event in events if event["type"] == "response"),
+        "unrecorded_requests": tape.unrecorded,
+        "skipped_interactions": skipped,
+        "errors": errors
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a cassette recorded by gearbot")
+    parser.add_argument("cassette", help="the cassette to replay")
+    parser.add_argument("--speed", type=float, default=1.0, help="how many times faster than recorded to replay")
+    parser.add_argument("--no-cooldowns", action="store_true", help="disable the command cooldowns")
+    parser.add_argument("--output", help="file to write the JSON results to, stdout if not given")
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.cassette)
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        header, events = cassette.read_cassette(path)
+        prepare_environment(header, workdir, not args.no_cooldowns)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = asyncio.run(replay(events, args.speed))
+        finally:
+            os.chdir(cwd)
+
+    results["cassette"] = os.path.basename(path)
+    for command, result in results["commands"].items():
+        print(f"{command:<16}{result['count']:>6}  median {result['median'] * 1000:10.1f} ms  "
+              f"p95 {result['p95'] * 1000:10.1f} ms", file=sys.stderr)
+    print(f"api requests: {results['requests_total']} (recorded: {results['recorded_requests_total']})",
+          file=sys.stderr)
+
+    if args.output:
+        file = open(args.output, "w")
+        json.dump(results, file, indent=4)
+        file.close()
+    else:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
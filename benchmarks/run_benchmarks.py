@@ -0,0 +1,248 @@
+"""
+run_benchmarks
+~~~~~~~~~~~~
+
+This module implements an offline benchmark suite for data_processing and the rendering path of discordbot.
+Every request to the Blizzard-API is answered from the recorded responses in benchmarks/fixtures, and discord
+channels are replaced by a fake that only records what would have been sent.
+
+Usage: python benchmarks/run_benchmarks.py [--sizes 1 5 25 200] [--repeat 5] [--output results.json]
+                                           [--compare previous.json]
+
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import blizzapi  # noqa: E402
+import data_processing  # noqa: E402
+import discordbot  # noqa: E402
+from corpus import Corpus  # noqa: E402
+
+default_sizes = [1, 5, 10, 25, 50, 100, 200]
+emote_names = ["checkmark", "warning", "alert", "none", "cross", "discord", "embellishment", "t1", "t2", "t3"]
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int = 1):
+        self.id = channel_id
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append({"content": content, **kwargs})
+
+
+class FakeMessage:
+    def __init__(self, content: str, channel: FakeChannel):
+        self.content = content
+        self.channel = channel
+        self.author = None
+        self.guild = None
+
+
+def prepare_environment(corpus: Corpus, workdir: str):
+    """
+    Points blizzapi at the corpus and writes the files discordbot expects into the working directory
+    :param corpus: The corpus of recorded responses
+    :param workdir: A temporary directory that becomes the working directory of the benchmark
+    """
+    blizzapi.call_blizz_api = lambda url, namespace: corpus.lookup(url)
+    os.chdir(workdir)
+
+    icon_ids = corpus.icon_ids()
+    emotes = {name: f"<:{name}:1>" for name in emote_names}
+    for icon_id in set(icon_ids.values()):
+        emotes[str(icon_id)] = f"<:{icon_id}:{icon_id}>"
+    discordbot.settings = {"emotes": emotes, "branch": "benchmark", "raidcheckfreshness": 0}
+    discordbot.item_icon_ids = None
+
+    file = open("itemiconid.json", "w")
+    json.dump(icon_ids, file, indent=4)
+    file.close()
+
+
+def load_roster(corpus: Corpus, size: int) -> list:
+    """
+    Writes a raidlist of the given size and fetches the equipment for every character on it
+    :param corpus: The corpus of recorded responses
+    :param size: Number of characters in the raidlist
+    :return: A list of tuples of the raw equipment response and the processed character for every character
+    """
+    playerlist = corpus.roster(size)
+    discordbot.save_raidlist(playerlist)
+    roster = []
+    for character in playerlist:
+        clean_name = character["name"].lower()
+        clean_realm = "-".join(character["realm"].split(" ")).lower()
+        raw = blizzapi.get_character_info(clean_name, clean_realm, "equipment")
+        chardict = data_processing.get_char_equip(clean_name, clean_realm)
+        chardict["class"] = data_processing.get_char_class(clean_name, clean_realm)
+        chardict["thumbnail"] = data_processing.get_char_media(clean_name, clean_realm)["portrait"]
+        roster.append((character, raw, chardict))
+    return roster
+
+
+def bench_process_equipment(roster: list):
+    for character, raw, chardict in roster:
+        data_processing.process_equipment(raw["equipped_items"])
+
+
+def bench_get_upgrade_track(roster: list):
+    for character, raw, chardict in roster:
+        for item in raw["equipped_items"]:
+            data_processing.get_upgrade_track(item.get("bonus_list", []))
+
+
+def bench_get_enchantment(roster: list):
+    for character, raw, chardict in roster:
+        for item in raw["equipped_items"]:
+            data_processing.get_enchantment({"type": item["inventory_type"]["type"]}, item)
+
+
+async def bench_construct_gearembed(roster: list):
+    for character, raw, chardict in roster:
+        await discordbot.construct_gearembed(character["name"], character["realm"], chardict)
+
+
+async def bench_check_gear_stats(roster: list):
+    for character, raw, chardict in roster:
+        await discordbot.check_gear_stats(character["name"], character["realm"], chardict)
+
+
+async def bench_raidcheck_cmd(roster: list):
+    await discordbot.raidcheck_cmd(FakeMessage("!raidcheck", FakeChannel()))
+
+
+benchmarks = {
+    "process_equipment": bench_process_equipment,
+    "get_upgrade_track": bench_get_upgrade_track,
+    "get_enchantment": bench_get_enchantment,
+    "construct_gearembed": bench_construct_gearembed,
+    "check_gear_stats": bench_check_gear_stats,
+    "raidcheck_cmd": bench_raidcheck_cmd,
+}
+
+
+async def measure(function, roster: list, repeat: int) -> list:
+    """
+    Runs a benchmark once to warm up and then times it repeatedly
+    :param function: The benchmark function, either sync or async
+    :param roster: The roster to run the benchmark on
+    :param repeat: How many timed runs to make
+    :return: A list with the duration of every timed run in seconds
+    """
+    timings = []
+    for run in range(repeat + 1):
+        start = time.perf_counter()
+        if asyncio.iscoroutinefunction(function):
+            await function(roster)
+        else:
+            function(roster)
+        if run > 0:
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def run(sizes: list, repeat: int, selected: list) -> list:
+    """
+    Runs every selected benchmark for every roster size
+    :param sizes: The roster sizes to benchmark
+    :param repeat: How many timed runs to make per benchmark and size
+    :param selected: Names of the benchmarks to run
+    :return: A list with one result dictionary per benchmark and size
+    """
+    corpus = Corpus()
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        prepare_environment(corpus, workdir)
+        try:
+            for size in sizes:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    roster = load_roster(corpus, size)
+                for name in selected:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        timings = await measure(benchmarks[name], roster, repeat)
+                    median = statistics.median(timings)
+                    results.append({
+                        "name": name,
+                        "size": size,
+                        "repeat": repeat,
+                        "min": min(timings),
+                        "median": median,
+                        "mean": statistics.fmean(timings),
+                        "max": max(timings),
+                        "per_character": median / size
+                    })
+                    print(f"{name:<22}{size:>5}  {median * 1000:10.3f} ms  ({median / size * 1e6:9.1f} µs/char)",
+                          file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def compare(results: list, previous_file: str, threshold: float):
+    """
+    Prints the change of every median compared to a previous run
+    :param results: The results of this run
+    :param previous_file: Path of the JSON output of a previous run
+    :param threshold: Relative slowdown above which a result is marked as a regression
+    """
+    file = open(previous_file, "r")
+    previous = {(result["name"], result["size"]): result for result in json.load(file)["results"]}
+    file.close()
+    for result in results:
+        key = (result["name"], result["size"])
+        if key not in previous:
+            continue
+        ratio = result["median"] / previous[key]["median"]
+        marker = "  REGRESSION" if ratio > 1 + threshold else ""
+        print(f"{result['name']:<22}{result['size']:>5}  {ratio:6.2f}x{marker}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for gearbot")
+    parser.add_argument("--sizes", type=int, nargs="+", default=default_sizes, help="roster sizes to benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per benchmark and size")
+    parser.add_argument("--only", nargs="+", choices=list(benchmarks), default=list(benchmarks),
+                        help="benchmarks to run")
+    parser.add_argument("--output", help="file to write the JSON results to, stdout if not given")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.sizes, args.repeat, args.only))
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat
+        },
+        "results": results
+    }
+
+    if args.output:
+        file = open(args.output, "w")
+        json.dump(report, file, indent=4)
+        file.close()
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.compare:
+        compare(results, args.compare, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
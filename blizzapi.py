@@ -3,16 +3,190 @@ blizzapi
 ~~~~~~~~~~~~
 
 This module implements calls to the Blizzard-API.
+Requests go to the region of the current command (see regions). Every region has its own api host and namespaces,
+and its own connection pool, accesstoken, response cache and circuit breakers, so a slow or failing region does
+not affect the others. Cached responses keep the ETag and Last-Modified the api sent with them, so refetching
+them is a conditional request that is answered with 304 Not Modified and no body if nothing changed.
 
 """
 
 from json import JSONDecodeError
 
 import requests
+import contextvars
 import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from requests.adapters import HTTPAdapter
+
+import cassette
+import characterindex
+import eventlog
+import localization
+import metrics
+import regions
+import sharedcache
+import tracing
 
 credentials_file = "blizzardapi.txt"
-locale = "de_DE"
+
+# Base urls of the authentification servers and the api, can be pointed at a local stand-in server. Without
+# BLIZZAPI_API_URL every region uses its own api host
+oauth_url = os.environ.get("BLIZZAPI_OAUTH_URL", "https://oauth.battle.net").rstrip("/")
+api_url = os.environ.get("BLIZZAPI_API_URL", "").rstrip("/") or None
+
+# The number of connections kept open to the api host of every region
+pool_size = 10
+
+# Requests that time out or fail with 429/5xx are retried with jittered exponential backoff
+request_timeout = 10
+max_retries = 3
+backoff_base = 0.5
+backoff_cap = 8.0
+
+# After failure_threshold consecutive failures of an endpoint its circuit opens, and requests to it fail
+# immediately until reset_timeout seconds have passed and a single probe request succeeds
+failure_threshold = 5
+reset_timeout = 30
+
+# Successful responses are reused for fresh_ttl seconds. When a request fails, a response up to stale_ttl seconds
+# old is returned instead (marked with "_stale") while a refresh runs in the background
+fresh_ttl = 30
+stale_ttl = 86400
+# The maximum number of cached responses per region
+response_cache_size = 5000
+
+# Status codes returned when no request could be made at all
+STATUS_TIMEOUT = 504
+STATUS_CIRCUIT_OPEN = 503
+# Status code of a conditional request whose cached response is still current
+STATUS_NOT_MODIFIED = 304
+
+token_caches = {}
+response_caches = {}
+cache_lock = threading.Lock()
+refreshing = set()
+breakers = {}
+sessions = {}
+
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        :return: Whether a request may be made right now
+        """
+        with self.lock:
+            if self.opened is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened >= reset_timeout:
+                self.probing = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+        metrics.circuit_open.set(0, endpoint=self.name)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= failure_threshold:
+                self.opened = time.monotonic()
+                self.probing = False
+        if self.opened is not None:
+            metrics.circuit_open.set(1, endpoint=self.name)
+
+
+def get_breaker(endpoint: str, region: str) -> CircuitBreaker:
+    """
+    :param endpoint: Name of the endpoint as returned by endpoint_name()
+    :param region: The region the endpoint is called in
+    :return: The circuit breaker of the endpoint in the region
+    """
+    key = (region, endpoint)
+    if key not in breakers:
+        breakers.setdefault(key, CircuitBreaker(f"{region}:{endpoint}"))
+    return breakers[key]
+
+
+def get_api_url(region: str = None) -> str:
+    """
+    :param region: The region, the region of the current command if None
+    :return: The base url of the api of the region
+    """
+    if api_url is not None:
+        return api_url
+    return f"https://{region or regions.get_region()}.api.blizzard.com"
+
+
+def get_request_locale() -> str:
+    """
+    :return: The locale to request data for the current command in, see localization.request_locale()
+    """
+    return localization.request_locale(regions.get_locale())
+
+
+def get_session(region: str) -> requests.Session:
+    """
+    :param region: The region
+    :return: The session whose connection pool is used for requests to the region
+    """
+    if region not in sessions:
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        sessions.setdefault(region, session)
+    return sessions[region]
+
+
+def get_token_cache(region: str) -> dict:
+    """
+    :param region: The region
+    :return: The cached accesstoken of the region
+    """
+    if region not in token_caches:
+        token_caches.setdefault(region, {"token": None, "expires": 0.0})
+    return token_caches[region]
+
+
+def get_response_cache(region: str) -> OrderedDict:
+    """
+    :param region: The region
+    :return: The response cache of the region, must be called while holding the cache_lock
+    """
+    if region not in response_caches:
+        response_caches[region] = OrderedDict()
+    return response_caches[region]
+
+
+def is_retryable(status: int) -> bool:
+    """
+    :param status: The status code of a failed request
+    :return: Whether the request could succeed if it is made again
+    """
+    return status == 429 or status >= 500
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    :param attempt: Number of the attempt that just failed, starting at 0
+    :return: How long to wait before the next attempt, with full jitter
+    """
+    return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
 
 
 def get_credentials() -> list:
@@ -27,65 +201,295 @@ def get_credentials() -> list:
     return credentials
 
 
-def get_access_token():
+@tracing.traced()
+def get_access_token(region: str):
     """
     Uses the client_id and the secret to make a request to the blizzard authentification servers to retrieve
-    an accesstoken to make a request to their api
+    an accesstoken to make a request to their api. The accesstoken is reused until shortly before it expires
 
+    :param region: The region the accesstoken is used for
     :return: Either the accesstoken for the api, or the status code of the request if it was not ok
     """
+    token_cache = get_token_cache(region)
+    if token_cache["token"] is not None and time.time() < token_cache["expires"]:
+        metrics.cache_requests.inc(cache="token", outcome="hit")
+        return token_cache["token"]
+    metrics.cache_requests.inc(cache="token", outcome="miss")
+    # Another process may have fetched a token already
+    shared = sharedcache.get("token", f"{oauth_url}|{region}", 86400)
+    if shared is not None and time.time() < shared[0]["expires"]:
+        token_cache.update(shared[0])
+        return token_cache["token"]
+
+    breaker = get_breaker("oauth", region)
+    if not breaker.allow():
+        return STATUS_CIRCUIT_OPEN
+
     credentials = get_credentials()
     client_id = credentials[0]
     secret = credentials[1]
     auth_request_data = {"grant_type": "client_credentials"}
-    auth_response = requests.post("https://oauth.battle.net/token", data=auth_request_data, auth=(client_id, secret))
+    try:
+        auth_response = requests.post(f"{oauth_url}/token", data=auth_request_data, auth=(client_id, secret),
+                                      timeout=request_timeout)
+    except requests.RequestException:
+        metrics.token_fetches.inc(status="error")
+        breaker.failure()
+        return STATUS_TIMEOUT
+    metrics.token_fetches.inc(status=auth_response.status_code)
 
     if not auth_response.ok:
+        if is_retryable(auth_response.status_code):
+            breaker.failure()
         return auth_response.status_code
+    breaker.success()
 
     try:
         auth_response_content = json.loads(auth_response.text)
         accesstoken = auth_response_content["access_token"]
-    except TypeError or JSONDecodeError or KeyError:
+    except (TypeError, JSONDecodeError, KeyError):
         return auth_response.status_code
+    token_cache["token"] = accesstoken
+    token_cache["expires"] = time.time() + auth_response_content.get("expires_in", 0) - 60
+    sharedcache.put("token", f"{oauth_url}|{region}", token_cache)
     return accesstoken
 
 
-def call_blizz_api(url: str, namespace: str):
+def endpoint_name(url: str) -> str:
+    """
+    Reduces an api-url to the endpoint it belongs to, without names or IDs, so it can be used as a metric label
+    :param url: The api-url
+    :return: The name of the endpoint, e.g. "character/equipment" or "media/item"
     """
-    Makes a request to the blizzard api to retrieve information
+    parts = urlparse(url).path.strip("/").split("/")
+    if parts[:3] == ["profile", "wow", "character"]:
+        if len(parts) > 5:
+            return "character/" + parts[5]
+        return "character"
+    return "/".join(part for part in parts[2:] if not part.isdigit())
+
+
+def request_blizz_api(url: str, namespace: str):
+    """
+    Makes a single request to the blizzard api, if the accesstoken was rejected it is renewed once
 
     :param url: The api-url to make a request to
-    :param namespace: The namespace to use for this request
+    :param namespace: The namespace to use for this request, it determines the region
     :return: Either the answer of the api, or the status code of the request if it was not ok
     """
-    accesstoken = get_access_token()
-    try:
-        int(accesstoken)
-        return accesstoken
-    except ValueError:
-        pass
+    endpoint = endpoint_name(url)
+    region = regions.region_of(namespace)
+    for renewed in [False, True]:
+        accesstoken = get_access_token(region)
+        if type(accesstoken) is int:
+            return accesstoken
 
-    api_call_header = {
-        'Authorization': f'Bearer {accesstoken}',
-    }
+        api_call_header = {
+            'Authorization': f'Bearer {accesstoken}',
+        }
 
-    api_call_parameters = {
-        'namespace': namespace,
-        'locale': locale,
-    }
+        api_call_parameters = {
+            'namespace': namespace,
+            'locale': get_request_locale(),
+        }
 
-    api_response = requests.get(url, params=api_call_parameters, headers=api_call_header)
+        cached = get_cached_data((url, namespace, get_request_locale()))
+        if cached is not None and "_etag" in cached:
+            api_call_header['If-None-Match'] = cached["_etag"]
+        if cached is not None and "_last_modified" in cached:
+            api_call_header['If-Modified-Since'] = cached["_last_modified"]
 
-    if not api_response.ok:
-        return api_response.status_code
+        start = time.perf_counter()
+        try:
+            api_response = get_session(region).get(url, params=api_call_parameters, headers=api_call_header,
+                                                   timeout=request_timeout)
+        except requests.RequestException:
+            metrics.blizzard_requests.inc(endpoint=endpoint, status="error")
+            return STATUS_TIMEOUT
+        finally:
+            metrics.blizzard_latency.observe(time.perf_counter() - start, endpoint=endpoint)
+        metrics.blizzard_requests.inc(endpoint=endpoint, status=api_response.status_code)
 
-    try:
-        api_response_json = json.loads(api_response.text)
-    except TypeError or JSONDecodeError:
-        return api_response.status_code
+        if api_response.status_code == 401 and not renewed:
+            get_token_cache(region)["token"] = None
+            continue
+        if api_response.status_code == STATUS_NOT_MODIFIED or not api_response.ok:
+            return api_response.status_code
+
+        try:
+            api_response_json = json.loads(api_response.text)
+        except (TypeError, JSONDecodeError):
+            return api_response.status_code
+
+        # The validators are kept with the answer, so it can be revalidated with a conditional request later
+        if type(api_response_json) is dict:
+            if api_response.headers.get("ETag"):
+                api_response_json["_etag"] = api_response.headers["ETag"]
+            if api_response.headers.get("Last-Modified"):
+                api_response_json["_last_modified"] = api_response.headers["Last-Modified"]
+        return api_response_json
+
+
+def request_with_retries(url: str, namespace: str, retries: int):
+    """
+    Makes a request to the blizzard api, retrying it with backoff if it failed in a way that could be temporary
+
+    :param url: The api-url to make a request to
+    :param namespace: The namespace to use for this request
+    :param retries: How often a failed request may be repeated
+    :return: Either the answer of the api, or the status code of the last request
+    """
+    breaker = get_breaker(endpoint_name(url), regions.region_of(namespace))
+    result = STATUS_CIRCUIT_OPEN
+    for attempt in range(retries + 1):
+        if not breaker.allow():
+            return STATUS_CIRCUIT_OPEN
+        start = time.perf_counter()
+        result = request_blizz_api(url, namespace)
+        cassette.record_response(url, namespace, result, time.perf_counter() - start)
+        if type(result) is not int or not is_retryable(result):
+            breaker.success()
+            return result
+        breaker.failure()
+        if attempt < retries:
+            metrics.blizzard_retries.inc(endpoint=endpoint_name(url))
+            time.sleep(backoff_delay(attempt))
+    return result
+
+
+def store_response(key: tuple, data, fetched: float = None):
+    """
+    Puts a response into the response cache of its region
+    :param key: The url, namespace and locale of the request
+    :param data: The answer of the api
+    :param fetched: Time the answer was retrieved, now if not given
+    """
+    with cache_lock:
+        response_cache = get_response_cache(regions.region_of(key[1]))
+        response_cache[key] = {"data": data, "fetched": fetched if fetched is not None else time.time()}
+        response_cache.move_to_end(key)
+        while len(response_cache) > response_cache_size:
+            response_cache.popitem(last=False)
+
+
+def get_cached_data(key: tuple):
+    """
+    :param key: The url, namespace and locale of a request
+    :return: The cached answer of the request, no matter how old, or None if there is none
+    """
+    with cache_lock:
+        entry = get_response_cache(regions.region_of(key[1])).get(key)
+    return entry["data"] if entry is not None else None
+
+
+def revalidate(key: tuple):
+    """
+    Marks a cached response as current again, after the api answered a conditional request for it with 304
+    :param key: The url, namespace and locale of the request
+    :return: The cached answer, or None if it was dropped from the cache in the meantime
+    """
+    data = get_cached_data(key)
+    if data is not None:
+        store_response(key, data)
+        sharedcache.put("response", "|".join(key), data)
+    return data
+
+
+def refresh_in_background(url: str, namespace: str):
+    """
+    Starts a thread that refetches a cached response, unless one is already running for it
+
+    :param url: The api-url to refetch
+    :param namespace: The namespace to use for this request
+    """
+    key = (url, namespace, get_request_locale())
+    with cache_lock:
+        if key in refreshing:
+            return
+        refreshing.add(key)
 
-    return api_response_json
+    def refresh():
+        try:
+            result = request_with_retries(url, namespace, max_retries)
+            if result == STATUS_NOT_MODIFIED:
+                revalidate(key)
+            elif type(result) is not int:
+                store_response(key, result)
+                sharedcache.put("response", "|".join(key), result)
+        finally:
+            with cache_lock:
+                refreshing.discard(key)
+
+    # The thread keeps the region and locale of the caller
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(refresh,), name=f"refresh {endpoint_name(url)}", daemon=True).start()
+
+
+@tracing.traced()
+def call_blizz_api(url: str, namespace: str):
+    """
+    Makes a request to the blizzard api to retrieve information.
+    If the api can not be reached but the same request succeeded before, the last good answer is returned with
+    "_stale" set to True and "_fetched" set to the time it was retrieved
+
+    :param url: The api-url to make a request to
+    :param namespace: The namespace to use for this request
+    :return: Either the answer of the api, or the status code of the request if it was not ok
+    """
+    start = time.perf_counter()
+    endpoint = endpoint_name(url)
+    tracing.annotate(endpoint=endpoint)
+    key = (url, namespace, get_request_locale())
+    with cache_lock:
+        entry = get_response_cache(regions.region_of(namespace)).get(key)
+    age = time.time() - entry["fetched"] if entry is not None else None
+    if entry is None or age >= fresh_ttl:
+        # Another process may have fetched the same response more recently
+        shared = sharedcache.get("response", "|".join(key), stale_ttl)
+        if shared is not None and (entry is None or shared[1] > entry["fetched"]):
+            store_response(key, shared[0], shared[1])
+            entry = {"data": shared[0], "fetched": shared[1]}
+            age = time.time() - entry["fetched"]
+
+    if entry is not None and age < fresh_ttl:
+        metrics.cache_requests.inc(cache="response", outcome="hit")
+        tracing.annotate(cache="hit")
+        eventlog.log("cache", endpoint=endpoint, status=200, cache="hit",
+                     duration=round(time.perf_counter() - start, 4))
+        return entry["data"]
+    metrics.cache_requests.inc(cache="response", outcome="miss")
+
+    has_stale = entry is not None and age < stale_ttl
+    # With an old answer to fall back on, the caller gets it right away instead of waiting for retries
+    result = request_with_retries(url, namespace, 0 if has_stale else max_retries)
+    if result == STATUS_NOT_MODIFIED:
+        data = revalidate(key)
+        if data is not None:
+            metrics.cache_requests.inc(cache="response", outcome="revalidated")
+            tracing.annotate(cache="revalidated")
+            eventlog.log("api", endpoint=endpoint, status=result, cache="revalidated",
+                         duration=round(time.perf_counter() - start, 4))
+            return data
+        # The cached answer was dropped since the request was made, so it is fetched without condition
+        result = request_with_retries(url, namespace, max_retries)
+    if type(result) is not int:
+        store_response(key, result)
+        sharedcache.put("response", "|".join(key), result)
+        eventlog.log("api", endpoint=endpoint, status=200, cache="miss",
+                     duration=round(time.perf_counter() - start, 4))
+        return result
+
+    if has_stale and is_retryable(result):
+        metrics.cache_requests.inc(cache="response", outcome="stale")
+        tracing.annotate(cache="stale", status=result)
+        eventlog.log("api", endpoint=endpoint, status=result, cache="stale",
+                     duration=round(time.perf_counter() - start, 4))
+        refresh_in_background(url, namespace)
+        return dict(entry["data"], _stale=True, _fetched=entry["fetched"])
+
+    tracing.annotate(status=result)
+    eventlog.log("api", endpoint=endpoint, status=result, cache="miss", duration=round(time.perf_counter() - start, 4))
+    return result
 
 
 def get_character_info(name: str, realm: str, infotype: str):
@@ -98,9 +502,11 @@ def get_character_info(name: str, realm: str, infotype: str):
     :param infotype: The type of information you would like to retrieve
     :return: The answer of the api
     """
-    print(f"Making Characterinfo request of type: \"{infotype}\" for \"{name}-{realm}\"")
-    url = f"https://eu.api.blizzard.com/profile/wow/character/{realm}/{name}/{infotype}"
-    return call_blizz_api(url, "profile-eu")
+    url = f"{get_api_url()}/profile/wow/character/{realm}/{name}/{infotype}"
+    with eventlog.bind(character=f"{name}-{realm}"):
+        response = call_blizz_api(url, f"profile-{regions.get_region()}")
+    characterindex.record_response(name, realm, response)
+    return response
 
 
 def getitemmedia(itemid: int):
@@ -111,6 +517,31 @@ def getitemmedia(itemid: int):
     :param itemid: The ID of the Item for which to make a request
     :return: The answer of the api
     """
-    print(f"Making Item-media request for ID: {itemid}")
-    url = f"https://eu.api.blizzard.com/data/wow/media/item/{itemid}"
-    return call_blizz_api(url, "static-eu")
+    url = f"{get_api_url()}/data/wow/media/item/{itemid}"
+    with eventlog.bind(item=itemid):
+        return call_blizz_api(url, f"static-{regions.get_region()}")
+
+
+def getrealmindex():
+    """
+    Constructs a url for the index of all realms and then forwards it to
+    call_blizz_api()
+
+    :return: The answer of the api
+    """
+    url = f"{get_api_url()}/data/wow/realm/index"
+    return call_blizz_api(url, f"dynamic-{regions.get_region()}")
+
+
+def get_guild_roster(guild: str, realm: str):
+    """
+    Constructs a url for the roster of a guild and then forwards it to
+    call_blizz_api()
+
+    :param guild: Name of the guild, as slug
+    :param realm: Name of the Realm of the guild
+    :return: The answer of the api
+    """
+    url = f"{get_api_url()}/data/wow/guild/{realm}/{guild}/roster"
+    with eventlog.bind(guild=f"{guild}-{realm}"):
+        return call_blizz_api(url, f"profile-{regions.get_region()}")
@@ -0,0 +1,117 @@
+"""
+cassette
+~~~~~~~~~~~~
+
+This module implements the recording of cassettes, compressed files with the traffic of the bot.
+While recording, every command message, every click on a dropdown, every raidcheck run and every response of the
+Blizzard-API is appended to the cassette together with the time it happened, so the traffic can be replayed
+later with benchmarks/replay.py. Nothing is recorded while no cassette is open.
+
+"""
+
+import gzip
+import json
+import threading
+import time
+
+writer = None
+started = None
+lock = threading.Lock()
+
+
+def start_recording(path: str, header: dict):
+    """
+    Opens a cassette and starts recording into it
+    :param path: Path of the cassette
+    :param header: The state the replay has to start from, e.g. the raidlist and the settings
+    """
+    global writer, started
+    with lock:
+        writer = gzip.open(path, "wt", encoding="utf-8")
+        started = time.monotonic()
+        writer.write(json.dumps(dict(header, type="header", recorded=time.time())) + "\n")
+
+
+def stop_recording():
+    """
+    Closes the cassette, if one is open
+    """
+    global writer
+    with lock:
+        if writer is not None:
+            writer.close()
+            writer = None
+
+
+def record(event: dict):
+    """
+    Appends an event to the cassette, does nothing if no cassette is open
+    :param event: The event, a dictionary with at least a "type"
+    """
+    if writer is None:
+        return
+    line = json.dumps(dict(event, t=round(time.monotonic() - started, 4)))
+    with lock:
+        if writer is not None:
+            writer.write(line + "\n")
+
+
+def record_message(message):
+    """
+    Records a message that contains a command
+    :param message: The message that was sent
+    """
+    if writer is None:
+        return
+    record({"type": "message", "channel": message.channel.id, "author": message.author.id,
+            "guild": message.guild.id if message.guild is not None else None, "content": message.content})
+
+
+def record_interaction(interaction, custom_id: str, values: list):
+    """
+    Records a click on a component
+    :param interaction: The interaction of the click
+    :param custom_id: The custom_id of the component
+    :param values: The values that were selected
+    """
+    if writer is None:
+        return
+    record({"type": "interaction", "channel": interaction.channel_id, "guild": interaction.guild_id,
+            "user": interaction.user.id, "custom_id": custom_id, "values": list(values)})
+
+
+def record_response(url: str, namespace: str, result, duration: float):
+    """
+    Records a response of the Blizzard-API
+    :param url: The api-url of the request
+    :param namespace: The namespace of the request
+    :param result: The answer of the api, or the status code of the request
+    :param duration: How long the request took in seconds
+    """
+    if writer is None:
+        return
+    record({"type": "response", "url": url, "namespace": namespace, "result": result,
+            "duration": round(duration, 4)})
+
+
+def read_cassette(path: str) -> tuple:
+    """
+    Reads a cassette
+    :param path: Path of the cassette
+    :return: A tuple of the header and the list of events, in the order they were recorded
+    """
+    file = gzip.open(path, "rt", encoding="utf-8")
+    header = None
+    events = []
+    for line in file:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            # The last line of a cassette that was not closed properly may be cut off
+            break
+        if event["type"] == "header":
+            header = event
+        else:
+            events.append(event)
+    file.close()
+    return header, events
@@ -0,0 +1,109 @@
+"""
+characterindex
+~~~~~~~~~~~~
+
+This module implements a cache of which characters exist and what their Blizzard character ID is.
+It is filled as a side effect of every profile request, so checking whether a character exists rarely needs
+a request of its own. Characters that were not found are only remembered for a short time. Characters are stored
+per region, as the same name and realm slug can exist in several regions.
+
+"""
+
+import threading
+import time
+
+import metrics
+import regions
+
+positive_ttl = 86400
+negative_ttl = 300
+
+entries = {}
+lock = threading.Lock()
+
+
+def make_key(name: str, realm: str) -> tuple:
+    """
+    :param name: Name of the Character
+    :param realm: Slug of the Realm of the Character
+    :return: The key under which the character is stored, in the region of the current command
+    """
+    return regions.get_region(), name.lower(), realm.lower()
+
+
+def record(name: str, realm: str, character_id: int):
+    """
+    Remembers that a character exists
+    :param name: Name of the Character
+    :param realm: Slug of the Realm of the Character
+    :param character_id: The Blizzard ID of the Character
+    """
+    with lock:
+        entries[make_key(name, realm)] = {"id": character_id, "exists": True, "checked": time.time()}
+
+
+def record_missing(name: str, realm: str):
+    """
+    Remembers that a character does not exist
+    :param name: Name of the Character
+    :param realm: Slug of the Realm of the Character
+    """
+    with lock:
+        entries[make_key(name, realm)] = {"id": None, "exists": False, "checked": time.time()}
+
+
+def record_response(name: str, realm: str, response):
+    """
+    Remembers what a profile request revealed about a character
+    :param name: Name of the Character
+    :param realm: Slug of the Realm of the Character
+    :param response: The answer of the api, or the status code of the request
+    """
+    if response == 404 or (type(response) is dict and response.get("is_valid") is False):
+        record_missing(name, realm)
+    elif type(response) is dict and not response.get("_stale"):
+        if "character" in response:
+            record(name, realm, response["character"].get("id"))
+        elif "id" in response:
+            record(name, realm, response["id"])
+
+
+def get_entry(name: str, realm: str):
+    """
+    :param name: Name of the Character
+    :param realm: Slug of the Realm of the Character
+    :return: The cached entry of the character, or None if nothing (still valid) is known about it
+    """
+    with lock:
+        entry = entries.get(make_key(name, realm))
+    if entry is not None:
+        ttl = positive_ttl if entry["exists"] else negative_ttl
+        if time.time() - entry["checked"] < ttl:
+            metrics.cache_requests.inc(cache="character", outcome="hit")
+            return entry
+    metrics.cache_requests.inc(cache="character", outcome="miss")
+    return None
+
+
+def exists(name: str, realm: str):
+    """
+    :param name: Name of the Character
+    :param realm: Slug of the Realm of the Character
+    :return: True or False if it is known whether the character exists, None if it is not known
+    """
+    entry = get_entry(name, realm)
+    if entry is None:
+        return None
+    return entry["exists"]
+
+
+def get_character_id(name: str, realm: str):
+    """
+    :param name: Name of the Character
+    :param realm: Slug of the Realm of the Character
+    :return: The Blizzard ID of the Character, or None if it is not known
+    """
+    entry = get_entry(name, realm)
+    if entry is None:
+        return None
+    return entry["id"]
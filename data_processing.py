@@ -3,86 +3,71 @@ dataprocessing
 ~~~~~~~~~~~~
 
 This module implements the processing of data gotten from the Blizzard-Api.
+Run as a script it processes saved responses instead, without making requests:
 
-"""
+    python data_processing.py INPUT [--format jsonl|csv] [--output FILE] [--workers N] [--chunk-size N]
 
-import blizzapi
+INPUT is either a directory with the responses of every character in REALM/NAME/equipment.json,
+REALM/NAME/specializations.json and REALM/NAME/character-media.json (the layout of the api urls), or a JSONL
+file ("-" for stdin) with one character per line, {"name": ..., "realm": ..., "equipment": ...,
+"specializations": ..., "character-media": ...}. Only the equipment is required. The characters are processed in
+chunks by a pool of processes, and the results are written in the order of the input as soon as they are ready.
+
+"""
 
+import argparse
+import csv
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
-def get_bonus_string(bonus_id_list: list) -> str:
+import blizzapi
+import eventlog
+import localization
+import tracing
+
+# Order of the columns in the raidcheck overview, the embellishment column follows after the last slot
+gear_slot_order = ["HEAD", "NECK", "SHOULDER", "CHEST", "WAIST", "LEGS", "FEET", "WRIST", "HANDS", "FINGER_1",
+                   "FINGER_2", "TRINKET_1", "TRINKET_2", "BACK", "MAIN_HAND", "OFF_HAND"]
+
+
+# The bonus IDs of the ranks of every upgrade track, lowest rank first
+upgrade_tracks = {
+    "explorer": [10289, 10288, 10287, 10286, 10285, 10284, 10283, 10282],
+    "adventurer": [10297, 10296, 10295, 10294, 10293, 10292, 10291, 10290],
+    "veteran": [10281, 10280, 10279, 10278, 10277, 10276, 10275, 10274],
+    "champion": [10273, 10272, 10271, 10270, 10269, 10268, 10267, 10266],
+    "hero": [10265, 10264, 10263, 10262, 10261, 10256],
+    "myth": [10260, 10259, 10258, 10257, 10298, 10299]
+}
+crafted_bonus_id = 10222
+
+bonus_id_tracks = {crafted_bonus_id: {"track": "crafted"}}
+for trackname, bonus_ids in upgrade_tracks.items():
+    for rank, bonus_id in enumerate(bonus_ids, 1):
+        bonus_id_tracks[bonus_id] = {"track": trackname, "rank": rank, "ranks": len(bonus_ids)}
+
+# Slots whose items can be enchanted, and slots that should have two sockets
+enchantable_slots = ["MAIN_HAND", "OFF_HAND", "BACK", "WRIST", "FEET", "FINGER_1", "FINGER_2", "CHEST", "LEGS"]
+socket_slots = ["NECK", "FINGER_1", "FINGER_2"]
+ignored_slots = ["SHIRT", "TABARD"]
+
+
+def get_upgrade_track(bonus_id_list: list) -> dict:
     """
-    Checks every bonus-ID of an Item and stores Information about the Upgrade-track inside a string
+    Checks every bonus-ID of an Item for the Upgrade-track, localization.track_label() turns it into text
     :param bonus_id_list: A list of the bonus-ID's an item has
-    :return: A string containing Information about the Upgrade-track of an item
-    """
-    bonus_string = ""
-    tracknames = ["Forscher", "Abenteurer", "Veteran", "Champion", "Held", "Mythos"]
-    bonus_id_dict = {
-        # Forscher
-        "10289": f"({tracknames[0]} 1/8)",
-        "10288": f"({tracknames[0]} 2/8)",
-        "10287": f"({tracknames[0]} 3/8)",
-        "10286": f"({tracknames[0]} 4/8)",
-        "10285": f"({tracknames[0]} 5/8)",
-        "10284": f"({tracknames[0]} 6/8)",
-        "10283": f"({tracknames[0]} 7/8)",
-        "10282": f"({tracknames[0]} 9/8)",
-
-        # Abenteuerer
-        "10297": f"({tracknames[1]} 1/8)",
-        "10296": f"({tracknames[1]} 2/8)",
-        "10295": f"({tracknames[1]} 3/8)",
-        "10294": f"({tracknames[1]} 4/8)",
-        "10293": f"({tracknames[1]} 5/8)",
-        "10292": f"({tracknames[1]} 6/8)",
-        "10291": f"({tracknames[1]} 7/8)",
-        "10290": f"({tracknames[1]} 9/8)",
-
-        # Veteran
-        "10281": f"({tracknames[2]} 1/8)",
-        "10280": f"({tracknames[2]} 2/8)",
-        "10279": f"({tracknames[2]} 3/8)",
-        "10278": f"({tracknames[2]} 4/8)",
-        "10277": f"({tracknames[2]} 5/8)",
-        "10276": f"({tracknames[2]} 6/8)",
-        "10275": f"({tracknames[2]} 7/8)",
-        "10274": f"({tracknames[2]} 9/8)",
-
-        # Champion
-        "10273": f"({tracknames[3]} 1/8)",
-        "10272": f"({tracknames[3]} 2/8)",
-        "10271": f"({tracknames[3]} 3/8)",
-        "10270": f"({tracknames[3]} 4/8)",
-        "10269": f"({tracknames[3]} 5/8)",
-        "10268": f"({tracknames[3]} 6/8)",
-        "10267": f"({tracknames[3]} 7/8)",
-        "10266": f"({tracknames[3]} 9/8)",
-
-        # Held
-        "10265": f"({tracknames[4]} 1/6)",
-        "10264": f"({tracknames[4]} 2/6)",
-        "10263": f"({tracknames[4]} 3/6)",
-        "10262": f"({tracknames[4]} 4/6)",
-        "10261": f"({tracknames[4]} 5/6)",
-        "10256": f"({tracknames[4]} 6/6)",
-
-        # Mythos
-        "10260": f"({tracknames[5]} 1/6)",
-        "10259": f"({tracknames[5]} 2/6)",
-        "10258": f"({tracknames[5]} 3/6)",
-        "10257": f"({tracknames[5]} 4/6)",
-        "10298": f"({tracknames[5]} 5/6)",
-        "10299": f"({tracknames[5]} 6/6)",
-
-        # Crafted
-        "10222": "(Crafted)"
-    }
-
+    :return: A dictionary with the "track" and, unless the item is crafted, its "rank" and the number of "ranks",
+    or an empty dictionary if the item has no upgrade track
+    """
+    track = {}
     for bonus_id in bonus_id_list:
-        if str(bonus_id) in bonus_id_dict:
-            bonus_string = bonus_id_dict[str(bonus_id)]
-
-    return bonus_string
+        if bonus_id in bonus_id_tracks:
+            track = bonus_id_tracks[bonus_id]
+    return track
 
 
 def get_char_equip(name: str, realm: str):
@@ -90,7 +75,8 @@ def get_char_equip(name: str, realm: str):
     Gets the equipment of the given Character form the blizzard-api and converts it into a much more usable format
     :param name: Name of the Character
     :param realm: Name of the Realm of the Character
-    :return: Either a dictionary of the Character Equipment, or the status code of the response
+    :return: Either a dictionary of the Character Equipment, or the status code of the response.
+    If the Blizzard-API could not be reached and older data was used, "stale" contains the time it was retrieved
     """
     character_equip_response = blizzapi.get_character_info(name, realm, "equipment")
     try:
@@ -100,9 +86,12 @@ def get_char_equip(name: str, realm: str):
         pass
     character_equip_raw = character_equip_response["equipped_items"]
     character = {"name": name, "realm": realm, "equip": process_equipment(character_equip_raw)}
+    if character_equip_response.get("_stale"):
+        character["stale"] = character_equip_response["_fetched"]
     return character
 
 
+@tracing.traced()
 def process_equipment(character_equip_raw: list) -> dict:
     """
     Goes through each item in the unprocessed list and makes a new, cleaner list with only the important information
@@ -112,11 +101,11 @@ def process_equipment(character_equip_raw: list) -> dict:
     ilvl = 0
     equip = {"gear": [], "embellishments": 0}
     for item in character_equip_raw:
-        if item["slot"]["name"] in ["Hemd", "Wappenrock"]:
+        if item["slot"]["type"] in ignored_slots:
             continue
 
         equip["gear"].append({
-            "slot": item["slot"]["name"],
+            "slottype": item["slot"]["type"],
             "name": item["name"],
             "id": item["item"]["id"],
             "ilvl": item["level"]["value"],
@@ -130,10 +119,7 @@ def process_equipment(character_equip_raw: list) -> dict:
 
         ilvl += item["level"]["value"]
 
-        if "bonus_list" in item:
-            current_item["itemtrack"] = get_bonus_string(item["bonus_list"])
-        else:
-            current_item["itemtrack"] = ""
+        current_item["itemtrack"] = get_upgrade_track(item.get("bonus_list", []))
 
         get_sockets(current_item, item)
 
@@ -146,8 +132,9 @@ def process_equipment(character_equip_raw: list) -> dict:
 
         equip["gear"][-1] = current_item
 
-    equip["hasshield"] = any(item.get("slot") == "Schildhand" for item in equip["gear"])
-    if not equip["hasshield"]:
+    equip["hasshield"] = any(item["slottype"] == "OFF_HAND" for item in equip["gear"])
+    # Without an off hand the weapon in the main hand is counted twice, a character without gear has no item level
+    if not equip["hasshield"] and len(equip["gear"]) != 0:
         ilvl += current_item["ilvl"]
     number_of_slots = 16
     ilvl = round(ilvl / number_of_slots, 2)
@@ -156,6 +143,45 @@ def process_equipment(character_equip_raw: list) -> dict:
     return equip
 
 
+def get_gear_status(equip: dict) -> list:
+    """
+    Evaluates the processed equipment of a character into one status code per column of the raidcheck overview
+    (0 = ok, 1 = warning, 2 = alert, 3 = none)
+    :param equip: The processed equipment of a character, as returned by process_equipment()
+    :return: A list with a status code for each slot in gear_slot_order, followed by the embellishment status
+    """
+    status_by_slot = {}
+    for item in equip["gear"]:
+        status = 0
+        if item["hassocket"]:
+            for socket in item["sockets"]:
+                if socket["missing"]:
+                    if status < 1:
+                        status = 1
+                elif not socket["hasgem"]:
+                    status = 2
+
+        if item["hasenchantment"]:
+            vz = item["enchantment"][0]
+            if vz["missing"]:
+                status = 2
+            elif ((item["slottype"] == "OFF_HAND" and item["type"] in ["WEAPON", "TWOHWEAPON"])
+                  or item["slottype"] != "OFF_HAND"):
+                if vz["tier"] != "Tier3" and status < 1:
+                    status = 1
+
+        status_by_slot[item["slottype"]] = status
+
+    statuslist = [status_by_slot.get(slottype, 3) for slottype in gear_slot_order]
+
+    if equip["embellishments"] >= 2:
+        statuslist.append(0)
+    else:
+        statuslist.append(1)
+
+    return statuslist
+
+
 def get_embellishment(current_item: dict, item: dict):
     """
     Checks if the item has an embellishent
@@ -163,7 +189,7 @@ def get_embellishment(current_item: dict, item: dict):
     :param item: The item that is checked
     """
     if "limit_category" in item:
-        if "Verziert" in item["limit_category"]:
+        if any(marker in item["limit_category"] for marker in localization.embellishment_markers):
             current_item["hasembellishment"] = True
 
 
@@ -173,8 +199,7 @@ def get_enchantment(current_item: dict, item: dict):
     :param current_item: The dictionary in which to store the information
     :param item: The item that is checked
     """
-    if item["slot"]["name"] in ["Waffenhand", "Schildhand", "Rücken", "Handgelenk", "Füße", "Ring 1", "Ring 2",
-                                "Brust", "Beine"]:
+    if item["slot"]["type"] in enchantable_slots:
         current_item["hasenchantment"] = True
         current_item["enchantment"] = [{}]
         istverzaubert = False
@@ -199,7 +224,7 @@ def get_enchantment(current_item: dict, item: dict):
                             vz["display_string"].split("|")[1].split(":")[1].split("-")[3]
 
         if not istverzaubert:
-            if item["slot"]["name"] == "Schildhand" and not current_item["type"] in ["WEAPON", "TWOHWEAPON"]:
+            if item["slot"]["type"] == "OFF_HAND" and not current_item["type"] in ["WEAPON", "TWOHWEAPON"]:
                 current_item["enchantment"][0]["missing"] = False
             else:
                 current_item["enchantment"][0]["missing"] = True
@@ -222,10 +247,10 @@ def get_sockets(current_item: dict, item: dict):
                 current_item["sockets"][-1]["item"] = sockel["item"]["name"]
                 current_item["sockets"][-1]["description"] = sockel["display_string"]
 
-        if (item["slot"]["name"] in ["Hals", "Ring 1", "Ring 2"]) and len(item["sockets"]) < 2:
+        if item["slot"]["type"] in socket_slots and len(item["sockets"]) < 2:
             current_item["sockets"].append({"missing": True})
 
-    elif item["slot"]["name"] in ["Hals", "Ring 1", "Ring 2"]:
+    elif item["slot"]["type"] in socket_slots:
         current_item["hassocket"] = True
         current_item["sockets"] = []
         current_item["sockets"].append({"missing": True})
@@ -237,7 +262,7 @@ def get_char_class(name: str, realm: str):
     Gets the class of the given Character from the blizzard-api
     :param name: Name of the Character
     :param realm: Name of the Realm of the Character
-    :return: Name of the Class of the Character, or the status code of the response
+    :return: The key of the Class of the Character (see localization.class_names), or the status code of the response
     """
     character_spec_response = blizzapi.get_character_info(name, realm, "specializations")
     try:
@@ -245,10 +270,71 @@ def get_char_class(name: str, realm: str):
         return character_spec_response
     except TypeError:
         pass
+    return parse_char_class(character_spec_response)
+
 
+def parse_char_class(character_spec_response: dict) -> str:
+    """
+    Reads the class of a Character from the specializations the blizzard-api returned for it
+    :param character_spec_response: The answer of the api
+    :return: The key of the Class of the Character (see localization.class_names), or the localized name of the
+    Class if it is unknown
+    """
     charclass = character_spec_response["specializations"][0]["loadouts"][0]["selected_class_talent_tree"]["name"]
+    if charclass not in localization.class_keys:
+        eventlog.log("data", "Unknown class name", charclass=charclass)
+        return charclass
+
+    return localization.class_keys[charclass]
+
+
+def get_char_status(name: str, realm: str):
+    """
+    Gets the profile status of the given Character from the blizzard-api
+    :param name: Name of the Character
+    :param realm: Name of the Realm of the Character
+    :return: A dictionary with the Blizzard "id" of the Character, or the status code of the response (404 if the
+    character is not valid)
+    """
+    character_status_response = blizzapi.get_character_info(name, realm, "status")
+    try:
+        int(character_status_response)
+        return character_status_response
+    except TypeError:
+        pass
+
+    if not character_status_response.get("is_valid", True):
+        return 404
+
+    return {"id": character_status_response["id"]}
+
+
+def get_guild_roster(guild: str, realm: str):
+    """
+    Gets the members of the given guild from the blizzard-api
+    :param guild: Name of the guild, as slug
+    :param realm: Name of the Realm of the guild
+    :return: A list with the "name", the realm "slug", the "level" and the guild "rank" of every member, or the
+    status code of the response
+    """
+    guild_roster_response = blizzapi.get_guild_roster(guild, realm)
+    try:
+        int(guild_roster_response)
+        return guild_roster_response
+    except TypeError:
+        pass
+
+    members = []
+    for member in guild_roster_response["members"]:
+        character = member["character"]
+        members.append({
+            "name": character["name"],
+            "slug": character["realm"]["slug"],
+            "level": character["level"],
+            "rank": member["rank"]
+        })
 
-    return charclass
+    return members
 
 
 def get_char_media(name: str, realm: str):
@@ -265,7 +351,15 @@ def get_char_media(name: str, realm: str):
         return character_media_response
     except TypeError:
         pass
+    return parse_char_media(character_media_response)
+
 
+def parse_char_media(character_media_response: dict) -> dict:
+    """
+    Reads the urls of the pictures of a Character from the media the blizzard-api returned for it
+    :param character_media_response: The answer of the api
+    :return: A dictionary with urls for a portrait, a panorama, and a raw picture of the character
+    """
     media = {
         "portrait": character_media_response["assets"][0]["value"],
         "panorama": character_media_response["assets"][1]["value"],
@@ -295,37 +389,186 @@ def get_item_media(itemid: int):
 def class_armor_type(charclass: str) -> str:
     """
     Looks up the armor type for the given class
-    :param charclass: The name of the class
-    :return:The Armor-type that class wears, or empty string if class is not found
+    :param charclass: The key of the class, as returned by get_char_class()
+    :return: The Armor-type that class wears (see localization.armor_names), or empty string if class is not found
     """
     armor_type = {
-        # Stoff
-        "Priester": "Stoff",
-        "Magier": "Stoff",
-        "Hexenmeister": "Stoff",
-
-        # Leder
-        "Schurke": "Leder",
-        "Druide": "Leder",
-        "Mönch": "Leder",
-        "Dämonenjäger": "Leder",
-
-        # Kette
-        "Jäger": "Kette",
-        "Schamane": "Kette",
-        "Rufer": "Kette",
-
-        # Platte
-        "Krieger": "Platte",
-        "Paladin": "Platte",
-        "Todesritter": "Platte"
+        "PRIEST": "CLOTH",
+        "MAGE": "CLOTH",
+        "WARLOCK": "CLOTH",
+
+        "ROGUE": "LEATHER",
+        "DRUID": "LEATHER",
+        "MONK": "LEATHER",
+        "DEMON_HUNTER": "LEATHER",
+
+        "HUNTER": "MAIL",
+        "SHAMAN": "MAIL",
+        "EVOKER": "MAIL",
+
+        "WARRIOR": "PLATE",
+        "PALADIN": "PLATE",
+        "DEATH_KNIGHT": "PLATE"
     }
     if charclass in armor_type:
         return armor_type[charclass]
     else:
-        print(charclass)
+        eventlog.log("data", "Unknown class, no armor type", charclass=charclass)
         return ""
 
 
+# The responses of a character that are read by the batch mode, named like the infotypes of the api
+saved_infotypes = ["equipment", "specializations", "character-media"]
+batch_chunk_size = 64
+csv_columns = ["name", "realm", "class", "armortype", "avgilvl", "embellishments"] + gear_slot_order + \
+              ["EMBELLISHMENTS", "portrait", "error"]
+
+
+def iter_saved_characters(path: str):
+    """
+    Finds the saved responses of every character, without reading them
+    :param path: A directory of saved responses, a JSONL file or "-" for a JSONL stream on stdin
+    :return: An iterator over a tuple per character, ("directory", path) or ("line", text)
+    """
+    if os.path.isdir(path):
+        for directory, subdirectories, filenames in os.walk(path):
+            subdirectories.sort()
+            if "equipment.json" in filenames:
+                yield "directory", directory
+        return
+    file = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    for line in file:
+        if line.strip() != "":
+            yield "line", line
+    if file is not sys.stdin:
+        file.close()
+
+
+def load_saved_character(task: tuple) -> dict:
+    """
+    Reads the saved responses of a character
+    :param task: A tuple as returned by iter_saved_characters()
+    :return: A dictionary with the "name", the "realm" and the responses by infotype
+    """
+    kind, source = task
+    if kind == "line":
+        return json.loads(source)
+    realm_directory, name = os.path.split(os.path.normpath(source))
+    saved = {"name": name, "realm": os.path.basename(realm_directory)}
+    for infotype in saved_infotypes:
+        response_path = os.path.join(source, f"{infotype}.json")
+        if os.path.exists(response_path):
+            file = open(response_path, "r", encoding="utf-8")
+            saved[infotype] = json.load(file)
+            file.close()
+    return saved
+
+
+def process_saved_character(saved: dict) -> dict:
+    """
+    Processes the saved responses of a character like the live requests would be
+    :param saved: A dictionary as returned by load_saved_character()
+    :return: A dictionary with the "name", "realm", "class", "armortype", "portrait", the processed "equip" and the
+    "status" of every column of the raidcheck overview
+    """
+    equip = process_equipment(saved["equipment"]["equipped_items"])
+    record = {"name": saved["name"], "realm": saved["realm"], "class": "", "armortype": "", "portrait": ""}
+    if "specializations" in saved:
+        record["class"] = parse_char_class(saved["specializations"])
+        record["armortype"] = class_armor_type(record["class"])
+    if "character-media" in saved:
+        record["portrait"] = parse_char_media(saved["character-media"])["portrait"]
+    record["status"] = dict(zip(gear_slot_order + ["EMBELLISHMENTS"], get_gear_status(equip)))
+    record["equip"] = equip
+    return record
+
+
+def process_batch(tasks: list) -> list:
+    """
+    Processes a chunk of characters in a worker process, a character that can not be processed gets a record with
+    the "error" instead of failing the chunk
+    :param tasks: Tuples as returned by iter_saved_characters()
+    :return: A record per character, in the same order
+    """
+    records = []
+    for task in tasks:
+        try:
+            saved = load_saved_character(task)
+        except Exception as error:
+            records.append({"source": task[1].strip()[:200], "error": repr(error)})
+            continue
+        try:
+            records.append(process_saved_character(saved))
+        except Exception as error:
+            records.append({"name": saved.get("name"), "realm": saved.get("realm"), "error": repr(error)})
+    return records
+
+
+def init_batch_worker():
+    """
+    Sends the log records of a worker process to stderr, so they don't end up between the results on stdout
+    """
+    eventlog.log_stream = sys.stderr
+
+
+def run_batch(path: str, workers: int = None, chunk_size: int = batch_chunk_size):
+    """
+    Processes saved responses with a pool of processes, only a few chunks per worker are queued at a time so the
+    input is streamed instead of read completely
+    :param path: A directory of saved responses, a JSONL file or "-", see iter_saved_characters()
+    :param workers: The number of processes, one per core if None
+    :param chunk_size: The number of characters sent to a process at once
+    :return: An iterator over the records of the characters, in the order of the input
+    """
+    workers = workers or os.cpu_count() or 1
+    tasks = iter_saved_characters(path)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker) as executor:
+        while True:
+            chunk = list(islice(tasks, chunk_size))
+            if len(chunk) != 0:
+                pending.append(executor.submit(process_batch, chunk))
+            if len(pending) == 0:
+                return
+            if len(chunk) == 0 or len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+
+
+def write_jsonl(records, file):
+    for record in records:
+        file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def write_csv(records, file):
+    writer = csv.DictWriter(file, fieldnames=csv_columns, extrasaction="ignore")
+    writer.writeheader()
+    for record in records:
+        row = dict(record)
+        row.update(record.get("status", {}))
+        row["avgilvl"] = record["equip"]["avgilvl"] if "equip" in record else ""
+        row["embellishments"] = record["equip"]["embellishments"] if "equip" in record else ""
+        writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Processes saved responses of the Blizzard-API")
+    parser.add_argument("input", help="a directory of saved responses, a JSONL file, or - for JSONL on stdin")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl", help="the format of the results")
+    parser.add_argument("--output", help="file to write the results to, stdout if not given")
+    parser.add_argument("--workers", type=int, help="the number of processes, one per core if not given")
+    parser.add_argument("--chunk-size", type=int, default=batch_chunk_size,
+                        help="the number of characters sent to a process at once")
+    args = parser.parse_args()
+
+    file = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    records = run_batch(args.input, args.workers, args.chunk_size)
+    if args.format == "csv":
+        write_csv(records, file)
+    else:
+        write_jsonl(records, file)
+    if file is not sys.stdout:
+        file.close()
+
+
 if __name__ == "__main__":
-    print(get_char_equip("estalia", "todeswache"))
+    main()
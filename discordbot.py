@@ -6,69 +6,244 @@ This module implements a discord bot for requesting Information about World of W
 
 """
 
+import asyncio
 import json
+import os
+import threading
+import time
+from collections import OrderedDict
 from typing import List, Any, Dict
 
 import discord
 import requests
 
+import blizzapi
+import cassette
+import characterindex
 import data_processing
+import eventlog
+import guilds
+import localization
+import memberdirectory
+import metrics
+import profiling
+import raidcheckstore
+import raidstats
+import realmindex
+import regions
+import settingswatch
+import sharedcache
+import snapshot
+import subscriptions
+import timeline
+import tracing
+import watchdog
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
-client = discord.Client(intents=intents)
-last_raidcheck_result = []
+client = discord.AutoShardedClient(intents=intents)
+settings = {}
+item_icon_ids = None
+# Guards item_icon_ids and itemiconid.json, icons are looked up from worker threads
+item_icon_lock = threading.Lock()
+# Shown instead of the icon of an item whose icon could not be fetched
+missing_icon_emote = "❔"
+startup_started = None
+validation_concurrency = 8
+import_min_level = 80
+raidcheck_freshness = 60
+inflight_raidchecks = {}
+# Seconds a user has to wait before using the command again, can be overridden with the setting "cooldowns"
+default_cooldowns = {"raidcheck": 30, "raidstats": 30, "raidimport": 300, "gear": 5, "history": 5}
+last_used = {}
+# The status emote strings, derived from the emotes of the settings they were built from
+status_strings = {}
+status_strings_emotes = None
+# Settings that are only read at startup
+restart_settings = ["metricsport", "snapshotfile", "cassette", "logfile", "sharedcache", "shardcount"]
+# Rendered pages of the raid detail view, by run, character and locale, the least recently used are dropped first
+detail_pages = OrderedDict()
+detail_page_cache_size = 200
+# The maximum number of options of a dropdown allowed by discord
+max_select_options = 25
+# Seconds between the checks which followed characters are due to be polled, and how many are polled at once
+subscription_tick = 60
+subscription_concurrency = 4
+subscription_task = None
 
 
 #
 #       Classes
 #
 
-class CharSelect(discord.ui.Select):
-    def __init__(self, charlist: list):
+class CharSelect(discord.ui.DynamicItem[discord.ui.Select], template=r"raidcheck:(?P<run_id>[0-9a-f]+)"):
+    def __init__(self, run_id: str, playerlist: list = None):
+        self.run_id = run_id
         options = []
-        for char in charlist:
-            options.append(discord.SelectOption(label=char))
-        super().__init__(placeholder="Wähle einen Charakter für mehr Details", max_values=1, min_values=1,
-                         options=options)
+        keys = set()
+        for char in playerlist or []:
+            key = raidcheckstore.make_key(char["name"], char["realm"])
+            if key in keys:
+                continue
+            keys.add(key)
+            options.append(discord.SelectOption(label=f"{char['name']}-{char['realm']}", value=key))
+        placeholder = "Wähle einen Charakter für mehr Details"
+        if len(options) > max_select_options:
+            # Discord rejects larger dropdowns, every character can still be reached through the raid detail view
+            options = options[:max_select_options]
+            placeholder = f"Die ersten {max_select_options} Charaktere, alle weiteren unter \"Alle Details\""
+        super().__init__(discord.ui.Select(custom_id=f"raidcheck:{run_id}", placeholder=placeholder,
+                                           max_values=1, min_values=1, options=options))
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match):
+        return cls(match["run_id"])
 
     async def callback(self, interaction: discord.Interaction):
-        global last_raidcheck_result
+        cassette.record_interaction(interaction, self.item.custom_id, self.item.values)
+        with guilds.use(interaction.guild_id), regions.use(get_setting("region"), get_setting("locale")):
+            with tracing.trace("charselect", user=interaction.user.id, character=self.item.values[0]):
+                with metrics.command_latency.time(command="charselect"):
+                    await self.show_character(interaction)
+
+    async def show_character(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True, thinking=True)
-        playerlist = get_raidlist()
-        charnamelist = get_charnames_from_raidlist(playerlist)
-        character_index = charnamelist.index(self.values[0])
-        selectedchar = playerlist[character_index]
-        name = selectedchar["name"]
-        realm = selectedchar["realm"]
-        clean_name = name.lower()
-        clean_realm = "-".join(realm.split(" ")).lower().replace("'", "")
-        equip = last_raidcheck_result[character_index]
-        equip["class"] = data_processing.get_char_class(clean_name, clean_realm)
-        equip["thumbnail"] = data_processing.get_char_media(clean_name, clean_realm)["portrait"]
-        gearembed = await construct_gearembed(name, realm, equip)
-        await interaction.followup.send(embed=gearembed, ephemeral=True)
+        entry = raidcheckstore.get_result(self.run_id, self.item.values[0])
+        if entry is None:
+            await send_message(interaction.followup, "Dieser Raidcheck ist abgelaufen, bitte führe !raidcheck erneut \
+aus.", ephemeral=True)
+            return
+        if type(entry["result"]) is int:
+            await send_message(interaction.followup, f"Die Daten von {entry['name']}-{entry['realm']} konnten nicht \
+abgerufen werden (Fehler {entry['result']}).", ephemeral=True)
+            return
+        gearembed = await get_detail_page(self.run_id, self.item.values[0], entry)
+        await send_message(interaction.followup, embed=gearembed, ephemeral=True)
+
+
+class DetailButton(discord.ui.DynamicItem[discord.ui.Button],
+                   template=r"raiddetail:(?P<run_id>[0-9a-f]+):(?P<page>[0-9]+):(?P<action>open|prev|next)"):
+    labels = {"open": "Alle Details", "prev": "◀ Zurück", "next": "Weiter ▶"}
+
+    def __init__(self, run_id: str, page: int, action: str, disabled: bool = False):
+        """
+        A button of the raid detail view
+        :param run_id: ID of the raidcheck run
+        :param page: The page the button leads to
+        :param action: "open" to send the view as a new message, "prev" or "next" to turn the page of the view
+        :param disabled: Whether the button can not be clicked
+        """
+        self.run_id = run_id
+        self.page = page
+        self.action = action
+        style = discord.ButtonStyle.primary if action == "open" else discord.ButtonStyle.secondary
+        super().__init__(discord.ui.Button(custom_id=f"raiddetail:{run_id}:{page}:{action}", label=self.labels[action],
+                                           style=style, disabled=disabled))
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(match["run_id"], int(match["page"]), match["action"])
+
+    async def callback(self, interaction: discord.Interaction):
+        cassette.record_interaction(interaction, self.item.custom_id, [])
+        with guilds.use(interaction.guild_id), regions.use(get_setting("region"), get_setting("locale")):
+            with tracing.trace("raiddetail", user=interaction.user.id, page=self.page):
+                with metrics.command_latency.time(command="raiddetail"):
+                    await show_detail_page(interaction, self.run_id, self.page, self.action == "open")
+
+
+class DetailJump(discord.ui.DynamicItem[discord.ui.Select], template=r"raiddetailjump:(?P<run_id>[0-9a-f]+)"):
+    def __init__(self, run_id: str, entries: list = None, page: int = 0):
+        """
+        The dropdown of the raid detail view, it lists the pages around the current one
+        :param run_id: ID of the raidcheck run
+        :param entries: The keys and results of every character of the run, in the order of the pages
+        :param page: The current page
+        """
+        self.run_id = run_id
+        entries = entries or []
+        first = max(0, min(page - max_select_options // 2, len(entries) - max_select_options))
+        options = []
+        for number, (key, entry) in enumerate(entries[first:first + max_select_options], first):
+            options.append(discord.SelectOption(label=f"{number + 1}. {entry['name']}-{entry['realm']}",
+                                                value=str(number), default=number == page))
+        super().__init__(discord.ui.Select(custom_id=f"raiddetailjump:{run_id}",
+                                           placeholder="Springe zu einem Charakter",
+                                           max_values=1, min_values=1, options=options))
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match):
+        return cls(match["run_id"])
+
+    async def callback(self, interaction: discord.Interaction):
+        cassette.record_interaction(interaction, self.item.custom_id, self.item.values)
+        page = int(self.item.values[0])
+        with guilds.use(interaction.guild_id), regions.use(get_setting("region"), get_setting("locale")):
+            with tracing.trace("raiddetail", user=interaction.user.id, page=page):
+                with metrics.command_latency.time(command="raiddetail"):
+                    await show_detail_page(interaction, self.run_id, page, False)
 
 
 class SelectView(discord.ui.View):
-    def __init__(self, *, timeout=1800, select):
+    def __init__(self, *, timeout=None, select):
         super().__init__(timeout=timeout)
         self.add_item(select)
 
 
+class DetailView(discord.ui.View):
+    def __init__(self, run_id: str, entries: list, page: int):
+        """
+        The buttons and the dropdown of a page of the raid detail view
+        :param run_id: ID of the raidcheck run
+        :param entries: The keys and results of every character of the run, in the order of the pages
+        :param page: The current page
+        """
+        super().__init__(timeout=None)
+        self.add_item(DetailButton(run_id, max(page - 1, 0), "prev", disabled=page == 0))
+        self.add_item(DetailButton(run_id, min(page + 1, len(entries) - 1), "next",
+                                   disabled=page >= len(entries) - 1))
+        self.add_item(DetailJump(run_id, entries, page))
+
+
 #
 #       Functions
 #
 
+def get_setting(key: str, default=None):
+    """
+    Looks up a setting for the guild of the current command, see guilds.get_setting()
+    :param key: The name of the setting
+    :param default: The value if the setting is not set
+    :return: The value of the setting
+    """
+    return guilds.get_setting(settings, key, default)
+
+
+def get_regions() -> set:
+    """
+    :return: The regions of every guild the bot serves
+    """
+    configured = {settings.get("region")} | {partition.get("region") for partition in guilds.partitions.values()}
+    return {region or regions.default_region for region in configured}
+
+
 def get_raidlist() -> list:
     """
-    Reads the list of Characters in the Raidlist from file
+    Reads the list of Characters in the Raidlist of the current guild from file
     :return: A list containing every Characters Name, Realm and their connected Discord-ID that is in the raidlist
     """
-    file = open("raidplayerlist.json", "r")
+    path = guilds.state_path("raidplayerlist.json")
+    if guilds.current_partition() is not None and not os.path.exists(path):
+        return []
+    metrics.store_operations.inc(file="raidplayerlist.json", operation="read")
+    file = open(path, "r")
     playerlist = json.load(file)
     file.close()
+    # Entries added by older versions of !raidadd store the Discord-ID under "discord_id"
+    for character in playerlist:
+        if "discord_id" in character:
+            character["discordID"] = character.pop("discord_id")
     return playerlist
 
 
@@ -87,22 +262,26 @@ def get_charnames_from_raidlist(playerlist: list) -> list:
 
 def save_raidlist(playerlist: list):
     """
-    Saves the playerlist to a file
+    Saves the playerlist of the current guild to a file
     :param playerlist: A List of players in the raid
     """
-    file = open("raidplayerlist.json", "w")
+    metrics.store_operations.inc(file="raidplayerlist.json", operation="write")
+    file = open(guilds.state_path("raidplayerlist.json", create=True), "w")
     json.dump(playerlist, file, indent=4)
     file.close()
 
 
 def save_settings(settingsdict: dict):
     """
-    Saves the settings to a file
+    Saves the settings to a file, the file is replaced atomically so the settings watcher never reads half of it
     :param settingsdict: A dictionary conataining the settings
     """
-    file = open("settings.json", "w")
+    metrics.store_operations.inc(file="settings.json", operation="write")
+    file = open("settings.json.tmp", "w")
     json.dump(settingsdict, file, indent=4)
     file.close()
+    os.replace("settings.json.tmp", "settings.json")
+    settingswatch.mark_current()
 
 
 def load_settings() -> dict:
@@ -110,32 +289,68 @@ def load_settings() -> dict:
     Reads the settings from a file
     :return: Dictionary conatining the settings
     """
+    metrics.store_operations.inc(file="settings.json", operation="read")
     file = open("settings.json", "r")
     settingsdict = json.load(file)
     file.close()
+    settingswatch.mark_current()
     return settingsdict
 
 
+def apply_settings(new_settings: dict):
+    """
+    Swaps in reloaded settings and updates only what depends on the settings that changed
+    :param new_settings: The settings read from the file, already validated
+    """
+    global settings
+    changed = settingswatch.changed_keys(settings, new_settings)
+    if "emotes" in changed:
+        # Keep the item emotes the bot created, in case the file was edited from a copy that didn't have them yet
+        for key, emote in settings.get("emotes", {}).items():
+            if key.isdigit() and key not in new_settings["emotes"]:
+                new_settings["emotes"][key] = emote
+    elif "emotes" in settings:
+        # Unchanged, so the derived status strings stay valid
+        new_settings["emotes"] = settings["emotes"]
+    settings = new_settings
+    if "lagthreshold" in changed:
+        watchdog.lag_threshold = settings.get("lagthreshold", watchdog.lag_threshold)
+    if "slowcommandthreshold" in changed:
+        tracing.slow_threshold = settings.get("slowcommandthreshold", tracing.slow_threshold)
+    if "tracefile" in changed:
+        tracing.trace_file = settings.get("tracefile")
+    if "guilds" in changed:
+        guilds.configure(settings.get("guilds", {}))
+    if "logsampling" in changed:
+        eventlog.sample_rates.update(settings.get("logsampling", {}))
+    if "lograte" in changed:
+        eventlog.rate_limits.update(settings.get("lograte", {}))
+    if len(changed) != 0:
+        print(f"Settings reloaded, changed: {', '.join(sorted(changed))}")
+    for key in sorted(changed.intersection(restart_settings)):
+        print(f"The setting {key} only takes effect after a restart")
+
+
 def class_to_color(classname: str) -> int:
     """
     Looks up the color-code for a given class
-    :param classname: The name of the class
+    :param classname: The key of the class, as returned by data_processing.get_char_class()
     :return: The color-code in decimal for the class
     """
     colordict = {
-        "Druide": 16743434,  # FF7C0A
-        "Dämonenjäger": 10694857,  # A330C9
-        "Hexenmeister": 8882414,  # 8788EE
-        "Jäger": 11195250,  # AAD372
-        "Krieger": 13015917,  # C69B6D
-        "Magier": 4179947,  # 3FC7EB
-        "Mönch": 65432,  # 00FF98
-        "Paladin": 16026810,  # F48CBA
-        "Priester": 16777215,  # FFFFFF
-        "Rufer": 3380095,  # 33937F
-        "Schamane": 28893,  # 0070DD
-        "Schurke": 16774248,  # FFF468
-        "Todesritter": 12852794  # C41E3A
+        "DRUID": 16743434,  # FF7C0A
+        "DEMON_HUNTER": 10694857,  # A330C9
+        "WARLOCK": 8882414,  # 8788EE
+        "HUNTER": 11195250,  # AAD372
+        "WARRIOR": 13015917,  # C69B6D
+        "MAGE": 4179947,  # 3FC7EB
+        "MONK": 65432,  # 00FF98
+        "PALADIN": 16026810,  # F48CBA
+        "PRIEST": 16777215,  # FFFFFF
+        "EVOKER": 3380095,  # 33937F
+        "SHAMAN": 28893,  # 0070DD
+        "ROGUE": 16774248,  # FFF468
+        "DEATH_KNIGHT": 12852794  # C41E3A
     }
 
     if classname in colordict:
@@ -160,35 +375,119 @@ def eval_gear_status(status: int) -> str:
     :param status: A ID representing the status of an Item
     :return: A string containing an emote representing the status
     """
-    match status:
-        case 0:
-            status_string = f"{settings['emotes']['checkmark']} "
-        case 1:
-            status_string = f"{settings['emotes']['warning']} "
-        case 2:
-            status_string = f"{settings['emotes']['alert']} "
-        case 3:
-            status_string = f"{settings['emotes']['none']} "
-    return status_string
+    global status_strings, status_strings_emotes
+    if status_strings_emotes is not settings["emotes"]:
+        emotes = settings["emotes"]
+        status_strings = {
+            0: f"{emotes['checkmark']} ",
+            1: f"{emotes['warning']} ",
+            2: f"{emotes['alert']} ",
+            3: f"{emotes['none']} "
+        }
+        status_strings_emotes = emotes
+    return status_strings[status]
 
 
 def character_exists(name: str, realm: str) -> bool:
     """
-    Checks if a character exists by making a simple api-request
+    Checks if a character exists, only making a simple api-request if the character index doesn't know it yet
     :param name: Name of the Character
     :param realm: Name of the realm
     :return: Boolean (if character exists or not)
     """
-    media = data_processing.get_char_media(name, realm)
-    return type(media) is not int
+    known = characterindex.exists(name, realm)
+    if known is not None:
+        return known
+    status = data_processing.get_char_status(name, realm)
+    return type(status) is not int
+
+
+def unknown_realm_text(realm: str) -> str:
+    """
+    Constructs the answer for a realm that does not exist, with suggestions which realm might have been meant
+    :param realm: Name of the realm, as typed by the user
+    :return: The text to send to the user
+    """
+    text = f"Der Realm \"{realm}\" wurde nicht gefunden."
+    suggestions = realmindex.suggest(realm)
+    if len(suggestions) > 0:
+        text += "\nMeintest du " + " oder ".join(f"\"{suggestion}\"" for suggestion in suggestions) + "?"
+    return text
+
+
+def add_to_raidlist(characters: list) -> tuple:
+    """
+    Adds many characters to the raidlist at once, the raidlist is only read and written once
+    :param characters: A list of dictionaries with the "name", the "realm" and the "discordID" of every character
+    :return: A tuple of the list of characters that were added and the list of characters that already were in the
+    raidlist
+    """
+    playerlist = get_raidlist()
+    known = {(character["name"].lower(), realmindex.get_slug(character["realm"])) for character in playerlist}
+    added = []
+    duplicates = []
+    for character in characters:
+        key = (character["name"].lower(), realmindex.get_slug(character["realm"]))
+        if key in known:
+            duplicates.append(character)
+            continue
+        known.add(key)
+        added.append(character)
+
+    if len(added) != 0:
+        playerlist.extend(added)
+        save_raidlist(playerlist)
+    return added, duplicates
+
+
+def format_charlist(characters: list, limit: int = 500) -> str:
+    """
+    Joins the names of characters for a message, cutting off the list if it gets too long
+    :param characters: A list of dictionaries with the "name" and the "realm" of every character
+    :param limit: The maximum length of the text
+    :return: The names of the characters, separated by commas
+    """
+    text = ""
+    for number, character in enumerate(characters):
+        name = f"{character['name']}-{character['realm']}"
+        if len(text) + len(name) > limit:
+            return text + f"... und {len(characters) - number} weitere"
+        text += name if text == "" else ", " + name
+    return text
+
+
+def raidadd_report(added: list, duplicates: list, notfound: list, errors: list = None) -> str:
+    """
+    Constructs the answer to a command that added many characters to the raidlist
+    :param added: The characters that were added
+    :param duplicates: The characters that already were in the raidlist
+    :param notfound: The characters that do not exist
+    :param errors: Additional lines, e.g. for entries that could not be read
+    :return: The text to send to the user
+    """
+    lines = []
+    if len(added) != 0:
+        lines.append(f"{len(added)} Charaktere wurden der Raidliste hinzugefügt: {format_charlist(added)}")
+    else:
+        lines.append("Es wurden keine Charaktere hinzugefügt.")
+    if len(duplicates) != 0:
+        lines.append(f"{len(duplicates)} Charaktere sind bereits in der Liste: {format_charlist(duplicates)}")
+    if len(notfound) != 0:
+        lines.append(f"{len(notfound)} Charaktere wurden nicht gefunden: {format_charlist(notfound)}")
+    lines.extend(errors or [])
+    return "\n".join(lines)[:2000]
 
 
 def get_mains() -> list:
     """
-    Reads the list of User-Mains from a file
+    Reads the list of User-Mains of the current guild from a file
     :return:List of User-Mains
     """
-    file = open("playermains.json", "r")
+    path = guilds.state_path("playermains.json")
+    if guilds.current_partition() is not None and not os.path.exists(path):
+        return {}
+    metrics.store_operations.inc(file="playermains.json", operation="read")
+    file = open(path, "r")
     mainlist = json.load(file)
     file.close()
     return mainlist
@@ -196,10 +495,11 @@ def get_mains() -> list:
 
 def save_mains(mainlist: list):
     """
-    Saves list of User-Mains to a file
+    Saves list of User-Mains of the current guild to a file
     :param mainlist: List of User-Mains
     """
-    file = open("playermains.json", "w")
+    metrics.store_operations.inc(file="playermains.json", operation="write")
+    file = open(guilds.state_path("playermains.json", create=True), "w")
     json.dump(mainlist, file, indent=4)
     file.close()
 
@@ -232,53 +532,220 @@ def remove_raid(discord_id: int):
     save_raidlist(raidliste)
 
 
+def get_item_icon_ids() -> dict:
+    """
+    Reads the Icon IDs of every known Item from file the first time it is needed, after that they are kept in memory.
+    Must be called while holding item_icon_lock
+    :return: A dictionary mapping Item IDs to Icon IDs
+    """
+    global item_icon_ids
+    if item_icon_ids is None:
+        metrics.store_operations.inc(file="itemiconid.json", operation="read")
+        file = open("itemiconid.json", "r")
+        item_icon_ids = json.load(file)
+        file.close()
+    return item_icon_ids
+
+
+@tracing.traced()
 def get_item_icon_id(item_id: int) -> int:
     """
     Checks if the given Item ID already has a Icon ID saved and saves it if not
     :param item_id: ID of the Item in question
-    :return: A list with the url of an icon if it hasn't been saved yet, and the ID of the ICon
-    """
-    file = open("itemiconid.json", "r")
-    itemiconidlist = json.load(file)
-    file.close()
-
-    if str(item_id) in itemiconidlist:
-        icondata = ["", itemiconidlist[str(item_id)]]
+    :return: A list with the url of an icon if it hasn't been saved yet, and the ID of the ICon, or the status code
+    of the response if the icon could not be fetched
+    """
+    with item_icon_lock:
+        icon_id = get_item_icon_ids().get(str(item_id))
+    if icon_id is not None:
+        metrics.cache_requests.inc(cache="itemicon", outcome="hit")
+        return ["", icon_id]
+
+    metrics.cache_requests.inc(cache="itemicon", outcome="miss")
+    # Icons never change, so one fetched by another process can be used at any age
+    shared = sharedcache.get("itemicon", str(item_id), float("inf"))
+    if shared is not None:
+        icondata = shared[0]
     else:
         icondata = data_processing.get_item_media(item_id)
-        itemiconidlist[str(item_id)] = icondata[1]
+        if type(icondata) is int:
+            return icondata
+        sharedcache.put("itemicon", str(item_id), icondata)
 
-    file = open("itemiconid.json", "w")
-    json.dump(itemiconidlist, file, indent=4)
-    file.close()
+    with item_icon_lock:
+        itemiconidlist = get_item_icon_ids()
+        itemiconidlist[str(item_id)] = icondata[1]
+        metrics.store_operations.inc(file="itemiconid.json", operation="write")
+        file = open("itemiconid.json.tmp", "w")
+        json.dump(itemiconidlist, file, indent=4)
+        file.close()
+        os.replace("itemiconid.json.tmp", "itemiconid.json")
 
     return icondata
 
 
+def add_character_details(chardict: dict, name: str, realm: str):
+    """
+    Adds the class and the portrait of a character to the dictionary of its equipment, both are left empty if
+    they could not be retrieved
+    :param chardict: The dictionary as returned by data_processing.get_char_equip()
+    :param name: Name of the Character, as used in api requests
+    :param realm: Name of the realm, as used in api requests
+    """
+    charclass = data_processing.get_char_class(name, realm)
+    media = data_processing.get_char_media(name, realm)
+    chardict["class"] = charclass if type(charclass) is not int else ""
+    chardict["thumbnail"] = media["portrait"] if type(media) is not int else ""
+
+
 #
 #       Async Functions
 #
 
+async def render_detail_page(entry: dict) -> discord.Embed:
+    """
+    Renders the equipment of a character of a raidcheck run, its class and portrait are fetched if the run does not
+    contain them yet
+    :param entry: The result of the character, as returned by raidcheckstore.get_result()
+    :return: The embed of the character
+    """
+    name = entry["name"]
+    realm = entry["realm"]
+    equip = entry["result"]
+    if type(equip) is int:
+        return make_embed({"description": f"# {name}-{realm}\nDie Daten konnten nicht abgerufen werden "
+                                          f"(Fehler {equip}).", "color": 0})
+    if "class" not in equip:
+        # The run is shared by every view of it, so the details are added to a copy
+        equip = dict(equip)
+        await asyncio.to_thread(add_character_details, equip, name.lower(), realmindex.get_slug(realm))
+    return await construct_gearembed(name, realm, equip)
+
+
+async def prefetch_detail_page(entry: dict) -> discord.Embed:
+    """
+    Renders a page in a trace of its own, as the command that started it may be finished before the page is
+    :param entry: The result of the character, see render_detail_page()
+    :return: The embed of the character
+    """
+    with tracing.trace("raiddetail.prefetch", character=f"{entry['name']}-{entry['realm']}"):
+        return await render_detail_page(entry)
+
+
+def get_detail_page(run_id: str, key: str, entry: dict, prefetch: bool = False) -> asyncio.Task:
+    """
+    Looks up the rendered page of a character of a raidcheck run, and starts rendering it in the background if it
+    has not been rendered yet for the locale of the current command. Awaiting the task gives the embed, rendering
+    a page that is already being rendered joins the running task
+    :param run_id: ID of the raidcheck run
+    :param key: Key of the character, see raidcheckstore.make_key()
+    :param entry: The result of the character, as returned by raidcheckstore.get_result()
+    :param prefetch: Whether the page is rendered ahead of time instead of for the current command
+    :return: The task rendering the page
+    """
+    cache_key = (run_id, key, regions.get_locale())
+    task = detail_pages.get(cache_key)
+    if task is not None:
+        metrics.cache_requests.inc(cache="detailpage", outcome="hit")
+        detail_pages.move_to_end(cache_key)
+        return task
+    metrics.cache_requests.inc(cache="detailpage", outcome="miss")
+    task = asyncio.ensure_future(prefetch_detail_page(entry) if prefetch else render_detail_page(entry))
+
+    def forget_failed(done: asyncio.Task):
+        if done.cancelled() or done.exception() is not None:
+            if detail_pages.get(cache_key) is done:
+                del detail_pages[cache_key]
+
+    task.add_done_callback(forget_failed)
+    detail_pages[cache_key] = task
+    while len(detail_pages) > detail_page_cache_size:
+        detail_pages.popitem(last=False)
+    return task
+
+
+async def show_detail_page(interaction: discord.Interaction, run_id: str, page: int, new_message: bool):
+    """
+    Shows a page of the raid detail view, the pages next to it are rendered in the background so turning the page
+    does not have to wait
+    :param interaction: The interaction of the click
+    :param run_id: ID of the raidcheck run
+    :param page: The page to show, starting at 0
+    :param new_message: Whether to send the view as a new message instead of turning the page of the clicked one
+    """
+    if new_message:
+        await interaction.response.defer(ephemeral=True, thinking=True)
+    else:
+        await interaction.response.defer()
+    run = raidcheckstore.load_run(run_id)
+    if run is None or len(run["results"]) == 0:
+        await send_message(interaction.followup, "Dieser Raidcheck ist abgelaufen, bitte führe !raidcheck erneut \
+aus.", ephemeral=True)
+        return
+    entries = list(run["results"].items())
+    page = min(page, len(entries) - 1)
+    embed = (await get_detail_page(run_id, *entries[page])).copy()
+    embed.set_footer(text=f"Charakter {page + 1}/{len(entries)}")
+    for neighbour in [page + 1, page - 1]:
+        if 0 <= neighbour < len(entries):
+            get_detail_page(run_id, *entries[neighbour], prefetch=True)
+
+    view = DetailView(run_id, entries, page)
+    if new_message:
+        await send_message(interaction.followup, embed=embed, view=view, ephemeral=True)
+    else:
+        with tracing.span("interaction.edit"):
+            await interaction.edit_original_response(embed=embed, view=view)
+
+
+async def send_message(channel, *args, **kwargs):
+    """
+    Sends a message to a channel inside its own tracing span
+    :param channel: The channel (or interaction followup) to send the message to
+    :return: The message that was sent
+    """
+    with tracing.span("channel.send"):
+        return await channel.send(*args, **kwargs)
+
+
+async def validate_characters(characters: list) -> list:
+    """
+    Checks if many characters exist, with up to validation_concurrency requests running at the same time
+    :param characters: A list of tuples with the name and the realm of every character, as used in api requests
+    :return: A list with a boolean for every character, in the same order
+    """
+    semaphore = asyncio.Semaphore(validation_concurrency)
+
+    async def validate(name: str, realm: str) -> bool:
+        async with semaphore:
+            return await asyncio.to_thread(character_exists, name, realm)
+
+    with tracing.span("validate_characters", count=len(characters)):
+        return await asyncio.gather(*(validate(name, realm) for name, realm in characters))
+
+
 async def add_role(guild: discord.Guild, member: discord.Member, roleid: int):
     """
     Adds a given role to a given Member of a guild
     :param guild: The Guild with the Member for which to add a role
-    :param member: The Member to add a role to
+    :param member: The Member to add a role to, nothing happens if it is None
     :param roleid: The ID of the Role to be added
     """
-    role = await guild.fetch_role(roleid)
-    await member.add_roles(role)
+    role = await memberdirectory.get_role(guild, roleid)
+    if member is not None and role is not None:
+        await member.add_roles(role)
 
 
 async def remove_role(guild: discord.Guild, member: discord.Member, roleid: int):
     """
     Removes a given role from a given Member of a guild
     :param guild: The Guild with the Member for which to remove a role
-    :param member: The Member to remove a role from
+    :param member: The Member to remove a role from, nothing happens if it is None
     :param roleid: The ID of the Role to be removed
     """
-    role = await guild.fetch_role(roleid)
-    await member.remove_roles(role)
+    role = await memberdirectory.get_role(guild, roleid)
+    if member is not None and role is not None:
+        await member.remove_roles(role)
 
 
 async def get_member(guild: discord.Guild, member_id: int) -> discord.Member:
@@ -286,10 +753,9 @@ async def get_member(guild: discord.Guild, member_id: int) -> discord.Member:
     Looks up a User ID in a guild to get the corresponding Member Object
     :param guild: The Guild in which the member is
     :param member_id: The ID of the member in question
-    :return:Discord Member object of the requested Member
+    :return:Discord Member object of the requested Member, or None if the user is not part of the guild
     """
-    member = await guild.fetch_member(member_id)
-    return member
+    return await memberdirectory.get_member(guild, member_id)
 
 
 async def get_username(guild: discord.Guild, member_id: int) -> str:
@@ -297,12 +763,13 @@ async def get_username(guild: discord.Guild, member_id: int) -> str:
     Looks up a User ID in a guild to get the correspending Display-name
     :param guild: The Guild in which the member is
     :param member_id: The ID of the member in question
-    :return: The Display-name of the User in the Guild
+    :return: The Display-name of the User in the Guild, or the ID if the user is not part of the guild
     """
-    user = await guild.fetch_member(member_id)
-    return user.display_name
+    names = await memberdirectory.get_display_names(guild, [member_id])
+    return names[member_id]
 
 
+@tracing.traced()
 async def create_emoji(name: str, url: str) -> discord.Emoji:
     """
     Uploads a Emote to the bot, which the bot can then use
@@ -312,25 +779,35 @@ async def create_emoji(name: str, url: str) -> discord.Emoji:
     """
     image = requests.get(url)
     emote = await client.create_application_emoji(name=name, image=image.content)
+    metrics.emoji_uploads.inc()
     return emote
 
 
+@tracing.traced()
 async def get_item_emote(itemid: int) -> str:
     """
     Looks up the emotestring for the icon of an item and creates it if it doesn't exist yet
     :param itemid: ID of the Item in question
-    :return: The emotestring so the bot can use this emote in a message
+    :return: The emotestring so the bot can use this emote in a message, a placeholder if the icon could not be
+    fetched
     """
-    icondata = get_item_icon_id(itemid)
+    icondata = await asyncio.to_thread(get_item_icon_id, itemid)
+    if type(icondata) is int:
+        return missing_icon_emote
     if str(icondata[1]) in settings["emotes"]:
+        metrics.cache_requests.inc(cache="emote", outcome="hit")
         return settings["emotes"][str(icondata[1])]
     else:
+        metrics.cache_requests.inc(cache="emote", outcome="miss")
         itememote = await create_emoji(str(icondata[1]), icondata[0])
+        # Pick up pending changes of the file first, so saving doesn't overwrite them
+        settingswatch.check()
         settings["emotes"][str(icondata[1])] = str(itememote)
         save_settings(settings)
         return settings["emotes"][str(icondata[1])]
 
 
+@tracing.traced()
 async def construct_gearembed(name: str, realm: str, chardict: dict) -> discord.Embed:
     """
     Constructs an Embed of the equipment of a given character using a dictionary containing information about it
@@ -339,23 +816,28 @@ async def construct_gearembed(name: str, realm: str, chardict: dict) -> discord.
     :param chardict: A dictionary conatining information about the equipment of the Character in question
     :return: A Discord Embed Object for the equipment of a single character
     """
+    locale = regions.get_locale()
     embed = {
-        "description": f"# [**{name}-{realm}**](https://worldofwarcraft.blizzard.com/de-de/character/eu/"
+        "description": f"# [**{name}-{realm}**](https://worldofwarcraft.blizzard.com/"
+                       f"{locale.lower().replace('_', '-')}/character/{regions.get_region()}/"
                        f"{chardict['realm']}/{chardict['name']}/)\n### Character Ilvl: {chardict['equip']['avgilvl']}",
         "color": class_to_color(chardict["class"]),
-        "thumbnail": {
-            "url": chardict["thumbnail"]
-        },
         "fields": [],
         "author": {
             "name": "GearBot"
         }
     }
+    if chardict["thumbnail"]:
+        embed["thumbnail"] = {"url": chardict["thumbnail"]}
+    if "stale" in chardict:
+        embed["footer"] = {"text": f"⚠ Die Blizzard-API ist nicht erreichbar, die Daten sind vom \
+{time.strftime('%d.%m.%Y %H:%M', time.localtime(chardict['stale']))}"}
     for item in chardict["equip"]["gear"]:
         embed["fields"].append({})
-        embed["fields"][-1]["name"] = "__**" + item["slot"] + "**__"
+        embed["fields"][-1]["name"] = "__**" + localization.slot_name(item["slottype"], locale) + "**__"
         emote = await get_item_emote(item["id"])
-        body = emote + " **" + item["name"] + " - " + str(item["ilvl"]) + " " + item["itemtrack"] + "**\n"
+        body = emote + " **" + item["name"] + " - " + str(item["ilvl"]) + " " + \
+            localization.track_label(item["itemtrack"], locale) + "**\n"
 
         if item["hassocket"]:
             for socket in item["sockets"]:
@@ -372,8 +854,8 @@ async def construct_gearembed(name: str, realm: str, chardict: dict) -> discord.
             if vz["missing"]:
                 body += f"- Fehlende Verzauberung {settings['emotes']['alert']}\n"
             else:
-                if ((item["slot"] == "Schildhand" and item["type"] in ["WEAPON", "TWOHWEAPON"])
-                        or item["slot"] != "Schildhand"):
+                if ((item["slottype"] == "OFF_HAND" and item["type"] in ["WEAPON", "TWOHWEAPON"])
+                        or item["slottype"] != "OFF_HAND"):
                     match vz["tier"]:
                         case "Tier3":
                             tieremoji = settings['emotes']['t3']
@@ -422,6 +904,20 @@ async def construct_gearembed(name: str, realm: str, chardict: dict) -> discord.
     return embed
 
 
+def get_status_field(name: str, realm: str, statuslist) -> dict:
+    """
+    Constructs a dictionary for a field in an embed from the status codes of a single character
+    :param name: Name of the Character
+    :param realm: Name of the Realm of the Character
+    :param statuslist: The status codes of the character, as returned by data_processing.get_gear_status()
+    :return: Dictionary in the format of a field in a discord embed
+    """
+    body = "🇭 🇳 🇸 🇨 🇧 🇱 🇫 🇼 🇬 🇷 🇷 🇹 🇹 🇺 🇲 🇴 🇻\n"
+    for status in statuslist:
+        body += eval_gear_status(status)
+    return {"name": f"**{name}-{realm}**", "value": body}
+
+
 async def check_gear_stats(name: str, realm: str, chardict: dict) -> dict:
     """
     Constructs a dictionary for a field in an embed containing a clear overview over the equipment of a single character
@@ -430,63 +926,46 @@ async def check_gear_stats(name: str, realm: str, chardict: dict) -> dict:
     :param chardict: A dictionary conatining information about the equipment of the Character in question
     :return: Dictionary in the format of a field in a discord embed
     """
-    field = {
-        "name": f"**{name}-{realm}**"
-    }
-    body = "🇭 🇳 🇸 🇨 🇧 🇱 🇫 🇼 🇬 🇷 🇷 🇹 🇹 🇺 🇲 🇴 🇻\n"
-    for item in chardict["equip"]["gear"]:
+    return get_status_field(name, realm, data_processing.get_gear_status(chardict["equip"]))
 
-        status = 0
-        if item["hassocket"]:
-            for socket in item["sockets"]:
-                if socket["missing"]:
-                    if status < 1:
-                        status = 1
-                else:
-                    if socket["hasgem"]:
-                        pass
-                    else:
-                        status = 2
 
-        if item["hasenchantment"]:
-            vz = item["enchantment"][0]
-            if vz["missing"]:
-                status = 2
+def collect_followed() -> dict:
+    """
+    Resolves the subscriptions to the characters they follow, a subscription to a raidlist follows the characters
+    that are in the raidlist of its guild right now
+    :return: A dictionary mapping the key of every followed character (see subscriptions.make_key()) to its "name",
+    its realm as "slug" and name, the "guild" it is polled for and the "subscribers" following it
+    """
+    followed = {}
+    for subscription in subscriptions.get_subscriptions():
+        with guilds.use(subscription["guild"]), regions.use(get_setting("region"), get_setting("locale")):
+            if subscription["target"] == "raidlist":
+                characters = [(character["name"], realmindex.get_slug(character["realm"]), character["realm"])
+                              for character in get_raidlist()]
             else:
-                if ((item["slot"] == "Schildhand" and item["type"] in ["WEAPON", "TWOHWEAPON"])
-                        or item["slot"] != "Schildhand"):
-                    if "item" in vz:
-                        if vz["tier"] == "Tier3":
-                            pass
-                        else:
-                            if status < 1:
-                                status = 1
-                    else:
-                        if vz["tier"] == "Tier3":
-                            pass
-                        else:
-                            if status < 1:
-                                status = 1
-                else:
-                    pass
+                slug = subscription["realm"]
+                characters = [(subscription["name"], slug, realmindex.get_names().get(slug, slug))]
+            for name, slug, realm in characters:
+                entry = followed.setdefault(subscriptions.make_key(regions.get_region(), name, slug), {
+                    "name": name, "slug": slug, "realm": realm, "guild": subscription["guild"], "subscribers": []
+                })
+                entry["subscribers"].append(subscription)
+    return followed
 
-        body += eval_gear_status(status)
 
-    if not chardict["equip"]["hasshield"]:
-        body += eval_gear_status(3)
-
-    match chardict["equip"]["embellishments"]:
-        case 2:
-            body += eval_gear_status(0)
-        case 1:
-            body += eval_gear_status(1)
-        case 0:
-            body += eval_gear_status(1)
-        case _:
-            pass
-    field["value"] = body
-
-    return field
+def fetch_raid_equipment(playerlist: list) -> list:
+    """
+    Gets the equipment of every character in the given list
+    :param playerlist: A list of characters as returned by get_raidlist()
+    :return: A list with the result of data_processing.get_char_equip() for every character, in the same order
+    """
+    results = []
+    for character in playerlist:
+        results.append(data_processing.get_char_equip(
+            character["name"].lower(),
+            realmindex.get_slug(character["realm"])
+        ))
+    return results
 
 
 async def gear_cmd(message):
@@ -496,7 +975,7 @@ async def gear_cmd(message):
     """
     args = message.content.split(" ")[1:]
     if len(args) == 0:
-        await message.channel.send(
+        await send_message(message.channel,
             "Der Befehl wurde falsch verwendet\n\
 Der korrekte Syntax ist\n\
 ```!gear Charactername Realmname\n\
@@ -512,14 +991,14 @@ Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben
             name = mainlist[discord_id]["name"]
             realm = mainlist[discord_id]["realm"]
         else:
-            await message.channel.send("Dieser Benutzer hat keinen eingetragenen Main-Character.")
+            await send_message(message.channel, "Dieser Benutzer hat keinen eingetragenen Main-Character.")
             return
     else:
         use_discord_id = False
         name = args[0]
         realm = " ".join(args[1:])
     if len(args) < 2 and not use_discord_id:
-        await message.channel.send(
+        await send_message(message.channel,
             "Der Befehl wurde falsch verwendet\n\
 Der korrekte Syntax ist\n\
 ```!gear Charactername Realmname\n\
@@ -527,20 +1006,71 @@ Der korrekte Syntax ist\n\
 Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben.\n\
 (z.B. \"Der Rat von Dalaran\")")
         return
-    await message.channel.send("Sammle Spielerdaten...\nDies kann kurz dauern")
     clean_name = name.lower()
-    clean_realm = "-".join(realm.split(" ")).lower().replace("'", "")
-    equip = data_processing.get_char_equip(clean_name, clean_realm)
+    clean_realm = realmindex.lookup(realm)
+    if clean_realm is None:
+        await send_message(message.channel, unknown_realm_text(realm))
+        return
+    await send_message(message.channel, "Sammle Spielerdaten...\nDies kann kurz dauern")
+    equip = await asyncio.to_thread(data_processing.get_char_equip, clean_name, clean_realm)
     try:
         int(equip)
         if equip == 404:
-            await message.channel.send(f"{name}-{realm} wurde nicht gefunden.\n\
+            await send_message(message.channel, f"{name}-{realm} wurde nicht gefunden.\n\
 Bitte überprüfe die Schreibweise des Character- und Realmnamens.")
+        else:
+            await send_message(message.channel, f"Die Blizzard-API ist gerade nicht erreichbar (Fehler {equip}).\n\
+Bitte versuche es später erneut.")
     except TypeError:
-        equip["class"] = data_processing.get_char_class(clean_name, clean_realm)
-        equip["thumbnail"] = data_processing.get_char_media(clean_name, clean_realm)["portrait"]
+        await asyncio.to_thread(add_character_details, equip, clean_name, clean_realm)
         gearembed = await construct_gearembed(name, realm, equip)
-        await message.channel.send(embed=gearembed)
+        await send_message(message.channel, embed=gearembed)
+
+
+async def run_raidcheck(channel_id: int, playerlist: list) -> tuple:
+    """
+    Fetches the equipment of every character of the raidlist without blocking the bot, and stores the result
+    :param channel_id: ID of the channel the raidcheck was requested in
+    :param playerlist: The characters of the raidlist
+    :return: A tuple of the ID of the stored run and the results for every character
+    """
+    results = await asyncio.to_thread(fetch_raid_equipment, playerlist)
+    run_id = raidcheckstore.create_run(channel_id, playerlist, results)
+    cassette.record({"type": "run", "channel": channel_id, "run_id": run_id})
+    roster = raidstats.build_roster_matrix(get_charnames_from_raidlist(playerlist), results)
+    timeline.record_check(playerlist, results, roster, guild=guilds.current_partition())
+    return run_id, results
+
+
+async def get_raidcheck(channel, playerlist: list) -> tuple:
+    """
+    Gets a raidcheck for a channel, a raidcheck that is still running in the channel is joined and one that was
+    made within the freshness window is reused, so the roster is only fetched once
+    :param channel: The channel the raidcheck was requested in
+    :param playerlist: The characters of the raidlist
+    :return: A tuple of the ID of the run and the results for every character
+    """
+    fresh = raidcheckstore.get_latest_run(channel.id, playerlist,
+                                          get_setting("raidcheckfreshness", raidcheck_freshness))
+    if fresh is not None:
+        metrics.raidcheck_runs.inc(outcome="fresh")
+        return fresh
+
+    running = inflight_raidchecks.get(channel.id)
+    if running is not None and running[0] == playerlist:
+        metrics.raidcheck_runs.inc(outcome="joined")
+        await send_message(channel, "Ein Raidcheck läuft bereits, das Ergebnis wird auch hier angezeigt.")
+        return await asyncio.shield(running[1])
+
+    metrics.raidcheck_runs.inc(outcome="fetched")
+    await send_message(channel, "Sammle Spielerdaten...\nDies kann kurz dauern")
+    task = asyncio.ensure_future(run_raidcheck(channel.id, playerlist))
+    inflight_raidchecks[channel.id] = (playerlist, task)
+    try:
+        return await asyncio.shield(task)
+    finally:
+        if inflight_raidchecks.get(channel.id, (None, None))[1] is task:
+            del inflight_raidchecks[channel.id]
 
 
 async def raidcheck_cmd(message):
@@ -549,59 +1079,46 @@ async def raidcheck_cmd(message):
     that are in the raidlist
     :param message: Message that was sent by the user
     """
+    args = message.content.split(" ")[1:]
+    sortkey = args[0].lower() if len(args) > 0 else ""
+    if sortkey != "" and sortkey not in raidstats.sort_keys:
+        await send_message(message.channel,
+            "Der Befehl wurde falsch verwendet\n\
+Der korrekte Syntax ist\n\
+```!raidcheck\n\
+!raidcheck ilvl\n\
+!raidcheck status\n\
+!raidcheck name```")
+        return
     cleanlist = get_raidlist()
     if len(cleanlist) == 0:
-        await message.channel.send("Die Spielerliste ist leer.")
+        await send_message(message.channel, "Die Spielerliste ist leer.")
         return
-    await message.channel.send("Sammle Spielerdaten...\nDies kann kurz dauern")
-    global last_raidcheck_result
-    last_raidcheck_result = []
+    run_id, results = await get_raidcheck(message.channel, cleanlist)
+    charnamelist = get_charnames_from_raidlist(cleanlist)
+    roster = raidstats.build_roster_matrix(charnamelist, results)
+    order = raidstats.sort_order(roster, sortkey)
+
     fields = []
-    embedlist = []
     pinglist = []
-    x = 0
-    for character in cleanlist:
-        name = character["name"]
-        realm = character["realm"]
-        if x == 5:
-            if len(embedlist) == 0:
-                embed = {
-                    "description": "# Raid Gear-Check",
-                    "fields": fields,
-                    "author": {
-                        "name": "Gearbot"
-                    },
-                    "color": 7929967
-                }
-            else:
-                embed = {
-                    "fields": fields,
-                    "color": 7929967
-                }
-            embedlist.append(make_embed(embed))
-            last_raidcheck_result.append(data_processing.get_char_equip(
-                                        name.lower(),
-                                        "-".join(realm.split(" ")).lower().replace("'", "")
-            ))
-            fields = [await check_gear_stats(name, realm, last_raidcheck_result[-1])]
-            if "alert" in fields[-1]["value"] and character["discordID"] != -1:
+    for row in order:
+        character = cleanlist[row]
+        if roster["valid"][row]:
+            fields.append(get_status_field(character["name"], character["realm"], roster["status"][row]))
+            if "stale" in results[row]:
+                fields[-1]["name"] += " ⚠ (veraltet)"
+            if raidstats.STATUS_ALERT in roster["status"][row] and character["discordID"] != -1:
                 pinglist.append(character["discordID"])
-            x = 1
         else:
-            last_raidcheck_result.append(data_processing.get_char_equip(
-                                        name.lower(),
-                                        "-".join(realm.split(" ")).lower().replace("'", "")
-            ))
-            fields.append(await check_gear_stats(name, realm, last_raidcheck_result[-1]))
-            if "alert" in fields[-1]["value"] and character["discordID"] != -1:
-                pinglist.append(character["discordID"])
-            x += 1
+            fields.append({"name": f"**{character['name']}-{character['realm']}**",
+                           "value": f"Daten konnten nicht abgerufen werden ({results[row]})"})
 
-    if len(fields) > 0:
+    embedlist = []
+    for start in range(0, len(fields), 5):
         if len(embedlist) == 0:
             embed = {
                 "description": "# Raid Gear-Check",
-                "fields": fields,
+                "fields": fields[start:start + 5],
                 "author": {
                     "name": "Gearbot"
                 },
@@ -609,38 +1126,378 @@ async def raidcheck_cmd(message):
             }
         else:
             embed = {
-                "fields": fields,
+                "fields": fields[start:start + 5],
                 "color": 7929967
             }
         embedlist.append(make_embed(embed))
 
-    embednum = 0
-    first = True
-    for embed in embedlist:
-        embednum += 1
-        if embednum == len(embedlist):
-            if first:
-                first = False
-                pingtext = ""
-                for discordID in pinglist:
-                    pingtext += "<@" + str(discordID) + ">"
-                await message.channel.send(pingtext,
-                                           embed=embed,
-                                           view=SelectView(
-                                               select=CharSelect(get_charnames_from_raidlist(get_raidlist()))))
+    pingtext = ""
+    for discordID in pinglist:
+        pingtext += "<@" + str(discordID) + ">"
+    for embednum, embed in enumerate(embedlist):
+        if embednum == len(embedlist) - 1:
+            view = SelectView(select=CharSelect(run_id, [cleanlist[row] for row in order]))
+            view.add_item(DetailButton(run_id, 0, "open"))
+            if embednum == 0:
+                await send_message(message.channel, pingtext, embed=embed, view=view)
             else:
-                await message.channel.send(embed=embed,
-                                           view=SelectView(
-                                               select=CharSelect(get_charnames_from_raidlist(get_raidlist()))))
+                await send_message(message.channel, embed=embed, view=view)
         else:
-            if first:
-                first = False
-                pingtext = ""
-                for discordID in pinglist:
-                    pingtext += "<@" + str(discordID) + ">"
-                await message.channel.send(pingtext, embed=embed)
+            if embednum == 0:
+                await send_message(message.channel, pingtext, embed=embed)
             else:
-                await message.channel.send(embed=embed)
+                await send_message(message.channel, embed=embed)
+
+
+async def poll_subscriptions():
+    """
+    Polls the followed characters whose turn it is, and notifies the subscribers about gear changes, until the bot
+    shuts down
+    """
+    semaphore = asyncio.Semaphore(subscription_concurrency)
+
+    async def poll(key: str, entry: dict):
+        async with semaphore:
+            with guilds.use(entry["guild"]), regions.use(get_setting("region"), get_setting("locale")):
+                result = await asyncio.to_thread(data_processing.get_char_equip, entry["name"].lower(), entry["slug"])
+        # An answer from the cache of an unreachable api says nothing about the current gear
+        if type(result) is int or "stale" in result:
+            change = subscriptions.record_poll(key, None, None)
+        else:
+            change = subscriptions.record_poll(key, data_processing.get_gear_status(result["equip"]),
+                                               result["equip"]["avgilvl"])
+        if change is not None:
+            await notify_gear_change(entry, change)
+
+    subscriptions.load()
+    while True:
+        followed = collect_followed()
+        due = subscriptions.due_keys(set(followed))
+        if len(due) != 0:
+            with tracing.trace("subscriptions", characters=len(due)):
+                outcomes = await asyncio.gather(*(poll(key, followed[key]) for key in due), return_exceptions=True)
+            for key, outcome in zip(due, outcomes):
+                if isinstance(outcome, Exception):
+                    eventlog.log("subscriptions", "Poll failed", character=key, error=repr(outcome))
+            subscriptions.save()
+        await asyncio.sleep(subscription_tick)
+
+
+async def notify_gear_change(entry: dict, change: dict):
+    """
+    Sends the change of the gear of a character to everyone following it, once per channel and user
+    :param entry: The followed character, as returned by collect_followed()
+    :param change: The change, as returned by subscriptions.record_poll()
+    """
+    name = entry["name"]
+    realm = entry["realm"]
+    before = change["before"]
+    after = change["after"]
+    text = f"# {name}-{realm}\nDie Ausrüstung hat sich geändert.\n**Ilvl:** {before['avgilvl']} → {after['avgilvl']}"
+    if after["avgilvl"] != before["avgilvl"]:
+        text += f" ({after['avgilvl'] - before['avgilvl']:+.2f})"
+    before_field = get_status_field(name, realm, before["status"])
+    before_field["name"] = "Vorher"
+    after_field = get_status_field(name, realm, after["status"])
+    after_field["name"] = "Jetzt"
+    embed = make_embed({
+        "description": text,
+        "fields": [before_field, after_field],
+        "author": {
+            "name": "Gearbot"
+        },
+        "color": 7929967
+    })
+
+    notified = set()
+    for subscription in entry["subscribers"]:
+        if subscription["channel"] is not None:
+            kind, target_id = "channel", subscription["channel"]
+        else:
+            kind, target_id = "dm", subscription["user"]
+        if (kind, target_id) in notified:
+            continue
+        notified.add((kind, target_id))
+        try:
+            if kind == "channel":
+                target = client.get_channel(target_id) or await client.fetch_channel(target_id)
+            else:
+                target = client.get_user(target_id) or await client.fetch_user(target_id)
+            await send_message(target, embed=embed)
+        except discord.HTTPException as error:
+            metrics.subscription_notifications.inc(kind=kind, outcome="failed")
+            eventlog.log("subscriptions", "Notification failed", kind=kind, target=target_id, error=str(error))
+            continue
+        metrics.subscription_notifications.inc(kind=kind, outcome="sent")
+
+
+async def get_character_argument(message, args: list, command: str) -> tuple:
+    """
+    Reads the character a command is about from its arguments, either as name and realm or as the main of a user,
+    and answers if the arguments are wrong or the realm does not exist
+    :param message: The Message that was sent by the User
+    :param args: The arguments of the command
+    :param command: The name of the command, for the correct syntax
+    :return: A tuple of the name, the name of the realm and the slug of the realm, or None if there was an answer
+    """
+    if len(args) != 0 and args[0][0] == "<":
+        mainlist = get_mains()
+        if args[0][2:-1] not in mainlist:
+            await send_message(message.channel, "Dieser Benutzer hat keinen eingetragenen Main-Character.")
+            return None
+        name = mainlist[args[0][2:-1]]["name"]
+        realm = mainlist[args[0][2:-1]]["realm"]
+    elif len(args) >= 2:
+        name = args[0]
+        realm = " ".join(args[1:])
+    else:
+        await send_message(message.channel,
+            f"Der Befehl wurde falsch verwendet\n\
+Der korrekte Syntax ist\n\
+```!{command} Charactername Realmname\n\
+!{command} @User```\n\
+Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben.\n\
+(z.B. \"Der Rat von Dalaran\")")
+        return None
+    clean_realm = realmindex.lookup(realm)
+    if clean_realm is None:
+        await send_message(message.channel, unknown_realm_text(realm))
+        return None
+    return name, realm, clean_realm
+
+
+async def follow_cmd(message):
+    """
+    Checks if the command was used correctly and if so, lets the user follow the gear changes of a character, or
+    lists what the user follows
+    :param message: The Message that was sent by the User
+    """
+    args = message.content.split(" ")[1:]
+    guild_id = message.guild.id if message.guild is not None else None
+    if len(args) == 0:
+        followed = [subscription for subscription in subscriptions.get_subscriptions(message.author.id)
+                    if subscription["guild"] == guild_id]
+        if len(followed) == 0:
+            await send_message(message.channel, "Du folgst noch keinem Charakter.\n\
+Folge einem mit folgendem Befehl:\n\
+```!follow Charactername Realmname```")
+            return
+        text = "# Gefolgte Charaktere\n\n"
+        for subscription in followed:
+            where = "per Direktnachricht" if subscription["channel"] is None else f"in <#{subscription['channel']}>"
+            if subscription["target"] == "raidlist":
+                text += f"- Raidliste ({where})\n"
+            else:
+                realm = realmindex.get_names().get(subscription["realm"], subscription["realm"])
+                text += f"- **{subscription['name']}-{realm}** ({where})\n"
+        embed = make_embed({
+            "description": text,
+            "author": {
+                "name": "Gearbot"
+            },
+            "color": 7929967
+        })
+        await send_message(message.channel, embed=embed)
+        return
+
+    character = await get_character_argument(message, args, "follow")
+    if character is None:
+        return
+    name, realm, clean_realm = character
+    if not await asyncio.to_thread(character_exists, name.lower(), clean_realm):
+        await send_message(message.channel, f"{name}-{realm} wurde nicht gefunden.\n\
+Bitte überprüfe die Schreibweise des Character- und Realmnamens.")
+        return
+    subscriptions.subscribe(message.author.id, guild_id, None, "character", name, clean_realm)
+    await send_message(message.channel, f"Du folgst nun **{name}-{realm}**. Änderungen an der Ausrüstung werden dir \
+per Direktnachricht geschickt.")
+
+
+async def unfollow_cmd(message):
+    """
+    Checks if the command was used correctly and if so, stops the user from following a character
+    :param message: The Message that was sent by the User
+    """
+    args = message.content.split(" ")[1:]
+    character = await get_character_argument(message, args, "unfollow")
+    if character is None:
+        return
+    name, realm, clean_realm = character
+    guild_id = message.guild.id if message.guild is not None else None
+    if subscriptions.unsubscribe(message.author.id, guild_id, "character", name, clean_realm):
+        await send_message(message.channel, f"Du folgst **{name}-{realm}** nicht mehr.")
+    else:
+        await send_message(message.channel, f"Du folgst **{name}-{realm}** nicht.")
+
+
+async def raidfollow_cmd(message):
+    """
+    Checks if the command was used correctly and if so, lets the user follow the gear changes of every character in
+    the raidlist, posted in the raid channel or sent as direct message
+    :param message: Message that was sent by the user
+    """
+    args = message.content.split(" ")[1:]
+    if len(args) > 1 or (len(args) == 1 and args[0].lower() != "dm"):
+        await send_message(message.channel,
+            "Der Befehl wurde falsch verwendet\n\
+Der korrekte Syntax ist\n\
+```!raidfollow\n\
+!raidfollow dm```")
+        return
+    direct = len(args) == 1
+    subscriptions.subscribe(message.author.id, message.guild.id, None if direct else message.channel.id, "raidlist")
+    if direct:
+        await send_message(message.channel, "Änderungen an der Ausrüstung der Raidliste werden dir nun per \
+Direktnachricht geschickt.")
+    else:
+        await send_message(message.channel, "Änderungen an der Ausrüstung der Raidliste werden nun hier gepostet.")
+
+
+async def raidunfollow_cmd(message):
+    """
+    Stops the user from following the raidlist
+    :param message: Message that was sent by the user
+    """
+    if subscriptions.unsubscribe(message.author.id, message.guild.id, "raidlist"):
+        await send_message(message.channel, "Du folgst der Raidliste nicht mehr.")
+    else:
+        await send_message(message.channel, "Du folgst der Raidliste nicht.")
+
+
+async def history_cmd(message):
+    """
+    Checks if the command was used correctly and if so, sends an embed with the gear timeline of the specified
+    character
+    :param message: The Message that was sent by the User
+    """
+    character = await get_character_argument(message, message.content.split(" ")[1:], "history")
+    if character is None:
+        return
+    name, realm, clean_realm = character
+
+    history = timeline.character_history(name, clean_realm)
+    if len(history) == 0:
+        await send_message(message.channel, f"Für {name}-{realm} wurde noch kein Raidcheck gespeichert.")
+        return
+
+    first = history[0]
+    last = history[-1]
+    text = f"# Verlauf von {name}-{realm}\n\n"
+    text += f"**Ilvl:** {first['avgilvl']} → {last['avgilvl']} ({last['avgilvl'] - first['avgilvl']:+.2f}) \
+seit {time.strftime('%d.%m.%Y', time.localtime(first['taken']))}\n"
+    text += f"**Fehlende Verzauberungen:** {first['enchants_missing']} → {last['enchants_missing']}\n"
+    text += f"**Verzierungen:** {first['embellishments']}/2 → {last['embellishments']}/2\n"
+    text += f"**Raidchecks:** {len(history)}\n"
+
+    text += "### Ausrüstungswechsel\n"
+    for entry in timeline.downsample(timeline.gear_changes(history)):
+        text += f"- {time.strftime('%d.%m.%Y', time.localtime(entry['taken']))}: {entry['avgilvl']} Ilvl | \
+{entry['enchants_missing']} Verz. fehlen | {entry['embellishments']}/2 Verzierungen\n"
+
+    embed = make_embed({
+        "description": text,
+        "author": {
+            "name": "Gearbot"
+        },
+        "color": 7929967
+    })
+
+    await send_message(message.channel, embed=embed)
+
+
+async def raidtrend_cmd(message):
+    """
+    Checks if the command was used correctly and if so, sends an embed with the development of the whole raid over
+    the stored raidchecks
+    :param message: Message that was sent by the user
+    """
+    args = message.content.split(" ")[1:]
+    if len(args) > 1 or (len(args) == 1 and not args[0].isdigit()):
+        await send_message(message.channel,
+            "Der Befehl wurde falsch verwendet\n\
+Der korrekte Syntax ist\n\
+```!raidtrend\n\
+!raidtrend Tage```")
+        return
+    since = time.time() - int(args[0]) * 86400 if len(args) == 1 else 0.0
+
+    trend = timeline.roster_trend(since, guild=guilds.current_partition())
+    if len(trend) == 0:
+        await send_message(message.channel, "Es wurde noch kein Raidcheck gespeichert.")
+        return
+
+    first = trend[0]
+    last = trend[-1]
+    text = "# Raid Verlauf\n\n"
+    text += f"**Durchschnittliches Ilvl:** {first['avgilvl']} → {last['avgilvl']} \
+({last['avgilvl'] - first['avgilvl']:+.2f})\n"
+    text += f"**Raidchecks:** {len(trend)} seit {time.strftime('%d.%m.%Y', time.localtime(first['taken']))}\n"
+
+    text += "### Raidchecks\n"
+    for entry in timeline.downsample(trend):
+        text += f"- {time.strftime('%d.%m.%Y', time.localtime(entry['taken']))}: {entry['avgilvl']} Ilvl | \
+{entry['enchants_missing']} Verz. fehlen | {entry['embellished']}/{entry['characters']} mit 2 Verzierungen\n"
+
+    embed = make_embed({
+        "description": text,
+        "author": {
+            "name": "Gearbot"
+        },
+        "color": 7929967
+    })
+
+    await send_message(message.channel, embed=embed)
+
+
+async def raidstats_cmd(message):
+    """
+    Sends an embed with statistics over the whole raidlist, based on the last raidcheck if there is one
+    :param message: Message that was sent by the user
+    """
+    playerlist = get_raidlist()
+    if len(playerlist) == 0:
+        await send_message(message.channel, "Die Spielerliste ist leer.")
+        return
+    results = raidcheckstore.get_latest_results(message.channel.id, playerlist)
+    if results is None:
+        await send_message(message.channel, "Sammle Spielerdaten...\nDies kann kurz dauern")
+        results = await asyncio.to_thread(fetch_raid_equipment, playerlist)
+    roster = raidstats.build_roster_matrix(get_charnames_from_raidlist(playerlist), results)
+    summary = raidstats.summarize_roster(roster)
+
+    text = "# Raid Statistik\n\n"
+    text += f"**Charaktere:** {summary['characters']}"
+    if len(summary["failed"]) > 0:
+        text += f" ({len(summary['failed'])} nicht abrufbar: {', '.join(summary['failed'])})"
+    text += f"\n**Durchschnittliches Ilvl:** {summary['avgilvl']} | **Median:** {summary['medianilvl']}\n"
+    text += f"**Niedrigstes Ilvl:** {summary['minilvl']} | **Höchstes Ilvl:** {summary['maxilvl']}\n"
+
+    text += f"### Fehlende Verzauberungen: {summary['missing_enchants_total']}\n"
+    for slot, count in summary["missing_enchants"].items():
+        text += f"- {slot}: {count}\n"
+
+    text += f"### Sockel\n- Fehlende Steine: {summary['missing_gems_total']} \
+(bei {summary['characters_missing_gems']} Charakteren)\n"
+    text += f"- Fehlende Sockel: {summary['missing_sockets_total']}\n"
+
+    embellishments = summary["embellishments"]
+    text += f"### Verzierungen\n- **(2/2):** {embellishments[2]} | **(1/2):** {embellishments[1]} | \
+**(0/2):** {embellishments[0]} ({round(summary['embellishment_coverage'] * 100)}% vollständig)\n"
+
+    if len(summary["worst_offenders"]) > 0:
+        text += "### Größte Baustellen\n"
+        for charname, score in summary["worst_offenders"]:
+            text += f"- **{charname}** ({score})\n"
+
+    embed = make_embed({
+        "description": text,
+        "author": {
+            "name": "Gearbot"
+        },
+        "color": 7929967
+    })
+
+    await send_message(message.channel, embed=embed)
 
 
 async def raidadd_cmd(message):
@@ -650,15 +1507,19 @@ async def raidadd_cmd(message):
     """
     args = message.content.split(" ")[1:]
     if len(args) == 0:
-        await message.channel.send(
+        await send_message(message.channel,
             "Der Befehl wurde falsch verwendet\n\
 Der korrekte Syntax ist\n\
 ```!raidadd Charactername Realmname\n\
 !raidadd @User\n\
-!raidadd @User Charactername Realmname```\n\
+!raidadd @User Charactername Realmname\n\
+!raidadd Charactername Realmname, Charactername Realmname```\n\
 Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben.\n\
 (z.B. \"Der Rat von Dalaran\")")
         return
+    if "," in message.content:
+        await raidadd_many(message, message.content.split(" ", 1)[1].split(","))
+        return
     if args[0][0] == "<":
         use_discord_id = True
         discord_id = args[0][2:-1]
@@ -668,15 +1529,16 @@ Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben
                 name = mainlist[discord_id]["name"]
                 realm = mainlist[discord_id]["realm"]
             else:
-                await message.channel.send("Dieser User hat keinen eingetragenen Main-Charakter")
+                await send_message(message.channel, "Dieser User hat keinen eingetragenen Main-Charakter")
                 return
         else:
             if len(args) < 3:
-                await message.channel.send(
+                await send_message(message.channel,
                     "Der Befehl wurde falsch verwendet\n\
 Der korrekte Syntax ist\n\
 ```!raidadd Charactername Realmname\n\
-!raidadd @User\n!raidadd @User Charactername Realmname```\n\
+!raidadd @User\n!raidadd @User Charactername Realmname\n\
+!raidadd Charactername Realmname, Charactername Realmname```\n\
 Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben.\n\
 (z.B. \"Der Rat von Dalaran\")")
                 return
@@ -685,11 +1547,12 @@ Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben
     else:
         use_discord_id = False
         if len(args) < 2:
-            await message.channel.send(
+            await send_message(message.channel,
                 "Der Befehl wurde falsch verwendet\n\
 Der korrekte Syntax ist\n\
 ```!raidadd Charactername Realmname\n\
-!raidadd @User\n!raidadd @User Charactername Realmname```\n\
+!raidadd @User\n!raidadd @User Charactername Realmname\n\
+!raidadd Charactername Realmname, Charactername Realmname```\n\
 Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben.\n\
 (z.B. \"Der Rat von Dalaran\")")
             return
@@ -697,10 +1560,13 @@ Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben
         name = args[0]
         realm = " ".join(args[1:])
     clean_name = name.lower()
-    clean_realm = "-".join(realm.split(" ")).lower().replace("'", "")
+    clean_realm = realmindex.lookup(realm)
+    if clean_realm is None:
+        await send_message(message.channel, unknown_realm_text(realm))
+        return
 
-    if not character_exists(clean_name, clean_realm):
-        await message.channel.send(f"{name}-{realm} wurde nicht gefunden.\n\
+    if not await asyncio.to_thread(character_exists, clean_name, clean_realm):
+        await send_message(message.channel, f"{name}-{realm} wurde nicht gefunden.\n\
 Bitte überprüfe die Schreibweise des Character- und Realmnamens.")
         return
 
@@ -708,20 +1574,114 @@ Bitte überprüfe die Schreibweise des Character- und Realmnamens.")
 
     for character in playerlist:
         if name == character["name"] and realm == character["realm"]:
-            await message.channel.send(f"{name}-{realm} ist bereits in der Liste")
+            await send_message(message.channel, f"{name}-{realm} ist bereits in der Liste")
             return
 
     if use_discord_id:
         member = await get_member(message.guild, int(discord_id))
-        await add_role(message.guild, member, settings["raidrolle"])
+        await add_role(message.guild, member, get_setting("raidrolle"))
 
-    if character_exists(clean_name, clean_realm):
-        playerlist.append({"name": name, "realm": realm, "discord_id": discord_id})
-        save_raidlist(playerlist)
-        await message.channel.send(f"{name}-{realm} wurde der Raidliste hinzugefügt")
-    else:
-        await message.channel.send(f"""{name}-{realm} wurde nicht gefunden.\n
-            Bitte überprüfe die Schreibweise des Character- und Realmnamens.""")
+    playerlist.append({"name": name, "realm": realm, "discordID": discord_id})
+    save_raidlist(playerlist)
+    await send_message(message.channel, f"{name}-{realm} wurde der Raidliste hinzugefügt")
+
+
+async def raidadd_many(message, entries: list):
+    """
+    Adds every character of a list of entries to the raidlist, the characters are validated concurrently
+    :param message: Message that was sent by the user
+    :param entries: The entries of the message, each in the format "[@User] Charactername Realmname"
+    """
+    characters = []
+    requests_args = []
+    errors = []
+    for entry in entries:
+        tokens = entry.split()
+        discord_id = -1
+        if len(tokens) != 0 and tokens[0][0] == "<":
+            discord_id = tokens[0][2:-1]
+            tokens = tokens[1:]
+        if len(tokens) < 2:
+            errors.append(f"\"{entry.strip()}\" konnte nicht gelesen werden.")
+            continue
+        name = tokens[0]
+        realm = " ".join(tokens[1:])
+        clean_realm = realmindex.lookup(realm)
+        if clean_realm is None:
+            errors.append(unknown_realm_text(realm))
+            continue
+        characters.append({"name": name, "realm": realm, "discordID": discord_id})
+        requests_args.append((name.lower(), clean_realm))
+
+    exists = await validate_characters(requests_args)
+    found = [character for character, valid in zip(characters, exists) if valid]
+    notfound = [character for character, valid in zip(characters, exists) if not valid]
+    added, duplicates = add_to_raidlist(found)
+
+    for character in added:
+        if character["discordID"] != -1:
+            member = await get_member(message.guild, int(character["discordID"]))
+            await add_role(message.guild, member, get_setting("raidrolle"))
+
+    await send_message(message.channel, raidadd_report(added, duplicates, notfound, errors))
+
+
+async def raidimport_cmd(message):
+    """
+    Checks if the command was used correctly and if so, adds the members of a guild to the raidlist
+    :param message: Message that was sent by the user
+    """
+    args = message.content.split(" ")[1:]
+    max_rank = None
+    min_level = get_setting("importlevel", import_min_level)
+    for arg in list(args):
+        option, _, value = arg.partition("=")
+        if option.lower() in ["rang", "level"] and value.isdigit():
+            if option.lower() == "rang":
+                max_rank = int(value)
+            else:
+                min_level = int(value)
+            args.remove(arg)
+    if len(args) < 2:
+        await send_message(message.channel,
+            "Der Befehl wurde falsch verwendet\n\
+Der korrekte Syntax ist\n\
+```!raidimport Gildenname Realmname\n\
+!raidimport Gildenname Realmname rang=3 level=80```\n\
+Bei Gilden mit mehreren Wörtern, bitte die Wörter mit \"-\" verbinden (z.B. \"Die-Gilde\").\n\
+Mit rang werden nur Mitglieder bis zu diesem Gildenrang (0 ist der Gildenmeister) übernommen, mit level nur \
+Mitglieder ab diesem Level.")
+        return
+    guild = args[0].lower()
+    realm = " ".join(args[1:])
+    clean_realm = realmindex.lookup(realm)
+    if clean_realm is None:
+        await send_message(message.channel, unknown_realm_text(realm))
+        return
+
+    await send_message(message.channel, "Lade Gildenliste...\nDies kann kurz dauern")
+    roster = await asyncio.to_thread(data_processing.get_guild_roster, guild, clean_realm)
+    if type(roster) is int:
+        if roster == 404:
+            await send_message(message.channel, f"Die Gilde {args[0]}-{realm} wurde nicht gefunden.")
+        else:
+            await send_message(message.channel, f"Die Gildenliste konnte nicht abgerufen werden ({roster})")
+        return
+
+    candidates = [member for member in roster
+                  if member["level"] >= min_level and (max_rank is None or member["rank"] <= max_rank)]
+    if len(candidates) == 0:
+        await send_message(message.channel, "Kein Mitglied der Gilde erfüllt die Bedingungen.")
+        return
+
+    exists = await validate_characters([(member["name"].lower(), member["slug"]) for member in candidates])
+    characters = [{"name": member["name"], "realm": realmindex.get_names().get(member["slug"], member["slug"]),
+                   "discordID": -1} for member in candidates]
+    found = [character for character, valid in zip(characters, exists) if valid]
+    notfound = [character for character, valid in zip(characters, exists) if not valid]
+    added, duplicates = add_to_raidlist(found)
+
+    await send_message(message.channel, raidadd_report(added, duplicates, notfound))
 
 
 async def raidremove_cmd(message):
@@ -731,7 +1691,7 @@ async def raidremove_cmd(message):
     """
     args = message.content.split(" ")[1:]
     if len(args) == 0:
-        await message.channel.send(
+        await send_message(message.channel,
             "Der Befehl wurde falsch verwendet\n\
 Der korrekte Syntax ist\n\
 ```!rairemove Charactername Realmname\n\
@@ -745,13 +1705,13 @@ Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben
         use_discord_id = True
         discord_id = args[0][2:-1]
         for character in playerlist:
-            if discord_id == character["discord_id"]:
+            if discord_id == character["discordID"]:
                 deletelist.append(character)
         member = await get_member(message.guild, int(discord_id))
-        await remove_role(message.guild, member, settings["raidrolle"])
+        await remove_role(message.guild, member, get_setting("raidrolle"))
     else:
         if len(args) < 2:
-            await message.channel.send(
+            await send_message(message.channel,
                 "Der Befehl wurde falsch verwendet\n\
 Der korrekte Syntax ist\n\
 ```!rairemove Charactername Realmname\n\
@@ -766,26 +1726,26 @@ Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben
         for character in playerlist:
             if name.lower() == character["name"].lower() and realm.lower() == character["realm"].lower():
                 deletelist.append(character)
-                if character["discord_id"] != -1:
+                if character["discordID"] != -1:
                     isconnected = True
-                    discord_id = character["discord_id"]
+                    discord_id = character["discordID"]
     if len(deletelist) == 0:
         if use_discord_id:
-            await message.channel.send(f"<@{discord_id}> hat keine Charactere in der Liste")
+            await send_message(message.channel, f"<@{discord_id}> hat keine Charactere in der Liste")
         else:
-            await message.channel.send(f"{name}-{realm} ist nicht in der Liste")
+            await send_message(message.channel, f"{name}-{realm} ist nicht in der Liste")
         return
     for character in deletelist:
-        await message.channel.send(f"{character['name']}-{character['realm']} wurde aus der Raidliste entfernt")
+        await send_message(message.channel, f"{character['name']}-{character['realm']} wurde aus der Raidliste entfernt")
         playerlist.remove(character)
     if not use_discord_id and isconnected:
         stillin = False
         for character in playerlist:
-            if discord_id == character["discord_id"]:
+            if discord_id == character["discordID"]:
                 stillin = True
         if not stillin:
             member = await get_member(message.guild, int(discord_id))
-            await remove_role(message.guild, member, settings["raidrolle"])
+            await remove_role(message.guild, member, get_setting("raidrolle"))
     save_raidlist(playerlist)
 
 
@@ -818,7 +1778,7 @@ async def raidlist_cmd(message):
         "color": 7929967
     })
 
-    await message.channel.send(embed=embed)
+    await send_message(message.channel, embed=embed)
 
 
 async def main_cmd(message):
@@ -831,16 +1791,16 @@ async def main_cmd(message):
     mainlist = get_mains()
     if len(args) == 0:
         if discord_id in mainlist:
-            await message.channel.send(f"Dein Main ist \
+            await send_message(message.channel, f"Dein Main ist \
 **{mainlist[discord_id]["name"]}-{mainlist[discord_id]["realm"]}**")
             return
         else:
-            await message.channel.send("Du hast noch keinen eigetragenen Main.\n\
+            await send_message(message.channel, "Du hast noch keinen eigetragenen Main.\n\
                                        Setze ihn jetzt mit folgendem Befehl:\n\
                                        ```!main Charactername Realmname```")
             return
     if len(args) < 2:
-        await message.channel.send(
+        await send_message(message.channel,
             "Der Befehl wurde falsch verwendet\n\
 Der korrekte Syntax ist\n\
 ```!main Charactername Realmname```\n\
@@ -850,9 +1810,12 @@ Bei Realms mit mehreren Wörtern, bitte alle mit Leerzeichen separiert schreiben
     name = args[0]
     realm = " ".join(args[1:])
     clean_name = name.lower()
-    clean_realm = "-".join(realm.split(" ")).lower().replace("'", "")
-    if not character_exists(clean_name, clean_realm):
-        await message.channel.send(f"{name}-{realm} wurde nicht gefunden.\n\
+    clean_realm = realmindex.lookup(realm)
+    if clean_realm is None:
+        await send_message(message.channel, unknown_realm_text(realm))
+        return
+    if not await asyncio.to_thread(character_exists, clean_name, clean_realm):
+        await send_message(message.channel, f"{name}-{realm} wurde nicht gefunden.\n\
 Bitte überprüfe die Schreibweise des Character- und Realmnamens.")
         return
     mainlist = get_mains()
@@ -860,7 +1823,7 @@ Bitte überprüfe die Schreibweise des Character- und Realmnamens.")
     mainlist[discord_id]["name"] = name
     mainlist[discord_id]["realm"] = realm
     save_mains(mainlist)
-    await message.channel.send(f"**{name}-{realm}** ist nun dein Main")
+    await send_message(message.channel, f"**{name}-{realm}** ist nun dein Main")
 
 
 async def mainlist_cmd(message):
@@ -874,8 +1837,9 @@ async def mainlist_cmd(message):
     if len(playerlist) == 0:
         text += "Die Liste ist aktuell leer"
 
+    usernames = await memberdirectory.get_display_names(message.guild, list(playerlist))
     for discordID, character in playerlist.items():
-        username = await get_username(message.guild, discordID)
+        username = usernames[discordID]
         text += f"_{username}_ | **{character['name']}-{character['realm']}**\n"
 
     embed = make_embed({
@@ -886,7 +1850,167 @@ async def mainlist_cmd(message):
         "color": 13414813
     })
 
-    await message.channel.send(embed=embed)
+    await send_message(message.channel, embed=embed)
+
+
+async def stats_cmd(message):
+    """
+    Sends an embed with the metrics of the bot, only administrators may use this command
+    :param message: Message that was sent by the user
+    """
+    permissions = getattr(message.author, "guild_permissions", None)
+    if permissions is None or not permissions.administrator:
+        await send_message(message.channel, "Dieser Befehl ist nur für Administratoren verfügbar.")
+        return
+
+    text = "# Statistiken\n"
+    text += "### Befehle\n"
+    for labels in metrics.command_latency.labelsets():
+        text += f"- **{labels['command']}**: {metrics.command_latency.count(**labels)} Aufrufe | \
+p50 {metrics.command_latency.quantile(0.5, **labels):.2f}s | \
+p95 {metrics.command_latency.quantile(0.95, **labels):.2f}s\n"
+
+    text += "### Blizzard-API\n"
+    for labels in metrics.blizzard_requests.labelsets():
+        text += f"- {labels['endpoint']} ({labels['status']}): {int(metrics.blizzard_requests.get(**labels))}\n"
+    tokens = sum(metrics.token_fetches.get(**labels) for labels in metrics.token_fetches.labelsets())
+    text += f"- Tokenabrufe: {int(tokens)}\n"
+
+    text += "### Caches\n"
+    caches = sorted({labels["cache"] for labels in metrics.cache_requests.labelsets()})
+    for cache in caches:
+        hits = int(metrics.cache_requests.get(cache=cache, outcome="hit"))
+        misses = int(metrics.cache_requests.get(cache=cache, outcome="miss"))
+        text += f"- {cache}: {round(metrics.cache_hit_ratio(cache) * 100)}% Treffer ({hits}/{hits + misses})\n"
+
+    reads = sum(metrics.store_operations.get(**labels) for labels in metrics.store_operations.labelsets()
+                if labels["operation"] == "read")
+    writes = sum(metrics.store_operations.get(**labels) for labels in metrics.store_operations.labelsets()
+                 if labels["operation"] == "write")
+    text += "### Event-Loop\n"
+    text += f"- Verzögerung: p50 {metrics.event_loop_lag.quantile(0.5) * 1000:.0f}ms | \
+p99 {metrics.event_loop_lag.quantile(0.99) * 1000:.0f}ms | Blockiert: {int(metrics.event_loop_stalls.get())}x\n"
+    text += f"- Gateway-Latenz: {metrics.gateway_latency.get() * 1000:.0f}ms\n"
+
+    text += "### Sonstiges\n"
+    text += f"- Server: {len(client.guilds)} | Shards: {client.shard_count}\n"
+    text += f"- Hochgeladene Emotes: {int(metrics.emoji_uploads.get())}\n"
+    text += f"- Dateizugriffe: {int(reads)} gelesen | {int(writes)} geschrieben\n"
+
+    embed = make_embed({
+        "description": text,
+        "author": {
+            "name": "Gearbot"
+        },
+        "color": 7929967
+    })
+
+    await send_message(message.channel, embed=embed)
+
+
+async def profile_cmd(message):
+    """
+    Checks if the command was used correctly and if so, profiles the next invocations of a command, only
+    administrators may use this command
+    :param message: Message that was sent by the user
+    """
+    permissions = getattr(message.author, "guild_permissions", None)
+    if permissions is None or not permissions.administrator:
+        await send_message(message.channel, "Dieser Befehl ist nur für Administratoren verfügbar.")
+        return
+
+    args = message.content.split(" ")[1:]
+    if len(args) == 0:
+        if len(profiling.armed) == 0:
+            await send_message(message.channel, "Es werden keine Befehle profiliert.")
+        else:
+            await send_message(message.channel, "Profiliert werden: " + ", ".join(
+                f"!{command} ({entry['remaining']}x)" for command, entry in profiling.armed.items()))
+        return
+    if args[0] == "aus":
+        profiling.disarm(args[1].removeprefix("!") if len(args) > 1 else None)
+        await send_message(message.channel, "Das Profiling wurde beendet.")
+        return
+    if len(args) > 2 or (len(args) == 2 and not args[1].isdigit()):
+        await send_message(message.channel,
+            "Der Befehl wurde falsch verwendet\n\
+Der korrekte Syntax ist\n\
+```!profile\n\
+!profile Befehl\n\
+!profile Befehl Anzahl\n\
+!profile aus```")
+        return
+    command = args[0].removeprefix("!")
+    count = int(args[1]) if len(args) == 2 else 1
+    profiling.arm(command, count, message.channel)
+    await send_message(message.channel, f"Die nächsten {count} Aufrufe von !{command} werden profiliert.")
+
+
+def cooldown_remaining(user_id: int, command: str) -> float:
+    """
+    Checks if a user has to wait before using a command again, and starts the cooldown if not
+    :param user_id: ID of the user that used the command
+    :param command: Name of the command
+    :return: The seconds the user still has to wait, 0 if the command can be used
+    """
+    cooldowns = get_setting("cooldowns", default_cooldowns)
+    cooldown = cooldowns.get(command, 0)
+    if cooldown <= 0:
+        return 0
+    now = time.monotonic()
+    used = last_used.get((user_id, command))
+    if used is not None and now - used < cooldown:
+        return cooldown - (now - used)
+    last_used[(user_id, command)] = now
+    for key in [key for key, used in last_used.items() if now - used > max(cooldowns.values())]:
+        del last_used[key]
+    return 0
+
+
+def get_command_handler(message):
+    """
+    Looks up which command was used in a message
+    :param message: The message that was sent
+    :return: The function handling the command, or None if the message does not contain a command for its channel
+    """
+    if message.content.startswith('!stats'):
+        return stats_cmd
+    if message.content.startswith('!profile'):
+        return profile_cmd
+    if message.channel.id == get_setting("gearbotchannel"):
+        if message.content.startswith('!gear'):
+            return gear_cmd
+        elif message.content.startswith('!history'):
+            return history_cmd
+        elif message.content.startswith('!follow'):
+            return follow_cmd
+        elif message.content.startswith('!unfollow'):
+            return unfollow_cmd
+    elif message.channel.id == get_setting("raidchannel"):
+        if message.content.startswith('!raidcheck'):
+            return raidcheck_cmd
+        elif message.content.startswith('!raidstats'):
+            return raidstats_cmd
+        elif message.content.startswith('!raidtrend'):
+            return raidtrend_cmd
+        elif message.content.startswith('!raidadd'):
+            return raidadd_cmd
+        elif message.content.startswith('!raidimport'):
+            return raidimport_cmd
+        elif message.content.startswith('!raidremove'):
+            return raidremove_cmd
+        elif message.content.startswith('!raidlist'):
+            return raidlist_cmd
+        elif message.content.startswith('!raidfollow'):
+            return raidfollow_cmd
+        elif message.content.startswith('!raidunfollow'):
+            return raidunfollow_cmd
+    elif message.channel.id == get_setting("mainschannel"):
+        if message.content.startswith('!main') and not message.content.startswith('!mainlist'):
+            return main_cmd
+        elif message.content.startswith('!mainlist'):
+            return mainlist_cmd
+    return None
 
 
 #
@@ -898,7 +2022,18 @@ async def on_ready():
     """
     Gets executed when the Bot is ready to operate
     """
-    print(f'Ready')
+    global subscription_task
+    if startup_started is not None:
+        startup_time = time.perf_counter() - startup_started
+        metrics.startup_duration.set(startup_time)
+        print(f'Ready after {startup_time:.2f}s')
+    else:
+        print(f'Ready')
+    watchdog.lag_threshold = settings.get("lagthreshold", watchdog.lag_threshold)
+    watchdog.start(client)
+    settingswatch.start()
+    if subscription_task is None:
+        subscription_task = asyncio.get_running_loop().create_task(poll_subscriptions())
 
 
 @client.event
@@ -909,30 +2044,46 @@ async def on_message(message):
     """
     if message.author == client.user:
         return
-    if message.channel.id == settings["gearbotchannel"]:
-        if message.content.startswith('!gear'):
-            await gear_cmd(message)
-            return
-    elif message.channel.id == settings["raidchannel"]:
-        if message.content.startswith('!raidcheck'):
-            await raidcheck_cmd(message)
-            return
-        elif message.content.startswith('!raidadd'):
-            await raidadd_cmd(message)
-            return
-        elif message.content.startswith('!raidremove'):
-            await raidremove_cmd(message)
-            return
-        elif message.content.startswith('!raidlist'):
-            await raidlist_cmd(message)
-            return
-    elif message.channel.id == settings["mainschannel"]:
-        if message.content.startswith('!main') and not message.content.startswith('!mainlist'):
-            await main_cmd(message)
-            return
-        elif message.content.startswith('!mainlist'):
-            await mainlist_cmd(message)
-            return
+    with guilds.use(message.guild.id if message.guild is not None else None):
+        with regions.use(get_setting("region"), get_setting("locale")):
+            await handle_command(message)
+
+
+async def handle_command(message):
+    """
+    Runs the command used in a message, if there is one for its channel
+    :param message: The message that was sent
+    """
+    handler = get_command_handler(message)
+    if handler is None:
+        return
+    command = handler.__name__.removesuffix("_cmd")
+    cassette.record_message(message)
+    remaining = cooldown_remaining(message.author.id, command)
+    if remaining > 0:
+        metrics.command_cooldowns.inc(command=command)
+        await send_message(message.channel, f"Bitte warte noch {remaining:.0f} Sekunden, bevor du !{command} erneut \
+verwendest.")
+        return
+    with tracing.trace(command, user=message.author.id, channel=message.channel.id):
+        with metrics.command_latency.time(command=command):
+            if command in profiling.armed:
+                report_channel = profiling.armed[command]["channel"]
+                paths = await profiling.run_profiled(command, handler(message))
+                if report_channel is not None and len(paths) != 0:
+                    await send_message(report_channel, f"Profil von !{command}",
+                                       files=[discord.File(path) for path in paths])
+            else:
+                await handler(message)
+
+
+@client.event
+async def on_member_join(member):
+    """
+    Gets executed when a member joins
+    :param member: The member that joined
+    """
+    memberdirectory.forget_missing(member.guild.id, member.id)
 
 
 @client.event
@@ -941,17 +2092,135 @@ async def on_member_remove(member):
     Gets executed when a member leaves
     :param member:
     """
-    remove_main(member.id)
-    remove_raid(member.id)
+    with guilds.use(member.guild.id), regions.use(get_setting("region"), get_setting("locale")):
+        remove_main(member.id)
+        remove_raid(member.id)
+
+
+@client.event
+async def on_guild_role_create(role):
+    """
+    Gets executed when a role is created
+    :param role: The role that was created
+    """
+    memberdirectory.role_changed(role.guild.id)
+
+
+def get_snapshot_file() -> str:
+    """
+    :return: The path of the warm-start snapshot, every process that runs only some of the shards has its own
+    """
+    snapshot_file = settings.get("snapshotfile", "warmstart.json.gz")
+    if client.shard_ids is None:
+        return snapshot_file
+    name, extension = snapshot_file.split(".", 1) if "." in snapshot_file else (snapshot_file, "")
+    return f"{name}-shards-{'-'.join(str(shard_id) for shard_id in client.shard_ids)}.{extension}".rstrip(".")
+
+
+def configure_shards():
+    """
+    Sets the shards this process runs, all of them unless the environment variable GEARBOT_SHARDS lists some, e.g.
+    "0,1", in which case the setting "shardcount" has to give the total number of shards of all processes
+    """
+    if "shardcount" in settings:
+        client.shard_count = settings["shardcount"]
+    if "GEARBOT_SHARDS" in os.environ:
+        if client.shard_count is None:
+            print("GEARBOT_SHARDS is ignored because the setting shardcount is missing, running all shards")
+            return
+        client.shard_ids = [int(shard_id) for shard_id in os.environ["GEARBOT_SHARDS"].split(",")]
+        print(f"Running shards {client.shard_ids} of {client.shard_count}")
+
+
+def warm_start():
+    """
+    Loads the warm-start snapshot and the files that are kept in memory, so the first commands don't start cold
+    """
+    snapshot_file = get_snapshot_file()
+    with metrics.startup_phase.time(phase="snapshot"):
+        restored = snapshot.load_snapshot(snapshot_file)
+    if len(restored) > 0:
+        print(f"Warm start: {restored['responses']} api responses restored, token restored: {restored['token']}")
+        raidcheckstore.import_latest(restored["raidchecks"])
+    with metrics.startup_phase.time(phase="itemicons"):
+        with item_icon_lock:
+            get_item_icon_ids()
+    with metrics.startup_phase.time(phase="realmindex"):
+        for region in get_regions():
+            realmindex.ensure_index(region)
+    with metrics.startup_phase.time(phase="raidchecks"):
+        raidcheckstore.prune()
+    with metrics.startup_phase.time(phase="sharedcache"):
+        sharedcache.prune("response", blizzapi.stale_ttl)
+
+
+def get_cassette_header() -> dict:
+    """
+    :return: The state a replay of a cassette has to start from
+    """
+    guild_state = {}
+    for guild_id in guilds.partitions:
+        with guilds.use(guild_id):
+            guild_state[str(guild_id)] = {"raidlist": get_raidlist(), "mains": get_mains()}
+    with item_icon_lock:
+        itemiconids = dict(get_item_icon_ids())
+    return {
+        "settings": settings,
+        "raidlist": get_raidlist(),
+        "mains": get_mains(),
+        "guilds": guild_state,
+        "itemiconids": itemiconids,
+        "realms": {region: [{"name": name, "slug": slug} for slug, name in index.names.items()]
+                   for region, index in realmindex.indexes.items()}
+    }
 
 
-f = open("token.txt", "r")
-token = f.read()
-f.close()
+def main():
+    """
+    Starts the bot and blocks until it is shut down
+    """
+    global settings, startup_started
+    startup_started = time.perf_counter()
+
+    with metrics.startup_phase.time(phase="settings"):
+        f = open("token.txt", "r")
+        token = f.read()
+        f.close()
+        settings = load_settings()
+    print(settings["branch"])
+    if "metricsport" in settings:
+        metrics.serve(settings["metricsport"])
+    tracing.slow_threshold = settings.get("slowcommandthreshold", tracing.slow_threshold)
+    tracing.trace_file = settings.get("tracefile")
+    eventlog.log_file = settings.get("logfile")
+    eventlog.sample_rates.update(settings.get("logsampling", {}))
+    eventlog.rate_limits.update(settings.get("lograte", {}))
+    guilds.configure(settings.get("guilds", {}))
+    sharedcache.database_file = settings.get("sharedcache")
+    configure_shards()
+    print(discord.__version__ + " - " + discord.version_info.releaselevel)
+
+    warm_start()
+    client.add_dynamic_items(CharSelect, DetailButton, DetailJump)
+    settingswatch.add_listener(apply_settings)
+    if "GEARBOT_PROFILE" in os.environ:
+        profiling.arm_from_environment(os.environ["GEARBOT_PROFILE"])
+    cassette_file = os.environ.get("GEARBOT_CASSETTE", settings.get("cassette"))
+    if cassette_file:
+        cassette.start_recording(cassette_file, get_cassette_header())
+        print(f"Recording cassette to {cassette_file}")
+    print(f"Startup before login took {time.perf_counter() - startup_started:.2f}s")
+
+    try:
+        client.run(token)
+    finally:
+        cassette.stop_recording()
+        settingswatch.stop()
+        settingswatch.check()
+        save_settings(settings)
+        snapshot.save_snapshot(get_snapshot_file(), raidcheckstore.export_latest())
+        eventlog.stop()
 
-settings = load_settings()
-print(settings["branch"])
-print(discord.__version__ + " - " + discord.version_info.releaselevel)
 
-client.run(token)
-save_settings(settings)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+eventlog
+~~~~~~~~~~~~
+
+This module implements the structured log of the bot.
+Records are dictionaries of fields (the command, the character, the api endpoint, the status, the duration, the
+cache outcome ...) that are put into a queue on the calling thread and written as JSON lines by a background
+thread, so logging never waits for the terminal or the disk. Every category of records can be sampled and rate
+limited, records that are dropped that way are only counted, and the next record of the category that is written
+says how many were suppressed before it.
+
+"""
+
+import atexit
+import contextvars
+import json
+import queue
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+import tracing
+
+log_file = None
+# The stream records are written to while no log_file is set, stdout if None
+log_stream = None
+queue_size = 10000
+batch_size = 500
+
+# The fraction of records of a category that is written, categories that are not listed are written completely
+sample_rates = {"cache": 0.1}
+# The maximum number of records of a category written per second, categories that are not listed are unlimited
+rate_limits = {"api": 50, "cache": 20, "data": 1}
+
+records = queue.Queue(queue_size)
+bound_fields = contextvars.ContextVar("bound_fields", default={})
+buckets = {}
+suppressed = {}
+lock = threading.Lock()
+writer = None
+
+
+class TokenBucket:
+    def __init__(self, rate: float):
+        """
+        Allows up to rate events per second, with bursts of up to rate events
+        :param rate: The number of events per second
+        """
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        """
+        :return: Whether an event is allowed right now, must be called while holding the lock
+        """
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def current_command() -> str:
+    """
+    :return: The name of the trace the caller runs in, usually the command, or None outside of a trace
+    """
+    current = tracing.current_span.get()
+    if current is None:
+        return None
+    while current.parent is not None:
+        current = current.parent
+    return current.name
+
+
+@contextmanager
+def bind(**fields):
+    """
+    Adds fields to every record logged inside the with-statement, in the same task or thread
+    :param fields: The fields to add, e.g. character="name-realm"
+    """
+    token = bound_fields.set(dict(bound_fields.get(), **fields))
+    try:
+        yield
+    finally:
+        bound_fields.reset(token)
+
+
+def admit(category: str) -> bool:
+    """
+    Decides if a record of a category is written, counting the records that are not
+    :param category: The category of the record
+    :return: Whether the record is written
+    """
+    rate = sample_rates.get(category, 1.0)
+    if rate < 1.0 and random.random() >= rate:
+        metrics.log_records.inc(category=category, outcome="sampled")
+        return False
+    limit = rate_limits.get(category)
+    if limit is None:
+        return True
+    with lock:
+        bucket = buckets.get(category)
+        if bucket is None or bucket.rate != limit:
+            bucket = buckets[category] = TokenBucket(limit)
+        if bucket.take():
+            return True
+        suppressed[category] = suppressed.get(category, 0) + 1
+    metrics.log_records.inc(category=category, outcome="limited")
+    return False
+
+
+def log(category: str, message: str = None, **fields):
+    """
+    Logs a record without waiting for it to be written
+    :param category: The category of the record, e.g. "api"
+    :param message: A description for humans, if the fields are not enough
+    :param fields: The fields of the record
+    """
+    if not admit(category):
+        return
+    record = {"time": round(time.time(), 3), "category": category}
+    command = current_command()
+    if command is not None:
+        record["command"] = command
+    record.update(bound_fields.get())
+    record.update(fields)
+    if message is not None:
+        record["message"] = message
+    if category in suppressed:
+        with lock:
+            record["suppressed"] = suppressed.pop(category, 0)
+    if writer is None:
+        start()
+    try:
+        records.put_nowait(record)
+    except queue.Full:
+        metrics.log_records.inc(category=category, outcome="dropped")
+        return
+    metrics.log_records.inc(category=category, outcome="queued")
+
+
+def write():
+    """
+    Runs in its own thread and writes the queued records in batches until it gets None
+    """
+    while True:
+        batch = [records.get()]
+        while len(batch) < batch_size and batch[-1] is not None:
+            try:
+                batch.append(records.get_nowait())
+            except queue.Empty:
+                break
+        lines = [json.dumps(record, ensure_ascii=False, default=str) for record in batch if record is not None]
+        if len(lines) != 0:
+            try:
+                if log_file is not None:
+                    file = open(log_file, "a", encoding="utf-8")
+                else:
+                    file = log_stream or sys.stdout
+                file.write("\n".join(lines) + "\n")
+                file.flush()
+                if log_file is not None:
+                    file.close()
+            except OSError as error:
+                print(f"Could not write {len(lines)} log records: {error}", file=sys.stderr)
+        if batch[-1] is None:
+            return
+
+
+def start():
+    """
+    Starts the writer thread, does nothing if it already runs
+    """
+    global writer
+    with lock:
+        if writer is not None:
+            return
+        writer = threading.Thread(target=write, name="eventlog", daemon=True)
+        writer.start()
+
+
+def stop(timeout: float = 5.0):
+    """
+    Writes the queued records and stops the writer thread
+    :param timeout: How long to wait for the queued records to be written
+    """
+    global writer
+    with lock:
+        current = writer
+        writer = None
+    if current is None:
+        return
+    records.put(None)
+    current.join(timeout)
+
+
+atexit.register(stop)
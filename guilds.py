@@ -0,0 +1,81 @@
+"""
+guilds
+~~~~~~~~~~~~
+
+This module implements the partitioning of the bot's state by guild.
+Every guild listed under "guilds" in the settings has its own channels, raid role and overrides of the other
+settings, and its own raid list and mains in a directory of its own. Guilds that are not listed use the top-level
+settings and the files in the working directory, so a bot that serves a single guild runs as before. The guild a
+command belongs to is kept in a contextvar, which the functions reading and writing the state look at.
+
+"""
+
+import contextvars
+import os
+from contextlib import contextmanager
+
+state_directory = "guilds"
+
+# Maps the ID of every listed guild to its settings
+partitions = {}
+
+current_guild = contextvars.ContextVar("current_guild", default=None)
+
+
+def configure(guild_settings: dict):
+    """
+    Replaces the settings of the listed guilds
+    :param guild_settings: The "guilds" of the settings, mapping guild IDs (as strings) to their settings
+    """
+    global partitions
+    partitions = {int(guild_id): partition for guild_id, partition in guild_settings.items()}
+
+
+@contextmanager
+def use(guild_id: int):
+    """
+    Makes a guild the current guild inside the with-statement, in the same task or thread
+    :param guild_id: ID of the guild, None for direct messages
+    """
+    token = current_guild.set(guild_id)
+    try:
+        yield
+    finally:
+        current_guild.reset(token)
+
+
+def current_partition() -> int:
+    """
+    :return: The ID of the current guild if it has a partition of its own, None if it uses the top-level state
+    """
+    guild_id = current_guild.get()
+    return guild_id if guild_id in partitions else None
+
+
+def get_setting(settings: dict, key: str, default=None):
+    """
+    Looks up a setting for the current guild, the settings of the guild override the top-level settings
+    :param settings: The top-level settings
+    :param key: The name of the setting
+    :param default: The value if neither the guild nor the top-level settings have it
+    :return: The value of the setting
+    """
+    partition = partitions.get(current_guild.get())
+    if partition is not None and key in partition:
+        return partition[key]
+    return settings.get(key, default)
+
+
+def state_path(filename: str, create: bool = False) -> str:
+    """
+    :param filename: Name of a file with state of a guild, e.g. "raidplayerlist.json"
+    :param create: Whether to create the directory of the guild if it doesn't exist yet
+    :return: The path of the file for the current guild
+    """
+    guild_id = current_partition()
+    if guild_id is None:
+        return filename
+    directory = os.path.join(state_directory, str(guild_id))
+    if create:
+        os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
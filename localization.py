@@ -0,0 +1,181 @@
+"""
+localization
+~~~~~~~~~~~~
+
+This module implements the translation of the locale-independent codes used by data_processing into text.
+The processed equipment only contains codes (slot types, class keys, upgrade tracks), so it is the same in every
+locale and can be cached once, and it is only turned into text for the locale of a guild when it is rendered.
+Locales without a table of their own use the English one.
+Embellishments and classes can only be recognized by their localized names, so the api is asked for the data of
+a locale without tables in the fallback locale instead (see request_locale()).
+
+"""
+
+fallback_language = "en"
+fallback_locale = "en_US"
+
+slot_names = {
+    "de": {
+        "HEAD": "Kopf",
+        "NECK": "Hals",
+        "SHOULDER": "Schulter",
+        "CHEST": "Brust",
+        "WAIST": "Taille",
+        "LEGS": "Beine",
+        "FEET": "Füße",
+        "WRIST": "Handgelenk",
+        "HANDS": "Hände",
+        "FINGER_1": "Ring 1",
+        "FINGER_2": "Ring 2",
+        "TRINKET_1": "Schmuckstück 1",
+        "TRINKET_2": "Schmuckstück 2",
+        "BACK": "Rücken",
+        "MAIN_HAND": "Waffenhand",
+        "OFF_HAND": "Schildhand"
+    },
+    "en": {
+        "HEAD": "Head",
+        "NECK": "Neck",
+        "SHOULDER": "Shoulders",
+        "CHEST": "Chest",
+        "WAIST": "Waist",
+        "LEGS": "Legs",
+        "FEET": "Feet",
+        "WRIST": "Wrist",
+        "HANDS": "Hands",
+        "FINGER_1": "Ring 1",
+        "FINGER_2": "Ring 2",
+        "TRINKET_1": "Trinket 1",
+        "TRINKET_2": "Trinket 2",
+        "BACK": "Back",
+        "MAIN_HAND": "Main Hand",
+        "OFF_HAND": "Off Hand"
+    }
+}
+
+track_names = {
+    "de": {
+        "explorer": "Forscher",
+        "adventurer": "Abenteurer",
+        "veteran": "Veteran",
+        "champion": "Champion",
+        "hero": "Held",
+        "myth": "Mythos",
+        "crafted": "Crafted"
+    },
+    "en": {
+        "explorer": "Explorer",
+        "adventurer": "Adventurer",
+        "veteran": "Veteran",
+        "champion": "Champion",
+        "hero": "Hero",
+        "myth": "Myth",
+        "crafted": "Crafted"
+    }
+}
+
+class_names = {
+    "de": {
+        "DEATH_KNIGHT": "Todesritter",
+        "DEMON_HUNTER": "Dämonenjäger",
+        "DRUID": "Druide",
+        "EVOKER": "Rufer",
+        "HUNTER": "Jäger",
+        "MAGE": "Magier",
+        "MONK": "Mönch",
+        "PALADIN": "Paladin",
+        "PRIEST": "Priester",
+        "ROGUE": "Schurke",
+        "SHAMAN": "Schamane",
+        "WARLOCK": "Hexenmeister",
+        "WARRIOR": "Krieger"
+    },
+    "en": {
+        "DEATH_KNIGHT": "Death Knight",
+        "DEMON_HUNTER": "Demon Hunter",
+        "DRUID": "Druid",
+        "EVOKER": "Evoker",
+        "HUNTER": "Hunter",
+        "MAGE": "Mage",
+        "MONK": "Monk",
+        "PALADIN": "Paladin",
+        "PRIEST": "Priest",
+        "ROGUE": "Rogue",
+        "SHAMAN": "Shaman",
+        "WARLOCK": "Warlock",
+        "WARRIOR": "Warrior"
+    }
+}
+
+armor_names = {
+    "de": {"CLOTH": "Stoff", "LEATHER": "Leder", "MAIL": "Kette", "PLATE": "Platte"},
+    "en": {"CLOTH": "Cloth", "LEATHER": "Leather", "MAIL": "Mail", "PLATE": "Plate"}
+}
+
+# The word the api uses in the "limit_category" of embellished items, in every language there is a table for
+embellishment_markers = {"Verziert", "Embellished"}
+
+# Maps the class name of every language to the class key
+class_keys = {name: key for names in class_names.values() for key, name in names.items()}
+
+
+def get_language(locale: str) -> str:
+    """
+    :param locale: A locale, e.g. "de_DE"
+    :return: The language of the locale if there are tables for it, otherwise the fallback language
+    """
+    language = locale.split("_")[0]
+    return language if language in slot_names else fallback_language
+
+
+def request_locale(locale: str) -> str:
+    """
+    :param locale: The locale of the current command
+    :return: The locale to request api data in, the locale itself if there are tables for its language, otherwise
+    the fallback locale
+    """
+    return locale if locale.split("_")[0] in slot_names else fallback_locale
+
+
+def slot_name(slottype: str, locale: str) -> str:
+    """
+    :param slottype: The slot type of an item, e.g. "OFF_HAND"
+    :param locale: The locale to render in
+    :return: The name of the slot
+    """
+    return slot_names[get_language(locale)].get(slottype, slottype)
+
+
+def class_name(class_key: str, locale: str) -> str:
+    """
+    :param class_key: The key of a class, e.g. "DEATH_KNIGHT"
+    :param locale: The locale to render in
+    :return: The name of the class
+    """
+    return class_names[get_language(locale)].get(class_key, class_key)
+
+
+def armor_name(armor_type: str, locale: str) -> str:
+    """
+    :param armor_type: The armor type of a class, e.g. "PLATE"
+    :param locale: The locale to render in
+    :return: The name of the armor type
+    """
+    return armor_names[get_language(locale)].get(armor_type, armor_type)
+
+
+def track_label(itemtrack, locale: str) -> str:
+    """
+    :param itemtrack: The upgrade track of an item as stored by data_processing.process_equipment(), results of
+    older versions already contain the text
+    :param locale: The locale to render in
+    :return: The upgrade track as text, e.g. "(Held 2/6)", or an empty string if the item has none
+    """
+    if type(itemtrack) is str:
+        return itemtrack
+    if len(itemtrack) == 0:
+        return ""
+    name = track_names[get_language(locale)][itemtrack["track"]]
+    if "rank" not in itemtrack:
+        return f"({name})"
+    return f"({name} {itemtrack['rank']}/{itemtrack['ranks']})"
@@ -0,0 +1,135 @@
+"""
+memberdirectory
+~~~~~~~~~~~~
+
+This module implements lookups of guild members and roles.
+Members and roles are taken from the gateway cache of discord.py, misses are resolved in chunks through the
+gateway instead of one REST call per member, and IDs that are not part of the guild are remembered for a while.
+
+"""
+
+import asyncio
+import time
+
+import discord
+
+import metrics
+
+# discord allows at most 100 user IDs per member query
+query_chunk_size = 100
+query_timeout = 10.0
+missing_ttl = 600
+
+missing_members = {}
+fetched_roles = set()
+
+
+def forget_missing(guild_id: int, member_id: int):
+    """
+    Removes a member from the IDs that are known not to be part of a guild
+    :param guild_id: ID of the guild
+    :param member_id: ID of the member
+    """
+    missing_members.get(guild_id, {}).pop(member_id, None)
+
+
+def is_missing(guild_id: int, member_id: int) -> bool:
+    """
+    :param guild_id: ID of the guild
+    :param member_id: ID of the member
+    :return: Whether the member was recently looked up and is not part of the guild
+    """
+    missing_since = missing_members.get(guild_id, {}).get(member_id)
+    return missing_since is not None and time.time() - missing_since < missing_ttl
+
+
+async def get_members(guild: discord.Guild, member_ids: list) -> dict:
+    """
+    Looks up many members of a guild at once
+    :param guild: The guild in which the members are
+    :param member_ids: The IDs of the members in question
+    :return: A dictionary mapping every ID that belongs to a member of the guild to the Member object
+    """
+    members = {}
+    misses = []
+    for member_id in {int(member_id) for member_id in member_ids}:
+        member = guild.get_member(member_id)
+        if member is not None:
+            metrics.cache_requests.inc(cache="member", outcome="hit")
+            members[member_id] = member
+        elif is_missing(guild.id, member_id):
+            metrics.cache_requests.inc(cache="member", outcome="hit")
+        else:
+            metrics.cache_requests.inc(cache="member", outcome="miss")
+            misses.append(member_id)
+
+    for start in range(0, len(misses), query_chunk_size):
+        chunk = misses[start:start + query_chunk_size]
+        try:
+            found = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=True)
+        except asyncio.TimeoutError:
+            continue
+        for member in found:
+            members[member.id] = member
+        for member_id in chunk:
+            if member_id not in members:
+                missing_members.setdefault(guild.id, {})[member_id] = time.time()
+
+    return members
+
+
+async def get_member(guild: discord.Guild, member_id: int):
+    """
+    Looks up a single member of a guild
+    :param guild: The guild in which the member is
+    :param member_id: The ID of the member in question
+    :return: The Member object, or None if the user is not part of the guild
+    """
+    members = await get_members(guild, [member_id])
+    return members.get(int(member_id))
+
+
+async def get_display_names(guild: discord.Guild, member_ids: list) -> dict:
+    """
+    Looks up the display names of many members of a guild at once
+    :param guild: The guild in which the members are
+    :param member_ids: The IDs of the members in question
+    :return: A dictionary mapping every ID as it was given to the display name, or to the ID itself if the user is
+    not part of the guild
+    """
+    members = await get_members(guild, member_ids)
+    names = {}
+    for member_id in member_ids:
+        member = members.get(int(member_id))
+        names[member_id] = member.display_name if member is not None else str(member_id)
+    return names
+
+
+async def get_role(guild: discord.Guild, role_id: int):
+    """
+    Looks up a role of a guild, the roles are only fetched if the cache does not know the role yet
+    :param guild: The guild the role belongs to
+    :param role_id: The ID of the role
+    :return: The Role object, or None if the guild has no such role
+    """
+    role = guild.get_role(int(role_id))
+    if role is not None:
+        metrics.cache_requests.inc(cache="role", outcome="hit")
+        return role
+    metrics.cache_requests.inc(cache="role", outcome="miss")
+    if guild.id in fetched_roles:
+        return None
+    roles = await guild.fetch_roles()
+    fetched_roles.add(guild.id)
+    for role in roles:
+        if role.id == int(role_id):
+            return role
+    return None
+
+
+def role_changed(guild_id: int):
+    """
+    Allows the roles of a guild to be fetched again, after a role was created or changed
+    :param guild_id: ID of the guild
+    """
+    fetched_roles.discard(guild_id)
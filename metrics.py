@@ -0,0 +1,253 @@
+"""
+metrics
+~~~~~~~~~~~~
+
+This module implements counters, gauges and histograms for the bot and exposes them in the Prometheus text format.
+
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+registry = []
+
+
+def format_labels(labelnames: tuple, labelvalues: tuple, extra: str = "") -> str:
+    """
+    Formats labels the way the Prometheus text format expects them
+    :param labelnames: Names of the labels
+    :param labelvalues: Values of the labels, in the same order as the names
+    :param extra: An additional, already formatted label
+    :return: The labels in curly braces, or an empty string if there are none
+    """
+    labels = []
+    for labelname, labelvalue in zip(labelnames, labelvalues):
+        escaped = str(labelvalue).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        labels.append(f"{labelname}=\"{escaped}\"")
+    if extra:
+        labels.append(extra)
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(labels) + "}"
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(labelname, "")) for labelname in self.labelnames)
+
+    def labelsets(self) -> list:
+        """
+        :return: A list with the labels of every combination that has been recorded so far
+        """
+        with self.lock:
+            keys = sorted(self.values)
+        return [dict(zip(self.labelnames, key)) for key in keys]
+
+    def samples(self) -> list:
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self) -> list:
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in values]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = latency_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+            entry = self.values[key]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["buckets"][index] += 1
+                    break
+            entry["count"] += 1
+            entry["sum"] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the time it takes to run the body of a with-statement
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        entry = self.values.get(self.key(labels))
+        if entry is None:
+            return 0
+        return entry["count"]
+
+    def quantile(self, q: float, **labels) -> float:
+        """
+        Estimates a quantile from the buckets, the same way Prometheus' histogram_quantile() does
+        :param q: The quantile, between 0 and 1
+        :return: The estimated value, or 0 if nothing was observed yet
+        """
+        entry = self.values.get(self.key(labels))
+        if entry is None or entry["count"] == 0:
+            return 0.0
+        rank = q * entry["count"]
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, entry["buckets"]):
+            if cumulative + count >= rank and count > 0:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+    def samples(self) -> list:
+        with self.lock:
+            values = sorted((key, dict(entry, buckets=list(entry["buckets"]))) for key, entry in self.values.items())
+        lines = []
+        for key, entry in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry["buckets"]):
+                cumulative += count
+                bucket_labels = format_labels(self.labelnames, key, "le=\"" + str(bound) + "\"")
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = format_labels(self.labelnames, key, "le=\"+Inf\"")
+            lines.append(f"{self.name}_bucket{bucket_labels} {entry['count']}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {entry['sum']}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {entry['count']}")
+        return lines
+
+
+command_latency = Histogram("gearbot_command_duration_seconds", "Time it took to handle a command", ("command",))
+blizzard_requests = Counter("gearbot_blizzard_requests_total", "Requests made to the Blizzard-API",
+                            ("endpoint", "status"))
+blizzard_latency = Histogram("gearbot_blizzard_request_duration_seconds", "Duration of requests to the Blizzard-API",
+                             ("endpoint",))
+blizzard_retries = Counter("gearbot_blizzard_retries_total", "Requests to the Blizzard-API that were repeated",
+                           ("endpoint",))
+circuit_open = Gauge("gearbot_blizzard_circuit_open", "Whether the circuit breaker of an endpoint is open",
+                     ("endpoint",))
+token_fetches = Counter("gearbot_token_fetches_total", "Access tokens requested from the authentification servers",
+                        ("status",))
+emoji_uploads = Counter("gearbot_emoji_uploads_total", "Item icons uploaded as application emotes")
+store_operations = Counter("gearbot_store_operations_total", "Reads and writes of the JSON files",
+                           ("file", "operation"))
+cache_requests = Counter("gearbot_cache_requests_total", "Lookups in the caches of the bot", ("cache", "outcome"))
+raidcheck_runs = Counter("gearbot_raidcheck_requests_total", "Raidchecks by how they were answered, fetched, joined "
+                         "a running raidcheck or reused a fresh one", ("outcome",))
+command_cooldowns = Counter("gearbot_command_cooldowns_total", "Commands that were rejected because of a cooldown",
+                            ("command",))
+log_records = Counter("gearbot_log_records_total", "Records of the structured log by whether they were queued or "
+                      "dropped by sampling, rate limiting or a full queue", ("category", "outcome"))
+settings_reloads = Counter("gearbot_settings_reloads_total", "Changes of the settings file by whether they were "
+                           "applied or rejected as invalid", ("outcome",))
+subscription_polls = Counter("gearbot_subscription_polls_total", "Polls of followed characters by whether their "
+                             "gear changed", ("outcome",))
+subscription_notifications = Counter("gearbot_subscription_notifications_total", "Notifications about gear changes "
+                                     "by how they were sent and whether that worked", ("kind", "outcome"))
+
+
+event_loop_lag = Histogram("gearbot_event_loop_lag_seconds", "How late the ticks of the event loop watchdog were",
+                           buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+event_loop_stalls = Counter("gearbot_event_loop_stalls_total", "Times the event loop was blocked longer than the "
+                            "threshold of the watchdog")
+gateway_latency = Gauge("gearbot_gateway_latency_seconds", "Latency of the last heartbeat of the discord gateway")
+
+startup_duration = Gauge("gearbot_startup_seconds", "Time from starting the process until the bot was ready")
+startup_phase = Histogram("gearbot_startup_phase_seconds", "Duration of the phases of the startup", ("phase",))
+
+
+def render() -> str:
+    """
+    :return: Every registered metric in the Prometheus text format
+    """
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+def cache_hit_ratio(cache: str) -> float:
+    """
+    :param cache: Name of the cache
+    :return: The share of lookups in the cache that were hits, or 0 if there were no lookups
+    """
+    hits = cache_requests.get(cache=cache, outcome="hit")
+    misses = cache_requests.get(cache=cache, outcome="miss")
+    if hits + misses == 0:
+        return 0.0
+    return hits / (hits + misses)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        payload = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def serve(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Starts serving the metrics on http://host:port/metrics in a background thread
+    :param port: The port to listen on
+    :param host: The address to listen on, only locally by default
+    :return: The running server
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,194 @@
+"""
+profiling
+~~~~~~~~~~~~
+
+This module implements on-demand profiling of commands.
+An administrator arms a command for its next N invocations, each of which then runs under cProfile and tracemalloc
+while a thread samples the stacks of the event loop and its worker threads. The reports (collapsed stacks for
+flamegraphs, the cProfile statistics and the largest allocations) are written to disk. Commands that are not armed
+run without any profiling code.
+
+"""
+
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+output_directory = "profiles"
+sample_interval = 0.001
+top_entries = 40
+
+# Maps the name of a command to the number of invocations that are still to be profiled and the report channel
+armed = {}
+# The command that is being profiled right now, cProfile can only profile one invocation at a time
+active = None
+# Numbers the reports, so reports written in the same second don't overwrite each other
+report_numbers = itertools.count(1)
+
+
+def arm(command: str, count: int, channel=None):
+    """
+    Profiles the next invocations of a command
+    :param command: Name of the command, e.g. "raidcheck"
+    :param count: How many invocations to profile
+    :param channel: A channel to send the reports to, if any
+    """
+    armed[command] = {"remaining": count, "channel": channel}
+
+
+def disarm(command: str = None):
+    """
+    Stops profiling a command, or every command if none is given
+    :param command: Name of the command
+    """
+    if command is None:
+        armed.clear()
+    else:
+        armed.pop(command, None)
+
+
+def arm_from_environment(value: str):
+    """
+    Arms commands from a specification like "raidcheck:3,gear:1"
+    :param value: The specification, usually the value of the environment variable GEARBOT_PROFILE
+    """
+    for entry in value.split(","):
+        command, _, count = entry.strip().partition(":")
+        if command != "":
+            arm(command, int(count) if count.isdigit() else 1)
+
+
+def is_idle(frame) -> bool:
+    """
+    :param frame: The innermost frame of a thread
+    :return: Whether the thread is waiting for work instead of doing something
+    """
+    return os.path.basename(frame.f_code.co_filename) in ["threading.py", "selectors.py", "queue.py", "thread.py"]
+
+
+def collapse(frame) -> str:
+    """
+    Formats a stack in the collapsed format of flamegraph.pl, outermost call first
+    :param frame: The innermost frame of the stack
+    """
+    names = []
+    while frame is not None:
+        names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler(threading.Thread):
+    def __init__(self, thread_ids: set):
+        """
+        Samples the stacks of threads until it is stopped
+        :param thread_ids: IDs of the threads to sample, threads started by asyncio.to_thread are sampled as well
+        """
+        super().__init__(name="profiler", daemon=True)
+        self.thread_ids = thread_ids
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(sample_interval):
+            workers = {thread.ident for thread in threading.enumerate() if thread.name.startswith("asyncio_")}
+            for thread_id, frame in sys._current_frames().items():
+                if (thread_id in self.thread_ids or thread_id in workers) and not is_idle(frame):
+                    self.stacks[collapse(frame)] += 1
+
+
+def write_reports(command: str, profiler: cProfile.Profile, stacks: Counter, allocations: list,
+                  duration: float) -> list:
+    """
+    Writes the reports of a profiled invocation to disk
+    :param command: Name of the command
+    :param profiler: The cProfile profiler of the invocation
+    :param stacks: The sampled stacks, in collapsed format, with the number of samples
+    :param allocations: The largest differences in allocated memory, as returned by tracemalloc
+    :param duration: How long the invocation took in seconds
+    :return: The paths of the written files
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    prefix = os.path.join(output_directory,
+                          f"{command}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(report_numbers)}")
+
+    collapsed_path = prefix + ".collapsed"
+    file = open(collapsed_path, "w")
+    for stack, samples in stacks.most_common():
+        file.write(f"{stack} {samples}\n")
+    file.close()
+
+    stats_path = prefix + ".prof.txt"
+    text = io.StringIO()
+    text.write(f"{command} took {duration * 1000:.1f} ms\n\n")
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(top_entries)
+    file = open(stats_path, "w")
+    file.write(text.getvalue())
+    file.close()
+    profiler.dump_stats(prefix + ".prof")
+
+    allocations_path = prefix + ".alloc.txt"
+    file = open(allocations_path, "w")
+    for statistic in allocations[:top_entries]:
+        file.write(f"{statistic}\n")
+    file.close()
+
+    return [collapsed_path, stats_path, allocations_path]
+
+
+async def run_profiled(command: str, coroutine) -> list:
+    """
+    Runs a command under the profilers, other coroutines that run at the same time show up in the reports as well.
+    While another invocation is being profiled, the command runs without profiling and stays armed
+    :param command: Name of the command
+    :param coroutine: The coroutine of the command
+    :return: The paths of the written reports, an empty list if the invocation was not profiled
+    """
+    global active
+    if active is not None or command not in armed:
+        await coroutine
+        return []
+
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    sampler = Sampler({threading.get_ident()})
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as error:
+        # Another profiler, e.g. a debugger, is already installed
+        print(f"Could not profile {command}: {error}")
+        if started_tracemalloc:
+            tracemalloc.stop()
+        await coroutine
+        return []
+    active = command
+    entry = armed[command]
+    entry["remaining"] -= 1
+    if entry["remaining"] <= 0:
+        disarm(command)
+    start = time.perf_counter()
+    sampler.start()
+    try:
+        await coroutine
+    finally:
+        profiler.disable()
+        active = None
+        duration = time.perf_counter() - start
+        sampler.stopped.set()
+        sampler.join()
+        allocations = tracemalloc.take_snapshot().compare_to(before, "lineno")
+        if started_tracemalloc:
+            tracemalloc.stop()
+    paths = write_reports(command, profiler, sampler.stacks, allocations, duration)
+    print(f"Profiled {command} ({duration * 1000:.1f} ms), reports written to {', '.join(paths)}")
+    return paths
@@ -0,0 +1,239 @@
+"""
+raidcheckstore
+~~~~~~~~~~~~
+
+This module implements the store for the results of raidchecks.
+Every raidcheck becomes a run with its own ID, scoped to the channel it was made in, and its results are stored by
+character instead of by their position in the raidlist, so a dropdown always shows the character it was made for,
+even if the raidlist changed in between. Runs are written to disk, so the dropdowns of a raidcheck keep working
+after a restart, and only the most recently used runs are kept in memory.
+
+"""
+
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+import realmindex
+
+store_directory = "raidchecks"
+run_retention = 14 * 86400
+max_results = 1000
+
+run_id_pattern = re.compile(r"[0-9a-f]+")
+
+runs = OrderedDict()
+latest_runs = {}
+lock = threading.Lock()
+last_run_id = 0
+
+
+def make_key(name: str, realm: str) -> str:
+    """
+    :param name: Name of the Character
+    :param realm: Name of the realm
+    :return: The key under which the result of the character is stored, short enough to be the value of a
+    dropdown option
+    """
+    return f"{name.lower()}/{realmindex.get_slug(realm)}"
+
+
+def new_run_id() -> str:
+    """
+    :return: A new run ID, derived from the current time so it stays unique across restarts
+    """
+    global last_run_id
+    run_id = max(int(time.time() * 1000), last_run_id + 1)
+    last_run_id = run_id
+    return format(run_id, "x")
+
+
+def run_path(run_id: str) -> str:
+    return os.path.join(store_directory, f"{run_id}.json.gz")
+
+
+def count_results() -> int:
+    return sum(len(run["results"]) for run in runs.values())
+
+
+def cache_run(run_id: str, run: dict):
+    """
+    Keeps a run in memory, the least recently used runs are dropped while too many results are held, must be called
+    while holding the lock
+    :param run_id: ID of the run
+    :param run: The run
+    """
+    runs[run_id] = run
+    runs.move_to_end(run_id)
+    while len(runs) > 1 and count_results() > max_results:
+        runs.popitem(last=False)
+
+
+def write_run(run_id: str, run: dict):
+    """
+    Writes a run to disk, the file is replaced atomically
+    :param run_id: ID of the run
+    :param run: The run
+    """
+    metrics.store_operations.inc(file=store_directory, operation="write")
+    os.makedirs(store_directory, exist_ok=True)
+    temporary_path = run_path(run_id) + ".tmp"
+    file = gzip.open(temporary_path, "wt", encoding="utf-8")
+    json.dump({"channel": run["channel"], "created": run["created"], "results": list(run["results"].values())}, file)
+    file.close()
+    os.replace(temporary_path, run_path(run_id))
+
+
+def read_run(run_id: str) -> dict:
+    """
+    Reads a run from disk
+    :param run_id: ID of the run
+    :return: The run, or None if there is no such run
+    """
+    if run_id_pattern.fullmatch(run_id) is None or not os.path.exists(run_path(run_id)):
+        return None
+    metrics.store_operations.inc(file=store_directory, operation="read")
+    try:
+        file = gzip.open(run_path(run_id), "rt", encoding="utf-8")
+        stored = json.load(file)
+        file.close()
+    except (OSError, ValueError):
+        return None
+    results = OrderedDict((make_key(entry["name"], entry["realm"]), entry) for entry in stored["results"])
+    return {"channel": stored["channel"], "created": stored["created"], "results": results}
+
+
+def load_run(run_id: str) -> dict:
+    """
+    Looks up a run in memory, or on disk if it is not in memory
+    :param run_id: ID of the run
+    :return: The run, or None if there is no such run or it is older than run_retention
+    """
+    with lock:
+        run = runs.get(run_id)
+        if run is not None:
+            metrics.cache_requests.inc(cache="raidcheck", outcome="hit")
+            runs.move_to_end(run_id)
+    if run is None:
+        metrics.cache_requests.inc(cache="raidcheck", outcome="miss")
+        run = read_run(run_id)
+        if run is None:
+            return None
+        with lock:
+            cache_run(run_id, run)
+    if time.time() - run["created"] > run_retention:
+        return None
+    return run
+
+
+def create_run(channel_id: int, playerlist: list, results: list, created: float = None) -> str:
+    """
+    Stores the results of a raidcheck as a new run
+    :param channel_id: ID of the channel the raidcheck was made in
+    :param playerlist: The characters of the raidcheck, as returned by discordbot.get_raidlist()
+    :param results: The results of data_processing.get_char_equip() for every character, in the same order
+    :param created: Time of the raidcheck, now if not given
+    :return: The ID of the run
+    """
+    created = created if created is not None else time.time()
+    run = {"channel": channel_id, "created": created, "results": OrderedDict()}
+    for character, result in zip(playerlist, results):
+        run["results"][make_key(character["name"], character["realm"])] = {
+            "name": character["name"],
+            "realm": character["realm"],
+            "result": result
+        }
+    with lock:
+        run_id = new_run_id()
+    write_run(run_id, run)
+    with lock:
+        cache_run(run_id, run)
+        latest_runs[channel_id] = run_id
+    return run_id
+
+
+def get_result(run_id: str, key: str) -> dict:
+    """
+    Looks up the result of a single character of a run
+    :param run_id: ID of the run
+    :param key: Key of the character, see make_key()
+    :return: A dictionary with the "name", the "realm" and the "result" of the character, or None if the run has
+    expired or does not contain the character
+    """
+    run = load_run(run_id)
+    if run is None:
+        return None
+    return run["results"].get(key)
+
+
+def get_latest_run(channel_id: int, playerlist: list, max_age: float = None) -> tuple:
+    """
+    Looks up the latest raidcheck of a channel, if it was made for the given characters
+    :param channel_id: ID of the channel
+    :param playerlist: The characters the results are needed for, as returned by discordbot.get_raidlist()
+    :param max_age: The maximum age of the raidcheck in seconds, any age up to run_retention if not given
+    :return: A tuple of the ID of the run and a list with the result of every character in the same order, or None
+    if there is no matching run
+    """
+    run_id = latest_runs.get(channel_id)
+    run = load_run(run_id) if run_id is not None else None
+    if run is None or (max_age is not None and time.time() - run["created"] > max_age):
+        return None
+    keys = [make_key(character["name"], character["realm"]) for character in playerlist]
+    if keys != list(run["results"]):
+        return None
+    return run_id, [run["results"][key]["result"] for key in keys]
+
+
+def get_latest_results(channel_id: int, playerlist: list) -> list:
+    """
+    Looks up the results of the latest raidcheck of a channel, if it was made for the given characters
+    :param channel_id: ID of the channel
+    :param playerlist: The characters the results are needed for, as returned by discordbot.get_raidlist()
+    :return: A list with the result of every character in the same order, or None if there is no matching run
+    """
+    latest = get_latest_run(channel_id, playerlist)
+    return latest[1] if latest is not None else None
+
+
+def prune(now: float = None) -> int:
+    """
+    Deletes the runs that are older than run_retention from disk
+    :param now: The current time
+    :return: The number of deleted runs
+    """
+    now = now if now is not None else time.time()
+    if not os.path.isdir(store_directory):
+        return 0
+    deleted = 0
+    for filename in os.listdir(store_directory):
+        path = os.path.join(store_directory, filename)
+        if now - os.path.getmtime(path) > run_retention:
+            os.remove(path)
+            deleted += 1
+            with lock:
+                runs.pop(filename.split(".")[0], None)
+    return deleted
+
+
+def export_latest() -> dict:
+    """
+    :return: The ID of the latest run of every channel, in a format that can be written as JSON
+    """
+    with lock:
+        return {str(channel_id): run_id for channel_id, run_id in latest_runs.items()}
+
+
+def import_latest(exported: dict):
+    """
+    Restores the latest run of every channel
+    :param exported: The IDs as returned by export_latest()
+    """
+    with lock:
+        for channel_id, run_id in exported.items():
+            latest_runs[int(channel_id)] = run_id
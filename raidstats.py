@@ -0,0 +1,158 @@
+"""
+raidstats
+~~~~~~~~~~~~
+
+This module implements roster-wide analytics over the results of a raidcheck.
+The results are encoded as NumPy arrays, so that every summary is computed in one vectorized pass.
+
+"""
+
+import numpy as np
+
+import data_processing
+
+STATUS_OK = 0
+STATUS_WARNING = 1
+STATUS_ALERT = 2
+STATUS_NONE = 3
+STATUS_ERROR = -1
+
+number_of_slots = len(data_processing.gear_slot_order)
+
+slot_labels = {
+    "HEAD": "Kopf",
+    "NECK": "Hals",
+    "SHOULDER": "Schulter",
+    "CHEST": "Brust",
+    "WAIST": "Taille",
+    "LEGS": "Beine",
+    "FEET": "Füße",
+    "WRIST": "Handgelenk",
+    "HANDS": "Hände",
+    "FINGER_1": "Ring 1",
+    "FINGER_2": "Ring 2",
+    "TRINKET_1": "Schmuck 1",
+    "TRINKET_2": "Schmuck 2",
+    "BACK": "Rücken",
+    "MAIN_HAND": "Waffenhand",
+    "OFF_HAND": "Schildhand"
+}
+
+sort_keys = ["ilvl", "status", "name"]
+
+
+def build_roster_matrix(charnamelist: list, results: list) -> dict:
+    """
+    Encodes the results of a raidcheck as NumPy arrays with one row per character
+    :param charnamelist: The names of the characters, in the same order as the results
+    :param results: The results of data_processing.get_char_equip() for every character, either a dictionary
+    or the status code of a failed request
+    :return: A dictionary containing the arrays "status" (characters x 17 status codes), "ilvl", "embellishments",
+    "enchant_missing", "gems_missing", "sockets_missing" and "valid", as well as the "names" of the characters
+    """
+    count = len(results)
+    roster = {
+        "names": list(charnamelist),
+        "status": np.full((count, number_of_slots + 1), STATUS_ERROR, dtype=np.int8),
+        "ilvl": np.full(count, np.nan),
+        "embellishments": np.zeros(count, dtype=np.int8),
+        "enchant_missing": np.zeros((count, number_of_slots), dtype=bool),
+        "gems_missing": np.zeros((count, number_of_slots), dtype=np.int8),
+        "sockets_missing": np.zeros((count, number_of_slots), dtype=np.int8),
+        "valid": np.zeros(count, dtype=bool)
+    }
+    slot_index = {slottype: index for index, slottype in enumerate(data_processing.gear_slot_order)}
+
+    for row, chardict in enumerate(results):
+        if type(chardict) is int:
+            continue
+        equip = chardict["equip"]
+        roster["valid"][row] = True
+        roster["status"][row] = data_processing.get_gear_status(equip)
+        roster["ilvl"][row] = equip["avgilvl"]
+        roster["embellishments"][row] = equip["embellishments"]
+
+        for item in equip["gear"]:
+            column = slot_index.get(item["slottype"])
+            if column is None:
+                continue
+            if item["hasenchantment"] and item["enchantment"][0]["missing"]:
+                roster["enchant_missing"][row, column] = True
+            if item["hassocket"]:
+                for socket in item["sockets"]:
+                    if socket["missing"]:
+                        roster["sockets_missing"][row, column] += 1
+                    elif not socket["hasgem"]:
+                        roster["gems_missing"][row, column] += 1
+
+    return roster
+
+
+def problem_scores(roster: dict) -> np.ndarray:
+    """
+    Weighs the problems of every character, an alert counts twice as much as a warning
+    :param roster: A roster as returned by build_roster_matrix()
+    :return: An array with one score per character, characters whose request failed score -1
+    """
+    status = roster["status"]
+    scores = 2 * (status == STATUS_ALERT).sum(axis=1) + (status == STATUS_WARNING).sum(axis=1)
+    return np.where(roster["valid"], scores, -1)
+
+
+def sort_order(roster: dict, key: str) -> np.ndarray:
+    """
+    Calculates the order in which the characters of a roster should be shown
+    :param roster: A roster as returned by build_roster_matrix()
+    :param key: One of sort_keys, "ilvl" sorts by highest itemlevel, "status" by most problems, "name" alphabetically
+    :return: An array of row indices, characters whose request failed are always last
+    """
+    match key:
+        case "ilvl":
+            order = np.argsort(-np.nan_to_num(roster["ilvl"], nan=-np.inf), kind="stable")
+        case "status":
+            order = np.argsort(-problem_scores(roster), kind="stable")
+        case "name":
+            order = np.array(sorted(range(len(roster["names"])), key=lambda row: roster["names"][row].lower()),
+                             dtype=np.intp)
+        case _:
+            order = np.arange(len(roster["names"]))
+    return order[np.argsort(~roster["valid"][order], kind="stable")]
+
+
+def summarize_roster(roster: dict, offenders: int = 5) -> dict:
+    """
+    Computes roster-level statistics
+    :param roster: A roster as returned by build_roster_matrix()
+    :param offenders: How many of the characters with the most problems should be listed
+    :return: A dictionary with the statistics of the roster
+    """
+    valid = roster["valid"]
+    ilvl = roster["ilvl"][valid]
+    embellishments = np.minimum(roster["embellishments"][valid], 2)
+    scores = problem_scores(roster)
+
+    worst = np.argsort(-scores, kind="stable")[:offenders]
+    worst = worst[scores[worst] > 0]
+
+    enchants_per_slot = roster["enchant_missing"][valid].sum(axis=0)
+    gems_per_character = roster["gems_missing"].sum(axis=1)
+
+    return {
+        "characters": int(valid.size),
+        "failed": [roster["names"][row] for row in np.flatnonzero(~valid)],
+        "avgilvl": round(float(ilvl.mean()), 2) if ilvl.size else 0.0,
+        "medianilvl": round(float(np.median(ilvl)), 2) if ilvl.size else 0.0,
+        "minilvl": round(float(ilvl.min()), 2) if ilvl.size else 0.0,
+        "maxilvl": round(float(ilvl.max()), 2) if ilvl.size else 0.0,
+        "missing_enchants": {
+            slot_labels[data_processing.gear_slot_order[column]]: int(enchants_per_slot[column])
+            for column in np.flatnonzero(enchants_per_slot)
+        },
+        "missing_enchants_total": int(enchants_per_slot.sum()),
+        "missing_gems_total": int(gems_per_character[valid].sum()),
+        "missing_sockets_total": int(roster["sockets_missing"][valid].sum()),
+        "characters_missing_gems": int((gems_per_character[valid] > 0).sum()),
+        "embellishments": np.bincount(embellishments, minlength=3).tolist(),
+        "embellishment_coverage": round(float((embellishments == 2).mean()), 4) if embellishments.size else 0.0,
+        "worst_offenders": [(roster["names"][row], int(scores[row])) for row in worst]
+    }
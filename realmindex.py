@@ -0,0 +1,219 @@
+"""
+realmindex
+~~~~~~~~~~~~
+
+This module implements the resolution of realm names to the slugs the Blizzard-API expects.
+The index of all realms is fetched from the api, cached on disk and only refreshed rarely, so misspelled realms
+can be rejected (with suggestions) without a round trip to the api. Lookups only read the index in memory, loading
+and refreshing it happens in a background thread. Every region has an index of its own, the region of the current
+command is taken from regions.
+
+"""
+
+import contextvars
+import difflib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+
+import blizzapi
+import metrics
+import regions
+
+# The index of the default region is stored in index_file, the other regions get a file with the region in its name
+index_file = "realmindex.json"
+refresh_interval = 7 * 86400
+retry_interval = 300
+max_suggestions = 3
+
+
+class RegionIndex:
+    def __init__(self):
+        self.realms = {}
+        self.names = {}
+        self.fetched = 0.0
+        self.last_attempt = 0.0
+        self.refreshing = False
+
+
+indexes = {}
+lock = threading.Lock()
+
+
+def get_index(region: str = None) -> RegionIndex:
+    """
+    :param region: The region, the region of the current command if None
+    :return: The index of the region
+    """
+    if region is None:
+        region = regions.get_region()
+    if region not in indexes:
+        indexes.setdefault(region, RegionIndex())
+    return indexes[region]
+
+
+def get_index_file(region: str) -> str:
+    """
+    :param region: The region
+    :return: The path of the file the index of the region is stored in
+    """
+    if region == regions.default_region:
+        return index_file
+    root, extension = os.path.splitext(index_file)
+    return f"{root}-{region}{extension}"
+
+
+def get_names(region: str = None) -> dict:
+    """
+    :param region: The region, the region of the current command if None
+    :return: A dictionary mapping the slug of every known realm to its name
+    """
+    return get_index(region).names
+
+
+def normalize(realm: str) -> str:
+    """
+    Converts a realm name into the form of a slug, e.g. "Un'Goro" into "ungoro" and "Aggra (Português)" into
+    "aggra-portugues"
+    :param realm: Name of the realm, as typed by a user
+    :return: The normalized name
+    """
+    decomposed = unicodedata.normalize("NFKD", realm)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    stripped = stripped.lower().replace("'", "").replace("’", "")
+    return re.sub(r"[^a-z0-9]+", "-", stripped).strip("-")
+
+
+def build_index(realmlist: list, region: str = None):
+    """
+    Builds the lookup tables from a list of realms
+    :param realmlist: A list of dictionaries with the "name" and the "slug" of every realm
+    :param region: The region of the realms, the region of the current command if None
+    """
+    index = get_index(region)
+    new_realms = {}
+    new_names = {}
+    for realm in realmlist:
+        slug = realm["slug"]
+        new_names[slug] = realm["name"]
+        for key in [slug, normalize(realm["name"]), normalize(realm["name"]).replace("-", "")]:
+            new_realms[key] = slug
+    index.realms = new_realms
+    index.names = new_names
+
+
+def load_index(region: str = None):
+    """
+    Loads the realm index of a region from disk, and fetches it from the api if there is none or it is older than
+    refresh_interval. If the api can not be reached, the index from disk is kept
+    :param region: The region, the region of the current command if None
+    """
+    if region is None:
+        region = regions.get_region()
+    index = get_index(region)
+    path = get_index_file(region)
+    index.last_attempt = time.time()
+    realmlist = None
+    if os.path.exists(path):
+        metrics.store_operations.inc(file=path, operation="read")
+        file = open(path, "r", encoding="utf-8")
+        stored = json.load(file)
+        file.close()
+        realmlist = stored["realms"]
+        index.fetched = stored["fetched"]
+
+    if realmlist is None or time.time() - index.fetched > refresh_interval:
+        with regions.use(region, regions.current_locale.get()):
+            response = blizzapi.getrealmindex()
+        if type(response) is not int:
+            realmlist = [{"name": realm["name"], "slug": realm["slug"]} for realm in response["realms"]]
+            index.fetched = time.time()
+            metrics.store_operations.inc(file=path, operation="write")
+            file = open(path, "w", encoding="utf-8")
+            json.dump({"fetched": index.fetched, "realms": realmlist}, file, indent=4, ensure_ascii=False)
+            file.close()
+
+    if realmlist is not None:
+        build_index(realmlist, region)
+
+
+def ensure_index(region: str = None):
+    """
+    Loads the realm index of a region the first time it is needed and refreshes it when it gets too old, failed
+    attempts are only repeated after retry_interval. Blocks while doing so, so it is only used at startup
+    :param region: The region, the region of the current command if None
+    """
+    index = get_index(region)
+    if time.time() - index.last_attempt < retry_interval:
+        return
+    if len(index.realms) == 0 or time.time() - index.fetched > refresh_interval:
+        load_index(region)
+
+
+def refresh_in_background(region: str = None):
+    """
+    Starts a thread that loads the realm index of a region the first time it is needed and refreshes it when it gets
+    too old, failed attempts are only repeated after retry_interval. Until the thread is done, the index that is
+    already in memory is used
+    :param region: The region, the region of the current command if None
+    """
+    if region is None:
+        region = regions.get_region()
+    index = get_index(region)
+    with lock:
+        if index.refreshing or time.time() - index.last_attempt < retry_interval:
+            return
+        if len(index.realms) != 0 and time.time() - index.fetched <= refresh_interval:
+            return
+        index.refreshing = True
+
+    def refresh():
+        try:
+            load_index(region)
+        finally:
+            index.refreshing = False
+
+    # The thread keeps the locale of the caller
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(refresh,), name=f"realmindex {region}", daemon=True).start()
+
+
+def lookup(realm: str):
+    """
+    Resolves a realm name to its slug
+    :param realm: Name of the realm, as typed by a user
+    :return: The slug of the realm, or None if the realm does not exist. If the realm index is not available,
+    the slug is derived from the name instead
+    """
+    refresh_in_background()
+    realms = get_index().realms
+    normalized = normalize(realm)
+    if len(realms) == 0:
+        return normalized
+    slug = realms.get(normalized) or realms.get(normalized.replace("-", ""))
+    metrics.cache_requests.inc(cache="realm", outcome="hit" if slug is not None else "miss")
+    return slug
+
+
+def get_slug(realm: str) -> str:
+    """
+    Resolves a realm name to its slug, without rejecting unknown realms
+    :param realm: Name of the realm
+    :return: The slug of the realm, or the slug derived from the name if the realm is unknown
+    """
+    return lookup(realm) or normalize(realm)
+
+
+def suggest(realm: str) -> list:
+    """
+    Finds the realms whose names are the closest to a misspelled one
+    :param realm: Name of the realm, as typed by a user
+    :return: A list with the names of up to max_suggestions realms
+    """
+    refresh_in_background()
+    names = get_names()
+    matches = difflib.get_close_matches(normalize(realm), list(names), n=max_suggestions, cutoff=0.6)
+    return [names[slug] for slug in matches]
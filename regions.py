@@ -0,0 +1,63 @@
+"""
+regions
+~~~~~~~~~~~~
+
+This module implements the selection of the Blizzard region and locale a request is made for.
+Every region has its own api host, namespaces, accesstoken and caches, and every guild can pick a region and a
+locale in its settings. The region and locale of the current command are kept in contextvars, so the modules
+making requests don't have to pass them along.
+
+"""
+
+import contextvars
+from contextlib import contextmanager
+
+default_region = "eu"
+# The locale used for a region if none is configured
+default_locales = {
+    "eu": "de_DE",
+    "us": "en_US",
+    "kr": "ko_KR",
+    "tw": "zh_TW"
+}
+
+current_region = contextvars.ContextVar("current_region", default=None)
+current_locale = contextvars.ContextVar("current_locale", default=None)
+
+
+@contextmanager
+def use(region: str, locale: str = None):
+    """
+    Makes requests inside the with-statement go to a region, in the same task or thread
+    :param region: The region, e.g. "eu", the default region if None
+    :param locale: The locale, e.g. "en_GB", the default locale of the region if None
+    """
+    region_token = current_region.set(region)
+    locale_token = current_locale.set(locale)
+    try:
+        yield
+    finally:
+        current_locale.reset(locale_token)
+        current_region.reset(region_token)
+
+
+def get_region() -> str:
+    """
+    :return: The region of the current command
+    """
+    return current_region.get() or default_region
+
+
+def get_locale() -> str:
+    """
+    :return: The locale of the current command
+    """
+    return current_locale.get() or default_locales[get_region()]
+
+
+def region_of(namespace: str) -> str:
+    """
+    :param namespace: A namespace of the api, e.g. "profile-eu"
+    :return: The region the namespace belongs to
+    """
+    return namespace.rsplit("-", 1)[-1]
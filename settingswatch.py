@@ -0,0 +1,198 @@
+"""
+settingswatch
+~~~~~~~~~~~~
+
+This module implements the hot reload of the settings.
+A task on the event loop polls the modification time of settings.json, and when the file was changed by someone
+else than the bot, it is read and validated. A valid file is handed to the listeners, which swap it in and update
+whatever depends on the keys that changed. An invalid file is reported and ignored, so the bot keeps running with
+the settings it had.
+
+"""
+
+import asyncio
+import json
+import os
+
+import metrics
+import regions
+
+path = "settings.json"
+poll_interval = 5.0
+
+# The type every required setting must have, the channels and the role are IDs
+required_keys = {
+    "gearbotchannel": int,
+    "raidchannel": int,
+    "mainschannel": int,
+    "raidrolle": int,
+    "emotes": dict,
+    "branch": str
+}
+# The type of the optional settings, if they are given
+optional_keys = {
+    "cooldowns": dict,
+    "importlevel": int,
+    "raidcheckfreshness": (int, float),
+    "lagthreshold": (int, float),
+    "slowcommandthreshold": (int, float),
+    "tracefile": str,
+    "metricsport": int,
+    "snapshotfile": str,
+    "cassette": str,
+    "logfile": str,
+    "logsampling": dict,
+    "lograte": dict,
+    "guilds": dict,
+    "sharedcache": str,
+    "shardcount": int,
+    "region": str,
+    "locale": str
+}
+# The settings every guild listed under "guilds" must have, they are also required at the top level unless guilds
+# are listed
+guild_keys = ["gearbotchannel", "raidchannel", "mainschannel", "raidrolle"]
+required_emotes = ["checkmark", "warning", "alert", "none", "cross", "discord", "embellishment", "t1", "t2", "t3"]
+
+last_mtime = None
+listeners = []
+running = False
+poll_task = None
+
+
+def get_mtime() -> float:
+    """
+    :return: The modification time of the settings file, or None if it does not exist
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def mark_current():
+    """
+    Remembers the current modification time of the settings file, must be called after the bot itself read or
+    wrote the file, so its own writes are not reloaded
+    """
+    global last_mtime
+    last_mtime = get_mtime()
+
+
+def validate(candidate) -> list:
+    """
+    Checks if settings can be used by the bot
+    :param candidate: The settings read from the file
+    :return: A list with a description of every problem, empty if the settings are valid
+    """
+    if type(candidate) is not dict:
+        return ["the settings are not a JSON object"]
+    problems = []
+    for key, expected in required_keys.items():
+        if key not in candidate:
+            if key not in guild_keys or "guilds" not in candidate:
+                problems.append(f"{key} is missing")
+        elif not isinstance(candidate[key], expected):
+            problems.append(f"{key} has the wrong type")
+    for key, expected in optional_keys.items():
+        if key in candidate and candidate[key] is not None and not isinstance(candidate[key], expected):
+            problems.append(f"{key} has the wrong type")
+    if isinstance(candidate.get("guilds"), dict):
+        for guild_id, partition in candidate["guilds"].items():
+            if not guild_id.isdigit() or not isinstance(partition, dict):
+                problems.append(f"the guild {guild_id} is not a guild ID with settings")
+                continue
+            for key in guild_keys:
+                if not isinstance(partition.get(key), int):
+                    problems.append(f"{key} of the guild {guild_id} is missing")
+    for scope, values in [("", candidate)] + [(f" of the guild {guild_id}", partition) for guild_id, partition
+                                               in (candidate.get("guilds") or {}).items() if isinstance(partition, dict)]:
+        if values.get("region") is not None and values["region"] not in regions.default_locales:
+            problems.append(f"the region{scope} is not one of {', '.join(regions.default_locales)}")
+    if isinstance(candidate.get("cooldowns"), dict):
+        for command, cooldown in candidate["cooldowns"].items():
+            if not isinstance(cooldown, (int, float)):
+                problems.append(f"the cooldown of {command} is not a number")
+    if isinstance(candidate.get("emotes"), dict):
+        for emote in required_emotes:
+            if type(candidate["emotes"].get(emote)) is not str:
+                problems.append(f"the emote {emote} is missing")
+    return problems
+
+
+def changed_keys(old: dict, new: dict) -> set:
+    """
+    :param old: The settings in use
+    :param new: The settings that were read
+    :return: The top-level keys whose value differs, added and removed keys included
+    """
+    return {key for key in old.keys() | new.keys() if old.get(key) != new.get(key)}
+
+
+def add_listener(listener):
+    """
+    Registers a function that is called with the new settings after every reload, it has to swap them in
+    :param listener: The function
+    """
+    listeners.append(listener)
+
+
+def check() -> bool:
+    """
+    Reloads the settings if the file was changed since it was last read or written by the bot
+    :return: Whether new settings were applied
+    """
+    global last_mtime
+    mtime = get_mtime()
+    if mtime is None or mtime == last_mtime:
+        return False
+    last_mtime = mtime
+    metrics.store_operations.inc(file=path, operation="read")
+    try:
+        file = open(path, "r")
+        candidate = json.load(file)
+        file.close()
+    except (OSError, ValueError) as error:
+        metrics.settings_reloads.inc(outcome="invalid")
+        print(f"Settings not reloaded, {path} could not be read: {error}")
+        return False
+    problems = validate(candidate)
+    if len(problems) != 0:
+        metrics.settings_reloads.inc(outcome="invalid")
+        print(f"Settings not reloaded, {path} is invalid: {', '.join(problems)}")
+        return False
+    metrics.settings_reloads.inc(outcome="applied")
+    for listener in listeners:
+        listener(candidate)
+    return True
+
+
+async def poll():
+    """
+    Runs on the event loop and checks the settings file every poll_interval seconds
+    """
+    while running:
+        await asyncio.sleep(poll_interval)
+        check()
+
+
+def start():
+    """
+    Starts watching the settings file, must be called from inside the running event loop, does nothing if it
+    already runs
+    """
+    global running, poll_task
+    if running:
+        return
+    running = True
+    if last_mtime is None:
+        mark_current()
+    poll_task = asyncio.get_running_loop().create_task(poll())
+
+
+def stop():
+    """
+    Stops watching the settings file
+    """
+    global running
+    running = False
@@ -0,0 +1,109 @@
+"""
+sharedcache
+~~~~~~~~~~~~
+
+This module implements a cache that is shared by every process of the bot.
+When the shards of the bot run in several processes, each of them would otherwise fetch its own accesstoken, item
+icons and character profiles. Entries are stored compressed in a SQLite database that every process opens, and
+each process still keeps its own in-memory caches in front of it. Nothing is shared while no database is
+configured.
+
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+import metrics
+
+database_file = None
+
+connection = None
+lock = threading.Lock()
+
+schema = """
+CREATE TABLE IF NOT EXISTS entries (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    stored REAL NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (kind, key)
+) WITHOUT ROWID;
+"""
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Opens the database the first time it is needed and creates the table if it does not exist yet, must be called
+    while holding the lock
+    :return: The connection to the database
+    """
+    global connection
+    if connection is None:
+        connection = sqlite3.connect(database_file, check_same_thread=False, timeout=5)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(schema)
+    return connection
+
+
+def get(kind: str, key: str, max_age: float) -> tuple:
+    """
+    Looks up an entry
+    :param kind: The kind of the entry, e.g. "response"
+    :param key: The key of the entry
+    :param max_age: The maximum age of the entry in seconds
+    :return: A tuple of the value and the time it was stored, or None if there is no such entry
+    """
+    if database_file is None:
+        return None
+    try:
+        with lock:
+            row = get_connection().execute("SELECT stored, value FROM entries WHERE kind = ? AND key = ? AND stored > ?",
+                                           (kind, key, time.time() - max_age)).fetchone()
+    except sqlite3.Error as error:
+        print(f"Shared cache could not be read: {error}")
+        return None
+    if row is None:
+        metrics.cache_requests.inc(cache=f"shared {kind}", outcome="miss")
+        return None
+    metrics.cache_requests.inc(cache=f"shared {kind}", outcome="hit")
+    return json.loads(zlib.decompress(row[1])), row[0]
+
+
+def put(kind: str, key: str, value, stored: float = None):
+    """
+    Stores an entry, replacing an older one with the same key
+    :param kind: The kind of the entry
+    :param key: The key of the entry
+    :param value: The value, anything that can be written as JSON
+    :param stored: Time the value was retrieved, now if not given
+    """
+    if database_file is None:
+        return
+    blob = zlib.compress(json.dumps(value).encode("utf-8"))
+    try:
+        with lock:
+            database = get_connection()
+            with database:
+                database.execute("INSERT OR REPLACE INTO entries (kind, key, stored, value) VALUES (?, ?, ?, ?)",
+                                 (kind, key, stored if stored is not None else time.time(), blob))
+    except sqlite3.Error as error:
+        print(f"Shared cache could not be written: {error}")
+
+
+def prune(kind: str, max_age: float) -> int:
+    """
+    Deletes the entries of a kind that are older than max_age
+    :param kind: The kind of the entries
+    :param max_age: The maximum age of the entries in seconds
+    :return: The number of deleted entries
+    """
+    if database_file is None:
+        return 0
+    with lock:
+        database = get_connection()
+        with database:
+            return database.execute("DELETE FROM entries WHERE kind = ? AND stored < ?",
+                                    (kind, time.time() - max_age)).rowcount
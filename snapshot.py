@@ -0,0 +1,106 @@
+"""
+snapshot
+~~~~~~~~~~~~
+
+This module implements the warm-start snapshot of the bot.
+On shutdown the in-memory caches (accesstoken, recent api responses, known characters and the latest raidcheck of every channel)
+are written to a compressed file, and on boot they are loaded again, so the first command after a restart does not start cold.
+The caches of every region are included.
+
+"""
+
+import gzip
+import json
+import os
+import time
+
+import blizzapi
+import characterindex
+
+snapshot_version = 4
+max_responses = 2000
+
+
+def collect_snapshot(raidchecks: dict = None) -> dict:
+    """
+    Collects the state of every cache that should survive a restart
+    :param raidchecks: The IDs of the latest raidcheck runs, as returned by raidcheckstore.export_latest()
+    :return: A dictionary that can be written as JSON
+    """
+    with blizzapi.cache_lock:
+        entries = [item for cache in blizzapi.response_caches.values() for item in cache.items()]
+        tokens = {region: dict(token_cache) for region, token_cache in blizzapi.token_caches.items()}
+    entries.sort(key=lambda item: item[1]["fetched"])
+    responses = []
+    for (url, namespace, locale), entry in entries[-max_responses:]:
+        responses.append({"url": url, "namespace": namespace, "locale": locale,
+                          "fetched": entry["fetched"], "data": entry["data"]})
+
+    with characterindex.lock:
+        characters = [[region, name, realm, entry]
+                      for (region, name, realm), entry in characterindex.entries.items()]
+
+    return {
+        "version": snapshot_version,
+        "created": time.time(),
+        "tokens": tokens,
+        "responses": responses,
+        "characters": characters,
+        "raidchecks": raidchecks or {}
+    }
+
+
+def save_snapshot(path: str, raidchecks: dict = None):
+    """
+    Writes the snapshot to a file, the file is replaced atomically so a crash never leaves half a snapshot behind
+    :param path: Path of the snapshot file
+    :param raidchecks: The IDs of the latest raidcheck runs, see collect_snapshot()
+    """
+    snapshot = collect_snapshot(raidchecks)
+    temporary_path = path + ".tmp"
+    file = gzip.open(temporary_path, "wt", encoding="utf-8")
+    json.dump(snapshot, file)
+    file.close()
+    os.replace(temporary_path, path)
+
+
+def load_snapshot(path: str) -> dict:
+    """
+    Loads a snapshot and puts its contents back into the caches, expired entries are skipped
+    :param path: Path of the snapshot file
+    :return: A dictionary with the number of restored "responses", whether a "token" was restored and the
+    latest "raidchecks", or an empty dictionary if there was no usable snapshot
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        file = gzip.open(path, "rt", encoding="utf-8")
+        snapshot = json.load(file)
+        file.close()
+    except (OSError, ValueError):
+        return {}
+    if snapshot.get("version") != snapshot_version:
+        return {}
+
+    now = time.time()
+    restored_token = False
+    for region, token in snapshot["tokens"].items():
+        if token["token"] is not None and token["expires"] > now:
+            blizzapi.get_token_cache(region).update(token)
+            restored_token = True
+
+    restored = 0
+    for response in snapshot["responses"]:
+        if now - response["fetched"] >= blizzapi.stale_ttl:
+            continue
+        key = (response["url"], response["namespace"], response["locale"])
+        blizzapi.store_response(key, response["data"], response["fetched"])
+        restored += 1
+
+    for region, name, realm, entry in snapshot.get("characters", []):
+        ttl = characterindex.positive_ttl if entry["exists"] else characterindex.negative_ttl
+        if now - entry["checked"] < ttl:
+            with characterindex.lock:
+                characterindex.entries[(region, name, realm)] = entry
+
+    return {"responses": restored, "token": restored_token, "raidchecks": snapshot.get("raidchecks", {})}
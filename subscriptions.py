@@ -0,0 +1,202 @@
+"""
+subscriptions
+~~~~~~~~~~~~
+
+This module implements the subscriptions to gear changes of characters.
+A user can follow a character, or the raid list of a guild, and is notified (by direct message or in a channel)
+when the status row of the raidcheck overview or the item level of a followed character changes. Every followed
+character is polled on its own schedule: the interval grows while nothing changes and drops back to the minimum
+after a change, and the polls are conditional requests that cost little while the equipment stays the same. The
+subscriptions and the last seen state of every character are stored on disk, so no change is missed across a
+restart.
+
+"""
+
+import json
+import os
+import threading
+import time
+
+import metrics
+
+subscriptions_file = "subscriptions.json"
+min_interval = 300
+max_interval = 3600
+backoff_factor = 1.5
+
+# Every subscription is a dictionary with the "user", the "guild" and the "channel" to post in (None for a direct
+# message), and either the "name" and "realm" of a character or "raidlist" as "target"
+subscriptions = []
+# The polling state of every followed character, by the key from make_key()
+watches = {}
+lock = threading.Lock()
+loaded = False
+
+
+def make_key(region: str, name: str, realm: str) -> str:
+    """
+    :param region: The region of the Character
+    :param name: Name of the Character, as used in api requests
+    :param realm: Slug of the Realm of the Character
+    :return: The key under which the state of the character is stored
+    """
+    return f"{region}|{name.lower()}|{realm.lower()}"
+
+
+def load():
+    """
+    Reads the subscriptions and the last seen state of the followed characters from disk, once
+    """
+    global subscriptions, loaded
+    with lock:
+        if loaded:
+            return
+        loaded = True
+        if not os.path.exists(subscriptions_file):
+            return
+        metrics.store_operations.inc(file=subscriptions_file, operation="read")
+        file = open(subscriptions_file, "r", encoding="utf-8")
+        stored = json.load(file)
+        file.close()
+        subscriptions = stored["subscriptions"]
+        for key, state in stored["watches"].items():
+            watches[key] = {"status": state["status"], "avgilvl": state["avgilvl"], "interval": min_interval,
+                            "next": 0.0}
+
+
+def save():
+    """
+    Writes the subscriptions and the last seen state of the followed characters to disk, the file is replaced
+    atomically
+    """
+    with lock:
+        stored = {
+            "subscriptions": subscriptions,
+            "watches": {key: {"status": watch["status"], "avgilvl": watch["avgilvl"]}
+                        for key, watch in watches.items() if watch["status"] is not None}
+        }
+    metrics.store_operations.inc(file=subscriptions_file, operation="write")
+    temporary_path = subscriptions_file + ".tmp"
+    file = open(temporary_path, "w", encoding="utf-8")
+    json.dump(stored, file, indent=4, ensure_ascii=False)
+    file.close()
+    os.replace(temporary_path, subscriptions_file)
+
+
+def matches(subscription: dict, user: int, guild: int, target: str, name: str = None, realm: str = None) -> bool:
+    return (subscription["user"] == user and subscription["guild"] == guild and subscription["target"] == target
+            and (target == "raidlist" or (subscription["name"].lower() == name.lower()
+                                          and subscription["realm"] == realm)))
+
+
+def subscribe(user: int, guild: int, channel: int, target: str, name: str = None, realm: str = None) -> bool:
+    """
+    Adds a subscription, an existing subscription of the user to the same target is replaced
+    :param user: Discord-ID of the user
+    :param guild: ID of the guild the subscription was made in, None for direct messages
+    :param channel: ID of the channel to post changes in, None to send them as direct message
+    :param target: "character" or "raidlist"
+    :param name: Name of the Character, for "character"
+    :param realm: Slug of the Realm of the Character, for "character"
+    :return: Whether the user did not follow the target before
+    """
+    load()
+    subscription = {"user": user, "guild": guild, "channel": channel, "target": target}
+    if target == "character":
+        subscription.update({"name": name, "realm": realm})
+    with lock:
+        existing = [entry for entry in subscriptions if matches(entry, user, guild, target, name, realm)]
+        for entry in existing:
+            subscriptions.remove(entry)
+        subscriptions.append(subscription)
+    save()
+    return len(existing) == 0
+
+
+def unsubscribe(user: int, guild: int, target: str, name: str = None, realm: str = None) -> bool:
+    """
+    Removes a subscription
+    :param user: Discord-ID of the user
+    :param guild: ID of the guild the subscription was made in
+    :param target: "character" or "raidlist"
+    :param name: Name of the Character, for "character"
+    :param realm: Slug of the Realm of the Character, for "character"
+    :return: Whether the user followed the target
+    """
+    load()
+    with lock:
+        existing = [entry for entry in subscriptions if matches(entry, user, guild, target, name, realm)]
+        for entry in existing:
+            subscriptions.remove(entry)
+    if len(existing) != 0:
+        save()
+    return len(existing) != 0
+
+
+def get_subscriptions(user: int = None) -> list:
+    """
+    :param user: Discord-ID of a user, None for the subscriptions of every user
+    :return: A list with the subscriptions
+    """
+    load()
+    with lock:
+        return [dict(entry) for entry in subscriptions if user is None or entry["user"] == user]
+
+
+def due_keys(followed: set, now: float = None) -> list:
+    """
+    Starts polling characters that were followed since the last call, stops polling the ones that are not followed
+    anymore, and finds the ones that should be polled now
+    :param followed: The keys of every followed character
+    :param now: The current time, now if not given
+    :return: The keys of the characters to poll
+    """
+    now = now if now is not None else time.time()
+    with lock:
+        for key in list(watches):
+            if key not in followed:
+                del watches[key]
+        for key in followed:
+            if key not in watches:
+                watches[key] = {"status": None, "avgilvl": None, "interval": min_interval, "next": 0.0}
+        return [key for key, watch in watches.items() if watch["next"] <= now]
+
+
+def record_poll(key: str, status: list, avgilvl: float, now: float = None) -> dict:
+    """
+    Compares the result of a poll with the last seen state of a character and schedules the next poll, sooner after
+    a change and later the longer nothing changed
+    :param key: The key of the character, see make_key()
+    :param status: The status codes of the character, as returned by data_processing.get_gear_status(), or None if
+    the poll failed
+    :param avgilvl: The item level of the character
+    :param now: The current time, now if not given
+    :return: A dictionary with the "status" and "avgilvl" seen before and now if the character changed, otherwise
+    None. The first poll of a character only records its state
+    """
+    now = now if now is not None else time.time()
+    change = None
+    with lock:
+        watch = watches.get(key)
+        if watch is None:
+            return None
+        if status is None:
+            outcome = "error"
+        elif watch["status"] is None:
+            outcome = "first"
+        elif watch["status"] != status or watch["avgilvl"] != avgilvl:
+            outcome = "changed"
+            change = {"before": {"status": watch["status"], "avgilvl": watch["avgilvl"]},
+                      "after": {"status": status, "avgilvl": avgilvl}}
+        else:
+            outcome = "unchanged"
+        if outcome == "changed" or outcome == "first":
+            watch["interval"] = min_interval
+        else:
+            watch["interval"] = min(max_interval, watch["interval"] * backoff_factor)
+        if status is not None:
+            watch["status"] = status
+            watch["avgilvl"] = avgilvl
+        watch["next"] = now + watch["interval"]
+    metrics.subscription_polls.inc(outcome=outcome)
+    return change
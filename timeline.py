@@ -0,0 +1,207 @@
+"""
+timeline
+~~~~~~~~~~~~
+
+This module implements the gear timeline, an append-only record of every raidcheck.
+Each check stores one compact row per character (itemlevel, status codes, embellishments and a fingerprint of
+the equipment) in a SQLite database, never the raw responses of the api. The rows are clustered by character so
+the history of one character is a single range scan, and every check keeps its roster-wide aggregates so trends
+over a whole season only have to read one row per check.
+
+"""
+
+import sqlite3
+import threading
+import time
+import zlib
+
+import numpy as np
+
+import metrics
+import realmindex
+
+database_file = "timeline.db"
+max_rows = 15
+
+connection = None
+lock = threading.Lock()
+
+schema = """
+CREATE TABLE IF NOT EXISTS checks (
+    id INTEGER PRIMARY KEY,
+    taken REAL NOT NULL,
+    characters INTEGER NOT NULL,
+    avgilvl REAL NOT NULL,
+    enchants_missing INTEGER NOT NULL,
+    embellished INTEGER NOT NULL,
+    guild INTEGER
+);
+CREATE INDEX IF NOT EXISTS checks_taken ON checks (taken);
+CREATE TABLE IF NOT EXISTS entries (
+    name TEXT NOT NULL,
+    realm TEXT NOT NULL,
+    check_id INTEGER NOT NULL,
+    taken REAL NOT NULL,
+    avgilvl REAL NOT NULL,
+    status BLOB NOT NULL,
+    embellishments INTEGER NOT NULL,
+    enchants_missing INTEGER NOT NULL,
+    fingerprint INTEGER NOT NULL,
+    PRIMARY KEY (name, realm, check_id)
+) WITHOUT ROWID;
+"""
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Opens the database the first time it is needed and creates the tables if they do not exist yet
+    :return: The connection to the database
+    """
+    global connection
+    if connection is None:
+        connection = sqlite3.connect(database_file, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(schema)
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(checks)")]
+        if "guild" not in columns:
+            # Databases from before the checks were stored per guild, their checks belong to the top-level guild
+            connection.execute("ALTER TABLE checks ADD COLUMN guild INTEGER")
+        connection.execute("CREATE INDEX IF NOT EXISTS checks_guild ON checks (guild, taken)")
+    return connection
+
+
+def equipment_fingerprint(equip: dict) -> int:
+    """
+    Calculates a fingerprint of the equipment of a character, which changes whenever an item, its itemlevel, an
+    enchantment or a gem changes
+    :param equip: The processed equipment of a character, as returned by data_processing.process_equipment()
+    :return: The fingerprint as a 32 bit integer
+    """
+    parts = []
+    for item in sorted(equip["gear"], key=lambda item: item["slottype"]):
+        parts.append(f"{item['slottype']}:{item['id']}:{item['ilvl']}")
+        if item["hasenchantment"]:
+            enchantment = item["enchantment"][0]
+            parts.append(f"{enchantment.get('item', '')}:{enchantment.get('tier', '')}")
+        if item["hassocket"]:
+            parts.append(",".join(socket.get("item", "") for socket in item["sockets"]))
+    return zlib.crc32("|".join(parts).encode())
+
+
+def record_check(playerlist: list, results: list, roster: dict, taken: float = None, guild: int = None) -> int:
+    """
+    Appends the result of a raidcheck to the timeline, characters whose request failed or whose data is stale are
+    left out
+    :param playerlist: The characters of the raidlist, as returned by discordbot.get_raidlist()
+    :param results: The results of data_processing.get_char_equip() for every character, in the same order
+    :param roster: The roster matrix of the results, as returned by raidstats.build_roster_matrix()
+    :param taken: Time of the check, now if not given
+    :param guild: ID of the guild whose raidlist was checked, None for the top-level guild
+    :return: The ID of the check, or None if no character could be recorded
+    """
+    taken = taken if taken is not None else time.time()
+    rows = []
+    for row, chardict in enumerate(results):
+        if not roster["valid"][row] or "stale" in chardict:
+            continue
+        character = playerlist[row]
+        rows.append((
+            character["name"].lower(),
+            realmindex.get_slug(character["realm"]),
+            float(roster["ilvl"][row]),
+            roster["status"][row].astype(np.int8).tobytes(),
+            int(roster["embellishments"][row]),
+            int(roster["enchant_missing"][row].sum()),
+            equipment_fingerprint(chardict["equip"])
+        ))
+    if len(rows) == 0:
+        return None
+
+    metrics.store_operations.inc(file=database_file, operation="write")
+    with lock:
+        database = get_connection()
+        with database:
+            cursor = database.execute(
+                "INSERT INTO checks (taken, characters, avgilvl, enchants_missing, embellished, guild) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (taken, len(rows), sum(row[2] for row in rows) / len(rows), sum(row[5] for row in rows),
+                 sum(1 for row in rows if row[4] >= 2), guild))
+            check_id = cursor.lastrowid
+            database.executemany(
+                "INSERT OR REPLACE INTO entries (name, realm, check_id, taken, avgilvl, status, embellishments, "
+                "enchants_missing, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(name, realm, check_id, taken, *values) for name, realm, *values in rows])
+    return check_id
+
+
+def character_history(name: str, realm: str, since: float = 0.0) -> list:
+    """
+    Reads the timeline of a single character
+    :param name: Name of the Character
+    :param realm: Name of the realm
+    :param since: Only checks after this time are returned
+    :return: A list with a dictionary for every check the character was part of, oldest first
+    """
+    metrics.store_operations.inc(file=database_file, operation="read")
+    with lock:
+        cursor = get_connection().execute(
+            "SELECT taken, avgilvl, status, embellishments, enchants_missing, fingerprint FROM entries "
+            "WHERE name = ? AND realm = ? AND taken >= ? ORDER BY check_id",
+            (name.lower(), realmindex.get_slug(realm), since))
+        rows = cursor.fetchall()
+    return [{
+        "taken": taken,
+        "avgilvl": avgilvl,
+        "status": np.frombuffer(status, dtype=np.int8).tolist(),
+        "embellishments": embellishments,
+        "enchants_missing": enchants_missing,
+        "fingerprint": fingerprint
+    } for taken, avgilvl, status, embellishments, enchants_missing, fingerprint in rows]
+
+
+def roster_trend(since: float = 0.0, guild: int = None) -> list:
+    """
+    Reads the roster-wide aggregates of every check of a guild
+    :param since: Only checks after this time are returned
+    :param guild: ID of the guild, None for the top-level guild
+    :return: A list with a dictionary for every check, oldest first
+    """
+    metrics.store_operations.inc(file=database_file, operation="read")
+    with lock:
+        cursor = get_connection().execute(
+            "SELECT taken, characters, avgilvl, enchants_missing, embellished FROM checks "
+            "WHERE guild IS ? AND taken >= ? ORDER BY taken", (guild, since))
+        rows = cursor.fetchall()
+    return [{
+        "taken": taken,
+        "characters": characters,
+        "avgilvl": round(avgilvl, 2),
+        "enchants_missing": enchants_missing,
+        "embellished": embellished
+    } for taken, characters, avgilvl, enchants_missing, embellished in rows]
+
+
+def gear_changes(history: list) -> list:
+    """
+    Reduces the history of a character to the checks in which its equipment changed
+    :param history: The history as returned by character_history()
+    :return: The first check and every check whose fingerprint differs from the one before
+    """
+    changes = []
+    for entry in history:
+        if len(changes) == 0 or entry["fingerprint"] != changes[-1]["fingerprint"]:
+            changes.append(entry)
+    return changes
+
+
+def downsample(entries: list, count: int = max_rows) -> list:
+    """
+    Picks evenly spaced entries of a list, always including the first and the last one
+    :param entries: The entries, in order
+    :param count: The maximum number of entries to keep
+    :return: The picked entries
+    """
+    if len(entries) <= count:
+        return entries
+    indices = np.unique(np.linspace(0, len(entries) - 1, count).round().astype(int))
+    return [entries[index] for index in indices]
@@ -0,0 +1,196 @@
+"""
+tracing
+~~~~~~~~~~~~
+
+This module implements tracing spans for commands.
+Every command runs inside a trace, and the stages it goes through open spans that attach themselves to the
+currently active span through a contextvar. Commands that take longer than a threshold have their span tree
+printed, and traces can be exported to a file in the Chrome trace event format (viewable in Perfetto).
+
+"""
+
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+slow_threshold = 5.0
+trace_file = None
+max_logged_spans = 60
+
+current_span = contextvars.ContextVar("current_span", default=None)
+trace_ids = itertools.count(1)
+export_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, name: str, parent=None, **attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.children = []
+        self.start = time.perf_counter()
+        self.wallclock = time.time()
+        self.end = None
+        if parent is None:
+            self.trace_id = next(trace_ids)
+        else:
+            self.trace_id = parent.trace_id
+            parent.children.append(self)
+
+    @property
+    def duration(self) -> float:
+        end = self.end if self.end is not None else time.perf_counter()
+        return end - self.start
+
+    def walk(self, depth: int = 0):
+        """
+        Iterates over this span and all of its descendants, depth first
+        :return: Tuples of the depth and the span
+        """
+        yield depth, self
+        for child in self.children:
+            yield from child.walk(depth + 1)
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    """
+    Starts a new trace, which becomes the parent of every span opened inside the with-statement
+    :param name: Name of the trace, usually the command
+    :param attributes: Additional information shown with the trace
+    """
+    root = Span(name, **attributes)
+    token = current_span.set(root)
+    try:
+        yield root
+    finally:
+        current_span.reset(token)
+        root.end = time.perf_counter()
+        finish_trace(root)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Opens a span as a child of the currently active span, does nothing if there is no active trace
+    :param name: Name of the span
+    :param attributes: Additional information shown with the span
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent, **attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    finally:
+        current_span.reset(token)
+        child.end = time.perf_counter()
+
+
+def annotate(**attributes):
+    """
+    Adds information to the currently active span, does nothing if there is no active trace
+    :param attributes: The information to add
+    """
+    current = current_span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def traced(name: str = None):
+    """
+    Decorator that runs every call of a function, sync or async, inside a span
+    :param name: Name of the span, the name of the function if not given
+    """
+    def decorator(function):
+        spanname = name or function.__name__
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with span(spanname):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with span(spanname):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_attributes(attributes: dict) -> str:
+    return " ".join(f"{key}={value}" for key, value in attributes.items())
+
+
+def format_trace(root: Span) -> str:
+    """
+    Formats a trace for the slow-command log, with the total time per span name followed by the span tree
+    :param root: The root span of the trace
+    :return: The formatted trace
+    """
+    breakdown = {}
+    for depth, current in root.walk():
+        if depth == 0:
+            continue
+        count, total = breakdown.get(current.name, (0, 0.0))
+        breakdown[current.name] = (count + 1, total + current.duration)
+
+    lines = [f"Slow command: {root.name} took {root.duration * 1000:.1f} ms {format_attributes(root.attributes)}",
+             "Breakdown:"]
+    for spanname, (count, total) in sorted(breakdown.items(), key=lambda entry: -entry[1][1]):
+        lines.append(f"  {spanname:<28}{count:>6}x {total * 1000:12.1f} ms")
+    lines.append("Spans:")
+    for number, (depth, current) in enumerate(root.walk()):
+        if number == max_logged_spans:
+            lines.append(f"  ... {sum(1 for _ in root.walk()) - max_logged_spans} more")
+            break
+        offset = (current.start - root.start) * 1000
+        lines.append(f"  {'  ' * depth}{current.name} +{offset:.1f} ms {current.duration * 1000:.1f} ms "
+                     f"{format_attributes(current.attributes)}".rstrip())
+    return "\n".join(lines)
+
+
+def export_trace(root: Span, path: str):
+    """
+    Appends a trace to a file in the Chrome trace event format. The file is a JSON array without its closing
+    bracket, which the format allows, so traces can be appended without rewriting it
+    :param root: The root span of the trace
+    :param path: Path of the trace file
+    """
+    events = []
+    for depth, current in root.walk():
+        events.append(json.dumps({
+            "name": current.name,
+            "ph": "X",
+            "ts": round((root.wallclock + current.start - root.start) * 1e6),
+            "dur": round(current.duration * 1e6),
+            "pid": os.getpid(),
+            "tid": root.trace_id,
+            "args": {key: str(value) for key, value in current.attributes.items()}
+        }))
+    with export_lock:
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        file = open(path, "a")
+        if new_file:
+            file.write("[\n")
+        file.write(",\n".join(events) + ",\n")
+        file.close()
+
+
+def finish_trace(root: Span):
+    """
+    Logs the trace if it was slow and exports it if a trace file is configured
+    :param root: The root span of the finished trace
+    """
+    if root.duration >= slow_threshold:
+        print(format_trace(root))
+    if trace_file is not None:
+        export_trace(root, trace_file)
@@ -0,0 +1,101 @@
+"""
+watchdog
+~~~~~~~~~~~~
+
+This module implements a watchdog for the event loop of the bot.
+A task on the event loop ticks at a fixed interval and measures how late every tick is, while a thread outside the
+event loop checks that the ticks keep coming. If the loop stalls for longer than a threshold, the thread samples
+the stack of the event loop thread, so the call that blocks it shows up in the log. The latency of the gateway
+heartbeat is recorded as well.
+
+"""
+
+import asyncio
+import math
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+interval = 0.5
+lag_threshold = 0.25
+max_stack_depth = 25
+
+last_tick = None
+loop_thread_id = None
+running = False
+tick_task = None
+
+
+def format_stack(thread_id: int) -> str:
+    """
+    Formats the current stack of a thread
+    :param thread_id: ID of the thread
+    :return: The stack, innermost call last, or an empty string if the thread does not exist
+    """
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return ""
+    return "".join(traceback.format_stack(frame, limit=max_stack_depth))
+
+
+async def tick(client):
+    """
+    Runs on the event loop, measures how late every tick is and records the heartbeat latency of the gateway
+    :param client: The discord client
+    """
+    global last_tick
+    while running:
+        expected = time.monotonic() + interval
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        last_tick = now
+        lag = max(now - expected, 0.0)
+        metrics.event_loop_lag.observe(lag)
+        if lag >= lag_threshold:
+            print(f"Event loop was blocked for {lag * 1000:.0f} ms")
+        if client is not None and math.isfinite(client.latency):
+            metrics.gateway_latency.set(client.latency)
+
+
+def watch():
+    """
+    Runs in its own thread and samples the stack of the event loop thread whenever the loop stalls
+    """
+    reported = None
+    while running:
+        time.sleep(interval / 2)
+        stalled_since = last_tick
+        lag = time.monotonic() - stalled_since - interval
+        if lag < lag_threshold:
+            continue
+        if reported == stalled_since:
+            continue
+        reported = stalled_since
+        metrics.event_loop_stalls.inc()
+        print(f"Event loop blocked for at least {lag * 1000:.0f} ms, stack of the event loop:\n{format_stack(loop_thread_id)}")
+
+
+def start(client=None):
+    """
+    Starts the watchdog, must be called from inside the running event loop, does nothing if it already runs
+    :param client: The discord client whose heartbeat latency should be recorded
+    """
+    global last_tick, loop_thread_id, running, tick_task
+    if running:
+        return
+    running = True
+    last_tick = time.monotonic()
+    loop_thread_id = threading.get_ident()
+    tick_task = asyncio.get_running_loop().create_task(tick(client))
+    threading.Thread(target=watch, name="watchdog", daemon=True).start()
+
+
+def stop():
+    """
+    Stops the watchdog
+    """
+    global running
+    running = False